@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Local stand-in for the Kuoni HotelMap bookings search and Auth0 token endpoints.
+
+Serves synthetic hotels/rates/rooms/nightly payloads with configurable latency,
+error rate, 429 throttling and response size, so the fetcher can be exercised and
+benchmarked without touching the live API. Point the fetcher at it with
+--url http://HOST:PORT/v1/hotelmap/bookings/search and
+--auth-url http://HOST:PORT/oauth/token.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Mapping
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8787
+SEARCH_PATH = "/v1/hotelmap/bookings/search"
+AUTH_PATH = "/oauth/token"
+DEFAULT_START_DATE = date(2026, 8, 1)
+
+
+class StubConfig:
+    """Behaviour knobs for the stub; shared by all request handler threads."""
+
+    def __init__(
+        self,
+        *,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: float = 1.0,
+        rates: int = 1,
+        rooms_per_rate: int = 1,
+        nights: int = 14,
+        max_rooms: int = 12,
+        start_date: date = DEFAULT_START_DATE,
+        token_expires_in: int = 86400,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rates = rates
+        self.rooms_per_rate = rooms_per_rate
+        self.nights = nights
+        self.max_rooms = max_rooms
+        self.start_date = start_date
+        self.token_expires_in = token_expires_in
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.counters: dict[str, int] = {
+            "auth": 0,
+            "searches": 0,
+            "errors": 0,
+            "throttled": 0,
+            "unauthorized": 0,
+        }
+        self.tokens: set[str] = set()
+
+    def roll(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def issue_token(self) -> str:
+        with self._lock:
+            token = f"stub-token-{len(self.tokens) + 1}"
+            self.tokens.add(token)
+        return token
+
+
+def synthetic_response(config: StubConfig, payload: Mapping[str, Any]) -> dict[str, Any]:
+    """Build a deterministic bookings search response for a payload."""
+    hotel_id = str(payload.get("hotel_id") or "")
+    stays = payload.get("config") or []
+    seed_source = json.dumps([config.seed, hotel_id, stays], sort_keys=True)
+    rng = random.Random(hashlib.sha256(seed_source.encode("utf-8")).hexdigest())
+    if stays:
+        dates = [str(stay.get("date")) for stay in stays]
+    else:
+        dates = [
+            (config.start_date + timedelta(days=offset)).isoformat()
+            for offset in range(config.nights)
+        ]
+
+    rates = []
+    for rate_index in range(config.rates):
+        rooms = []
+        for room_index in range(config.rooms_per_rate):
+            rooms.append(
+                {
+                    "room_id": f"{hotel_id}-R{rate_index}-{room_index}",
+                    "name": f"Synthetic room {room_index}",
+                    "nightly": [
+                        {"date": night, "rooms": rng.randint(0, config.max_rooms)}
+                        for night in dates
+                    ],
+                }
+            )
+        rates.append(
+            {
+                "rate_id": f"{hotel_id}-RATE{rate_index}",
+                "board": "RO",
+                "currency": "EUR",
+                "nightly": {night: rng.randint(0, config.max_rooms) for night in dates},
+                "rooms": rooms,
+            }
+        )
+    return {
+        "success": True,
+        "hotels": [{"hotel_id": hotel_id, "name": f"Hotel {hotel_id}", "rates": rates}],
+    }
+
+
+def make_handler(config: StubConfig) -> type[BaseHTTPRequestHandler]:
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Send headers and body in one segment; otherwise Nagle plus delayed ACKs add
+        # ~40 ms to every keep-alive response and swamp the configured latency.
+        disable_nagle_algorithm = True
+        wbufsize = -1
+
+        def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+            pass
+
+        def _send_json(self, status: int, body: Any, headers: Mapping[str, str] | None = None) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self) -> None:  # noqa: N802
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                self._send_json(400, {"error": "invalid JSON"})
+                return
+
+            if self.path.rstrip("/").endswith(AUTH_PATH):
+                config.count("auth")
+                self._send_json(
+                    200,
+                    {
+                        "access_token": config.issue_token(),
+                        "expires_in": config.token_expires_in,
+                        "token_type": "Bearer",
+                    },
+                )
+                return
+            if not self.path.rstrip("/").endswith(SEARCH_PATH):
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+                return
+
+            config.count("searches")
+            auth = self.headers.get("Authorization", "")
+            if config.tokens and auth.removeprefix("Bearer ") not in config.tokens:
+                config.count("unauthorized")
+                self._send_json(401, {"error": "invalid token"})
+                return
+            delay = max(0.0, config.latency + (config.roll() * 2 - 1) * config.jitter)
+            time.sleep(delay)
+            roll = config.roll()
+            if roll < config.throttle_rate:
+                config.count("throttled")
+                self._send_json(
+                    429, {"error": "rate limited"}, {"Retry-After": f"{config.retry_after:g}"}
+                )
+                return
+            if roll < config.throttle_rate + config.error_rate:
+                config.count("errors")
+                self._send_json(502, {"error": "synthetic upstream failure"})
+                return
+            self._send_json(200, synthetic_response(config, payload))
+
+    return StubHandler
+
+
+def start_stub_server(
+    config: StubConfig, host: str = DEFAULT_HOST, port: int = 0
+) -> tuple[ThreadingHTTPServer, str]:
+    """Start the stub on a daemon thread; returns the server and its base URL.
+
+    Port 0 picks a free port. Call server.shutdown() when done.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    bound_host, bound_port = server.server_address[:2]
+    return server, f"http://{bound_host}:{bound_port}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Bind address (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port (default: {DEFAULT_PORT})")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Uniform +/- latency jitter in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of searches answered 502")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of searches answered 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds on 429")
+    parser.add_argument("--rates", type=int, default=1, help="Rate plans per hotel response")
+    parser.add_argument("--rooms-per-rate", type=int, default=1, help="Rooms per rate plan")
+    parser.add_argument(
+        "--nights", type=int, default=14, help="Nights per response when the payload has no config"
+    )
+    parser.add_argument(
+        "--start-date",
+        type=date.fromisoformat,
+        default=DEFAULT_START_DATE,
+        help=f"First night for payloads without config (default: {DEFAULT_START_DATE})",
+    )
+    parser.add_argument(
+        "--token-expires-in", type=int, default=86400, help="expires_in for issued tokens"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic data")
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        rates=args.rates,
+        rooms_per_rate=args.rooms_per_rate,
+        nights=args.nights,
+        start_date=args.start_date,
+        token_expires_in=args.token_expires_in,
+        seed=args.seed,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(config))
+    base = f"http://{args.host}:{args.port}"
+    print(f"Stub listening: --url {base}{SEARCH_PATH} --auth-url {base}{AUTH_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(config.counters))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Offline benchmarks for kuoni_room_availability against the local API stub.
+
+Times fetch_bookings_availability (through kuoni_api_stub), extract_hotel_nightly_counts,
+build_availability_rows/build_availability_grid and each writer across hotel and
+date scales, and emits the results as JSON so runs can be compared between versions.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Sequence
+
+import requests
+
+import kuoni_api_stub as stub
+import kuoni_room_availability as kra
+
+QUICK_HOTELS = [50, 200]
+QUICK_NIGHTS = [30, 120]
+FULL_HOTELS = [50, 200, 700]
+FULL_NIGHTS = [30, 120, 365]
+DEFAULT_CONCURRENCY = [1, 8]
+
+
+def git_commit() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip() or None
+
+
+def timed(fn: Callable[[], Any], repeat: int) -> dict[str, float]:
+    """Run fn `repeat` times with its stdout silenced; return best/mean seconds."""
+    durations = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            durations.append(time.perf_counter() - start)
+    return {
+        "seconds": min(durations),
+        "mean_seconds": sum(durations) / len(durations),
+        "runs": len(durations),
+    }
+
+
+def synthetic_hotel_ids(count: int) -> list[str]:
+    return [f"BENCHHTL{index:05d}" for index in range(count)]
+
+
+def synthetic_responses(
+    hotel_ids: Sequence[str], nights: int, *, rates: int = 1, rooms_per_rate: int = 1
+) -> list[dict[str, Any]]:
+    config = stub.StubConfig(nights=nights, rates=rates, rooms_per_rate=rooms_per_rate)
+    return [stub.synthetic_response(config, {"hotel_id": hotel_id}) for hotel_id in hotel_ids]
+
+
+def bench_fetch(
+    hotel_count: int,
+    concurrency: int,
+    *,
+    latency: float,
+    workdir: Path,
+    repeat: int,
+) -> dict[str, Any]:
+    config = stub.StubConfig(latency=latency, jitter=latency / 4)
+    server, base_url = stub.start_stub_server(config)
+    try:
+        hotel_ids = synthetic_hotel_ids(hotel_count)
+        args = kra.build_parser().parse_args(
+            [
+                "--token",
+                "bench",
+                "--url",
+                base_url + stub.SEARCH_PATH,
+                "--jsonl-output",
+                str(workdir / f"fetch_{hotel_count}_{concurrency}.jsonl"),
+                "--concurrency",
+                str(concurrency),
+                "--rate",
+                "10000",
+                "--max-rate",
+                "10000",
+            ]
+        )
+        session = kra.configure_session(requests.Session(), concurrency)
+        scheduler = kra.RequestScheduler(
+            rate=args.rate,
+            max_rate=args.max_rate,
+            min_rate=kra.scheduler_floor(args.concurrency),
+        )
+
+        def run() -> None:
+            with contextlib.redirect_stderr(io.StringIO()):
+                kra.fetch_bookings_availability(
+                    hotel_ids=hotel_ids,
+                    config=None,
+                    args=args,
+                    session=session,
+                    scheduler=scheduler,
+                )
+
+        result = timed(run, repeat)
+    finally:
+        server.shutdown()
+        server.server_close()
+    result["requests_per_second"] = hotel_count / result["seconds"]
+    return result
+
+
+def bench_outputs(
+    hotel_count: int, nights: int, *, workdir: Path, repeat: int
+) -> list[dict[str, Any]]:
+    hotel_ids = synthetic_hotel_ids(hotel_count)
+    responses = synthetic_responses(hotel_ids, nights)
+    params = {"hotels": hotel_count, "nights": nights}
+    results: list[dict[str, Any]] = []
+
+    def record(name: str, fn: Callable[[], Any]) -> None:
+        results.append({"name": name, "params": params, **timed(fn, repeat)})
+
+    record(
+        "extract_hotel_nightly_counts",
+        lambda: [kra.extract_hotel_nightly_counts(response) for response in responses],
+    )
+    hotel_map = {
+        hotel_id: kra.extract_hotel_nightly_counts(response)
+        for hotel_id, response in zip(hotel_ids, responses)
+    }
+    record("build_availability_rows", lambda: kra.build_availability_rows(hotel_map))
+    record("build_availability_grid", lambda: kra.build_availability_grid(hotel_map))
+    grid = kra.build_availability_grid(hotel_map)
+
+    stem = workdir / f"grid_{hotel_count}_{nights}"
+    record("write_csv", lambda: kra.write_csv(grid, stem.with_suffix(".csv")))
+    record("write_excel", lambda: kra.write_excel(grid, stem.with_suffix(".xlsx")))
+    record("write_png", lambda: kra.write_png(grid, kra.DEFAULT_PNG_SIZE, stem.with_suffix(".png")))
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        record("write_parquet", lambda: kra.write_parquet(grid, stem.with_suffix(".parquet")))
+    return results
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help=f"Small scales only (hotels {QUICK_HOTELS}, nights {QUICK_NIGHTS})",
+    )
+    parser.add_argument("--hotels", type=int, nargs="+", default=None, help="Hotel counts to run")
+    parser.add_argument("--nights", type=int, nargs="+", default=None, help="Date counts to run")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=DEFAULT_CONCURRENCY,
+        help=f"Fetch concurrency levels (default: {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Stub latency per search in seconds (default: 0.02)"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; best is reported")
+    parser.add_argument("--skip-fetch", action="store_true", help="Only benchmark the offline stages")
+    parser.add_argument(
+        "--output", type=Path, default=None, help="Write the JSON report here instead of stdout"
+    )
+    args = parser.parse_args(argv)
+
+    hotels = args.hotels or (QUICK_HOTELS if args.quick else FULL_HOTELS)
+    nights = args.nights or (QUICK_NIGHTS if args.quick else FULL_NIGHTS)
+    results: list[dict[str, Any]] = []
+    with tempfile.TemporaryDirectory(prefix="kuoni-bench-") as tmp:
+        workdir = Path(tmp)
+        if not args.skip_fetch:
+            for hotel_count in hotels:
+                for concurrency in args.concurrency:
+                    print(f"fetch hotels={hotel_count} concurrency={concurrency}", file=sys.stderr)
+                    result = bench_fetch(
+                        hotel_count,
+                        concurrency,
+                        latency=args.latency,
+                        workdir=workdir,
+                        repeat=args.repeat,
+                    )
+                    results.append(
+                        {
+                            "name": "fetch_bookings_availability",
+                            "params": {
+                                "hotels": hotel_count,
+                                "concurrency": concurrency,
+                                "latency": args.latency,
+                            },
+                            **result,
+                        }
+                    )
+        for hotel_count in hotels:
+            for night_count in nights:
+                print(f"outputs hotels={hotel_count} nights={night_count}", file=sys.stderr)
+                results.extend(
+                    bench_outputs(hotel_count, night_count, workdir=workdir, repeat=args.repeat)
+                )
+
+    report = {
+        "version": 1,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(text + "\n", encoding="utf-8")
+        print(f"Wrote benchmark report to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,24 +1,49 @@
 #!/usr/bin/env python3
 """Fetch Kuoni HotelMap room availability for a list of hotels and emit JSONL,
 CSV, Excel, and PNG outputs. Can also convert an existing bookings JSONL into
-the tabular/visual formats via --convert-only."""
+the tabular/visual formats via --convert-only, and a pricing batch CSV into typed
+Parquet columns via --pricing-input."""
 
 from __future__ import annotations
 
 import argparse
+import ast
+import contextlib
+import contextvars
 import csv
+import gzip
+import hashlib
+import hmac
+import importlib
+import io
 import json
+import math
 import os
+import random
+import re
+import signal
+import sqlite3
 import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Any, Iterable, Mapping, Sequence
+from typing import IO, Any, Callable, Iterable, Iterator, Mapping, Sequence
 
 import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from openpyxl import load_workbook
-from openpyxl.styles import Font, PatternFill
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, NamedStyle, PatternFill
 from PIL import Image
 
 
@@ -34,13 +59,152 @@ DEFAULT_AUTH_CLIENT_ID = os.getenv("KUONI_AUTH_CLIENT_ID")
 DEFAULT_AUTH_CLIENT_SECRET = os.getenv("KUONI_AUTH_CLIENT_SECRET")
 DEFAULT_AUTH_AUDIENCE = os.getenv("KUONI_AUTH_AUDIENCE", "http://52.208.167.3/staging")
 DEFAULT_AUTH_GRANT_TYPE = os.getenv("KUONI_AUTH_GRANT_TYPE", "client_credentials")
+DEFAULT_TOKEN_CACHE = Path(
+    os.getenv("KUONI_TOKEN_CACHE", "~/.cache/roomberg/tokens.json")
+).expanduser()
+DEFAULT_CACHE_DIR = Path(
+    os.getenv("KUONI_CACHE_DIR", "~/.cache/roomberg/bookings")
+).expanduser()
+DEFAULT_HOTEL_INDEX_DIR = Path(
+    os.getenv("KUONI_HOTEL_INDEX_DIR", "~/.cache/roomberg/hotel-index")
+).expanduser()
+DEFAULT_CACHE_TTL = 3600.0
+DEFAULT_CACHE_MAX_MB = 512
+# Refresh cached tokens this many seconds before they actually expire
+TOKEN_EXPIRY_MARGIN = 120.0
 DEFAULT_INPUT_CSV = Path("kuoni_hotel_summary_with_kuoni.csv")
 DEFAULT_HOTEL_COLUMN = "kuoni_id"
+# Hotel summary columns behind --near/--city/--min-stars/--min-rooms
+HOTEL_ATTRIBUTE_COLUMNS = {
+    "lat": "latitude",
+    "lon": "longitude",
+    "city": "city",
+    "stars": "stars",
+    "rooms": "number_of_rooms",
+}
+HOTEL_INDEX_VERSION = 1
+# Grid cell size (degrees) of the hotel spatial index
+HOTEL_INDEX_CELL_DEGREES = 0.5
+EARTH_RADIUS_KM = 6371.0088
+DEFAULT_RADIUS_KM = 20.0  # reference_radius_m of the pricing batches
 DEFAULT_JSONL = Path("output_sheets/bookings_search_results.jsonl")
 DEFAULT_CSV = Path("output_sheets/bookings_search_availability.csv")
 DEFAULT_EXCEL = Path("output_sheets/bookings_search_availability.xlsx")
 DEFAULT_PNG = Path("output_sheets/bookings_search_availability.png")
+DEFAULT_SWEEP_CSV = Path("output_sheets/bookings_search_sweep.csv")
+DEFAULT_HISTORY_DB = os.getenv("KUONI_HISTORY_DB")
+PRICING_CHUNK_ROWS = 50_000
+# Keys of the Python dict repr stored in the price column of pricing_hotels_all.csv
+PRICING_NUMBER_FIELDS = ("Kuoni", "Market", "HotelMap", "sell")
+PRICING_TEXT_FIELDS = ("kuoni_currency", "mkt_currency", "kt_room", "mkt_room", "hotel_name")
+PARQUET_LAYOUTS = ("long", "wide")
+# Precomputed heatmap payload (--heatmap-payload) read by web/lib/availability-heatmap.js
+HEATMAP_DIRNAME = "heatmap"
+HEATMAP_PAYLOAD_VERSION = 1
+HISTORY_QUERIES = ("runs", "series", "diff")
+DEFAULT_HISTORY_RUNS = 20
+DEFAULT_SERVE_HOST = "127.0.0.1"
+DEFAULT_SERVE_PORT = int(os.getenv("ROOMBERG_SERVE_PORT", "8642"))
+# Connections kept per host by the --serve worker's shared session
+SERVE_POOL_SIZE = 32
+# Finished jobs (and their logs) the --serve worker keeps for GET /runs
+SERVE_KEEP_JOBS = 50
+# Shared secret every --serve request must carry in SERVE_TOKEN_HEADER
+SERVE_TOKEN_ENV = "ROOMBERG_WORKER_TOKEN"
+SERVE_TOKEN_HEADER = "X-Roomberg-Worker-Token"
+# Options a --serve job may set. Endpoints, credentials and file paths stay as the
+# worker was started with, so a request cannot redirect the token or overwrite files.
+SERVE_JOB_OPTIONS = frozenset(
+    {
+        "hotel_column",
+        "near",
+        "radius_km",
+        "city",
+        "min_stars",
+        "min_rooms",
+        "stay",
+        "sweep",
+        "start_date",
+        "lead_start",
+        "lead_end",
+        "lead_step",
+        "stay_length",
+        "rooms",
+        "mcode",
+        "event_id",
+        "language",
+        "best_only",
+        "cache",
+        "cache_ttl",
+        "no_cache",
+        "slim",
+        "stream_extract",
+        "resume",
+        "refresh_budget",
+        "refresh_max_age",
+        "convert_only",
+        "chunk_rows",
+        "workers",
+        "no_index",
+        "no_csv",
+        "no_excel",
+        "no_png",
+        "png_size",
+        "png_mode",
+        "png_rooms_required",
+        "png_cell",
+        "png_tile_size",
+        "heatmap_payload",
+        "feasibility",
+        "timeout",
+        "concurrency",
+        "max_retries",
+        "rate",
+        "max_rate",
+        "events",
+    }
+)
 DEFAULT_PNG_SIZE = (520, 700)
+PNG_MODES = ("binary", "graded")
+DEFAULT_ROOMS_REQUIRED = 10  # ROOMS_REQUIRED in web/lib/availability-heatmap.js
+DEFAULT_TILE_SIZE = 256
+PROGRESS_EVERY = 25
+# Volatility-aware refresh (--refresh-budget): smoothing of the per-hotel change rate,
+# the rate assumed before a hotel has been seen twice, and a floor so stable hotels
+# still age into the budget.
+REFRESH_EWMA_ALPHA = 0.3
+REFRESH_DEFAULT_RATE = 0.5
+REFRESH_RATE_FLOOR = 0.05
+DEFAULT_REFRESH_MAX_AGE_HOURS = 168.0
+EVENT_FORMATS = ("jsonl",)
+# Completions averaged for the rolling throughput/ETA in progress events
+THROUGHPUT_WINDOW = 50
+LATENCY_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+COMPRESSED_SUFFIXES = (".gz", ".zst", ".zstd")
+# Body chunk size for --stream-extract and the raw tee
+STREAM_CHUNK_BYTES = 64 * 1024
+# ijson prefixes of the nightly counts extract_hotel_nightly_counts reads
+RATE_NIGHTLY_PREFIX = "hotels.item.rates.item.nightly."
+ROOM_NIGHT_PREFIX = "hotels.item.rates.item.rooms.item.nightly.item"
+# JSONL inputs smaller than this are converted serially even when --workers > 1
+PARALLEL_CONVERT_MIN_BYTES = 16 * 1024 * 1024
+DEFAULT_CONCURRENCY = int(os.getenv("KUONI_BOOKINGS_CONCURRENCY", "1"))
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_MAX_RATE = 100.0
+MIN_RATE = 0.5
+# Seconds after a rate cut during which further 429/503s (typically the rest of the
+# same burst of in-flight requests) do not cut it again
+THROTTLE_COOLDOWN = 1.0
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+THROTTLE_STATUS = frozenset({429, 503})
+# Lead-time sweep grid; matches the defaults in web/lib/availability-heatmap.js
+DEFAULT_LEAD_START = 0
+DEFAULT_LEAD_END = 365
+DEFAULT_LEAD_STEP = 7
+DEFAULT_STAY_LENGTH = 3
+DEFAULT_SWEEP_ROOMS = 10
+# --feasibility profile used when none is given; the web heatmap's default question
+DEFAULT_STAY_PROFILE = (DEFAULT_ROOMS_REQUIRED,) * DEFAULT_STAY_LENGTH
 # Edit these to bake in your stay dates/room counts (DATE:ROOMS)
 DEFAULT_STAY_ARGS = [
     # "2026-08-30:10",
@@ -52,6 +216,442 @@ class KuoniBookingsAPIError(RuntimeError):
     pass
 
 
+class RunCancelled(Exception):
+    """Raised inside a fetch when its cancel event is set (e.g. by the --serve worker)."""
+
+
+class RequestScheduler:
+    """Thread-safe AIMD token bucket with jittered exponential backoff.
+
+    Every attempt takes a token. The rate starts at `max_rate` (or `rate` when
+    given), so an unthrottled run is never slowed by the limiter. Throttling
+    responses (429/503) halve it, down to `min_rate`, and pause all workers until any
+    Retry-After has elapsed; successful responses raise it additively again. A
+    burst of throttled in-flight requests counts as one cut (THROTTLE_COOLDOWN).
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: float | None = None,
+        max_rate: float = DEFAULT_MAX_RATE,
+        min_rate: float = MIN_RATE,
+        increase: float = 0.5,
+        decrease: float = 0.5,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+    ) -> None:
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = min(max(max_rate if rate is None else rate, self.min_rate), self.max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_cut = -math.inf
+        self.stats: dict[str, int] = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "failures": 0,
+        }
+
+    def acquire(self) -> None:
+        """Block until a request token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    elapsed = now - self._updated
+                    self._tokens = min(max(1.0, self.rate), self._tokens + elapsed * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        self.stats["requests"] += 1
+                        return
+                    wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after: float | None) -> None:
+        with self._lock:
+            self.stats["throttled"] += 1
+            now = time.monotonic()
+            if now - self._last_cut >= THROTTLE_COOLDOWN:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_cut = now
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        """Return the delay before retry number `attempt` (1-based), with full jitter."""
+        with self._lock:
+            self.stats["retries"] += 1
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.stats["failures"] += 1
+
+    def summary(self) -> str:
+        stats = self.stats
+        return (
+            f"Scheduler: {stats['requests']} requests, {stats['retries']} retries, "
+            f"{stats['throttled']} throttled, {stats['failures']} failed; "
+            f"final rate {self.rate:.1f} req/s"
+        )
+
+
+def scheduler_floor(concurrency: int) -> float:
+    """Lowest rate throttling may push the scheduler to: one request/s per worker.
+
+    Without a floor, a steady share of 429s keeps halving the rate faster than the
+    additive increase recovers it, and a long run crawls at MIN_RATE.
+    """
+    return max(MIN_RATE, float(concurrency))
+
+
+class ResponseCache:
+    """On-disk booking search cache keyed by a hash of the URL and payload.
+
+    Entries are served while younger than `ttl` seconds. Once the cache grows past
+    `max_bytes`, the least recently used entries (by access time, which hits bump
+    explicitly) are evicted.
+    """
+
+    def __init__(self, directory: Path, *, ttl: float, max_bytes: int) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.stats: dict[str, int] = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in self._entries())
+        if self._size > self.max_bytes:
+            self._evict()
+
+    @staticmethod
+    def key_for(url: str, payload: Mapping[str, Any]) -> str:
+        canonical = json.dumps(
+            {"url": url, "payload": payload}, sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _entries(self) -> Iterable[Path]:
+        return self.directory.glob("*/*.json")
+
+    def get(self, url: str, payload: Mapping[str, Any]) -> Mapping[str, Any] | None:
+        path = self._path(self.key_for(url, payload))
+        try:
+            stat = path.stat()
+            if time.time() - stat.st_mtime > self.ttl:
+                raise FileNotFoundError(path)
+            with path.open(encoding="utf-8") as handle:
+                data = json.load(handle)
+            # Bump atime for LRU ordering; mtime keeps tracking when it was stored.
+            os.utime(path, (time.time(), stat.st_mtime))
+        except (OSError, json.JSONDecodeError):
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        with self._lock:
+            self.stats["hits"] += 1
+        return data
+
+    def open_raw(self, url: str, payload: Mapping[str, Any]) -> IO[bytes] | None:
+        """Open a fresh entry's bytes without decoding them (for --stream-extract)."""
+        path = self._path(self.key_for(url, payload))
+        try:
+            stat = path.stat()
+            if time.time() - stat.st_mtime > self.ttl:
+                raise FileNotFoundError(path)
+            handle = path.open("rb")
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        with self._lock:
+            self.stats["hits"] += 1
+        return handle
+
+    def reserve(self, url: str, payload: Mapping[str, Any]) -> Path:
+        """Temporary path to write a new entry to; hand it to commit() once complete."""
+        path = self._path(self.key_for(url, payload))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+
+    def commit(self, url: str, payload: Mapping[str, Any], tmp_path: Path) -> None:
+        path = self._path(self.key_for(url, payload))
+        try:
+            previous = path.stat().st_size if path.exists() else 0
+            size = tmp_path.stat().st_size
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            print(f"[warn] Could not write cache entry {path}: {exc}", file=sys.stderr)
+            return
+        with self._lock:
+            self.stats["stores"] += 1
+            self._size += size - previous
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def put(self, url: str, payload: Mapping[str, Any], response: Mapping[str, Any]) -> None:
+        data = json.dumps(response).encode("utf-8")
+        try:
+            tmp_path = self.reserve(url, payload)
+            tmp_path.write_bytes(data)
+        except OSError as exc:
+            print(f"[warn] Could not write cache entry: {exc}", file=sys.stderr)
+            return
+        self.commit(url, payload, tmp_path)
+
+    def _evict(self) -> None:
+        """Drop expired entries, then least recently used ones until under 90% of the cap."""
+        target = int(self.max_bytes * 0.9)
+        now = time.time()
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((now - stat.st_mtime > self.ttl, stat.st_atime, stat.st_size, path))
+        # Expired entries first, then oldest access time.
+        entries.sort(key=lambda entry: (not entry[0], entry[1]))
+        size = sum(entry[2] for entry in entries)
+        for expired, _, entry_size, path in entries:
+            if size <= target and not expired:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            size -= entry_size
+            self.stats["evictions"] += 1
+        self._size = size
+
+    def summary(self) -> str:
+        stats = self.stats
+        return (
+            f"Cache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['stores']} stored, {stats['evictions']} evicted ({self.directory})"
+        )
+
+
+class RunEvents:
+    """Machine-readable run events plus the counters behind the end-of-run summary.
+
+    With a `stream`, every event is written to it as one JSON object per line
+    (`{"event": ..., "ts": ...}`); without one the counters are still collected so
+    the summary and Prometheus textfile work on their own. Safe to share across
+    fetch worker threads.
+    """
+
+    def __init__(self, stream: IO[str] | None = None) -> None:
+        self.stream = stream
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._completions: deque[float] = deque(maxlen=THROUGHPUT_WINDOW)
+        self.latencies: list[float] = []
+        self.phases: dict[str, float] = {}
+        self.stats: dict[str, Any] = {
+            "requests": 0,
+            "cached": 0,
+            "bytes": 0,
+            "retries": 0,
+            "statuses": {},
+        }
+
+    def emit(self, event: str, **fields: Any) -> None:
+        if self.stream is None:
+            return
+        line = json.dumps({"event": event, "ts": round(time.time(), 3), **fields})
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def request(
+        self,
+        *,
+        hotel_id: str | None,
+        status: int | str,
+        latency: float,
+        size: int,
+        retries: int,
+        cached: bool = False,
+    ) -> None:
+        """Record one booking search (all of its attempts) and emit a `request` event."""
+        with self._lock:
+            stats = self.stats
+            stats["requests"] += 1
+            stats["bytes"] += size
+            stats["retries"] += retries
+            stats["statuses"][str(status)] = stats["statuses"].get(str(status), 0) + 1
+            if cached:
+                stats["cached"] += 1
+            else:
+                self.latencies.append(latency)
+        self.emit(
+            "request",
+            hotel_id=hotel_id,
+            status=status,
+            latency_ms=round(latency * 1000, 1),
+            bytes=size,
+            retries=retries,
+            cached=cached,
+        )
+
+    def add_phase_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a block, emitting `phase_start`/`phase_end` events around it."""
+        self.emit("phase_start", phase=name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_phase_time(name, seconds)
+            self.emit("phase_end", phase=name, seconds=round(seconds, 4))
+
+    def progress(self, done: int, total: int) -> None:
+        """Emit completed/total with throughput over the last THROUGHPUT_WINDOW tasks."""
+        now = time.perf_counter()
+        self._completions.append(now)
+        rate = eta = None
+        span = now - self._completions[0]
+        if len(self._completions) > 1 and span > 0:
+            rate = (len(self._completions) - 1) / span
+            eta = round((total - done) / rate, 1)
+            rate = round(rate, 2)
+        self.emit("progress", done=done, total=total, rate=rate, eta_seconds=eta)
+
+    def latency_quantiles(self) -> dict[float, float]:
+        if not self.latencies:
+            return {}
+        values = np.quantile(np.asarray(self.latencies), LATENCY_QUANTILES)
+        return dict(zip(LATENCY_QUANTILES, (float(value) for value in values)))
+
+    def summary(self) -> dict[str, Any]:
+        """Emit and return the end-of-run `summary` event."""
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            stats = {**self.stats, "statuses": dict(self.stats["statuses"])}
+            latencies = list(self.latencies)
+        summary = {
+            "elapsed_seconds": round(elapsed, 3),
+            **stats,
+            "errors": sum(
+                count for status, count in stats["statuses"].items() if not status.startswith("2")
+            ),
+            "requests_per_second": round(stats["requests"] / elapsed, 2) if elapsed > 0 else None,
+            "latency_ms": {
+                f"p{round(quantile * 100)}": round(value * 1000, 1)
+                for quantile, value in self.latency_quantiles().items()
+            },
+            "latency_mean_ms": (
+                round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None
+            ),
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+        }
+        self.emit("summary", **summary)
+        return summary
+
+    def write_textfile(self, path: Path) -> None:
+        """Write the run metrics for the node_exporter textfile collector (atomically)."""
+        lines = [
+            "# HELP roomberg_requests_total Booking searches by final HTTP status.",
+            "# TYPE roomberg_requests_total counter",
+        ]
+        lines.extend(
+            f'roomberg_requests_total{{status="{status}"}} {count}'
+            for status, count in sorted(self.stats["statuses"].items())
+        )
+        lines += [
+            "# HELP roomberg_cache_hits_total Booking searches served from the response cache.",
+            "# TYPE roomberg_cache_hits_total counter",
+            f"roomberg_cache_hits_total {self.stats['cached']}",
+            "# HELP roomberg_response_bytes_total Response bytes received from the API.",
+            "# TYPE roomberg_response_bytes_total counter",
+            f"roomberg_response_bytes_total {self.stats['bytes']}",
+            "# HELP roomberg_retries_total Retried booking search attempts.",
+            "# TYPE roomberg_retries_total counter",
+            f"roomberg_retries_total {self.stats['retries']}",
+            "# HELP roomberg_request_latency_seconds Booking search latency including retries.",
+            "# TYPE roomberg_request_latency_seconds summary",
+        ]
+        lines.extend(
+            f'roomberg_request_latency_seconds{{quantile="{quantile:g}"}} {value:.6f}'
+            for quantile, value in self.latency_quantiles().items()
+        )
+        lines += [
+            f"roomberg_request_latency_seconds_sum {sum(self.latencies):.6f}",
+            f"roomberg_request_latency_seconds_count {len(self.latencies)}",
+            "# HELP roomberg_phase_seconds Wall time spent per run phase.",
+            "# TYPE roomberg_phase_seconds gauge",
+        ]
+        lines.extend(
+            f'roomberg_phase_seconds{{phase="{name}"}} {seconds:.6f}'
+            for name, seconds in sorted(self.phases.items())
+        )
+        lines += [
+            "# HELP roomberg_run_seconds Wall time of the last run.",
+            "# TYPE roomberg_run_seconds gauge",
+            f"roomberg_run_seconds {time.perf_counter() - self.started:.6f}",
+            "# HELP roomberg_last_run_timestamp_seconds Unix time the last run finished.",
+            "# TYPE roomberg_last_run_timestamp_seconds gauge",
+            f"roomberg_last_run_timestamp_seconds {time.time():.0f}",
+        ]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(tmp_path, path)
+
+
+def _phase(events: RunEvents | None, name: str) -> contextlib.AbstractContextManager[None]:
+    return events.phase(name) if events else contextlib.nullcontext()
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header (delta seconds or HTTP date) into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
 def parse_stays(stays: Sequence[str]) -> list[dict[str, Any]]:
     """Convert CLI --stay arguments like YYYY-MM-DD:ROOMS into payload dicts."""
     parsed: list[dict[str, Any]] = []
@@ -70,6 +670,35 @@ def parse_stays(stays: Sequence[str]) -> list[dict[str, Any]]:
     return parsed
 
 
+def build_sweep_windows(
+    *,
+    start_date: date,
+    lead_start: int,
+    lead_end: int,
+    lead_step: int,
+    stay_length: int,
+    rooms: int,
+) -> list[dict[str, Any]]:
+    """Return one stay window per lead time, each with its payload config entries."""
+    if lead_step < 1 or stay_length < 1:
+        raise ValueError("Lead step and stay length must be at least 1")
+    if lead_end < lead_start:
+        raise ValueError("Lead end must not be before lead start")
+    windows: list[dict[str, Any]] = []
+    for lead_days in range(lead_start, lead_end + 1, lead_step):
+        check_in = start_date + timedelta(days=lead_days)
+        nights = [check_in + timedelta(days=offset) for offset in range(stay_length)]
+        windows.append(
+            {
+                "lead_days": lead_days,
+                "check_in": check_in.isoformat(),
+                "check_out": (check_in + timedelta(days=stay_length)).isoformat(),
+                "config": [{"date": night.isoformat(), "rooms": rooms} for night in nights],
+            }
+        )
+    return windows
+
+
 def read_hotel_ids(csv_path: Path, column: str | None) -> list[str]:
     hotel_ids: list[str] = []
     with csv_path.open(newline="", encoding="utf-8-sig") as handle:
@@ -94,6 +723,241 @@ def read_hotel_ids(csv_path: Path, column: str | None) -> list[str]:
     return hotel_ids
 
 
+class HotelIndex:
+    """Hotel summary attributes with a lat/lon grid index for radius queries.
+
+    Hotels are bucketed into HOTEL_INDEX_CELL_DEGREES cells and kept sorted by cell,
+    so a radius query only measures the hotels in cells overlapping the circle's
+    bounding box. Built indexes are cached as .npz files keyed by the CSV's path,
+    size and mtime, so repeat runs skip parsing the CSV.
+    """
+
+    LON_CELLS = int(round(360 / HOTEL_INDEX_CELL_DEGREES))
+    FIELDS = ("ids", "lat", "lon", "city", "stars", "rooms")
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        city: np.ndarray,
+        stars: np.ndarray,
+        rooms: np.ndarray,
+    ) -> None:
+        self.ids = ids
+        self.lat = lat
+        self.lon = lon
+        self.city = city
+        self.stars = stars
+        self.rooms = rooms
+        located = ~(np.isnan(lat) | np.isnan(lon))
+        cells = np.full(len(ids), -1, dtype=np.int64)
+        cells[located] = self._cell(self._lat_cell(lat[located]), self._lon_cell(lon[located]))
+        self.order = np.argsort(cells, kind="stable")
+        self.cells = cells[self.order]
+
+    @staticmethod
+    def _lat_cell(lat: Any) -> Any:
+        return np.clip(np.floor((np.asarray(lat) + 90) / HOTEL_INDEX_CELL_DEGREES), 0, None)
+
+    @classmethod
+    def _lon_cell(cls, lon: Any) -> Any:
+        cell = np.floor((np.asarray(lon) + 180) / HOTEL_INDEX_CELL_DEGREES)
+        return np.clip(cell, 0, cls.LON_CELLS - 1)
+
+    @classmethod
+    def _cell(cls, lat_cell: Any, lon_cell: Any) -> Any:
+        return (np.asarray(lat_cell) * cls.LON_CELLS + lon_cell).astype(np.int64)
+
+    @classmethod
+    def build(cls, csv_path: Path, column: str | None) -> HotelIndex:
+        frame = pd.read_csv(csv_path, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+        column = column or frame.columns[0]
+        if column not in frame.columns:
+            raise ValueError(
+                f"Column '{column}' not found. Available columns: {', '.join(frame.columns)}"
+            )
+        frame[column] = frame[column].str.strip()
+        frame = frame[frame[column] != ""]
+
+        def numbers(field: str) -> np.ndarray:
+            name = HOTEL_ATTRIBUTE_COLUMNS[field]
+            if name not in frame.columns:
+                return np.full(len(frame), np.nan)
+            return pd.to_numeric(frame[name], errors="coerce").to_numpy(dtype=np.float64)
+
+        city_column = HOTEL_ATTRIBUTE_COLUMNS["city"]
+        city = frame[city_column] if city_column in frame.columns else pd.Series([""] * len(frame))
+        return cls(
+            frame[column].to_numpy(dtype=str),
+            numbers("lat"),
+            numbers("lon"),
+            city.str.strip().str.casefold().to_numpy(dtype=str),
+            numbers("stars"),
+            numbers("rooms"),
+        )
+
+    @classmethod
+    def load(
+        cls, csv_path: Path, column: str | None, cache_dir: Path | None = DEFAULT_HOTEL_INDEX_DIR
+    ) -> HotelIndex:
+        """Return the cached index for this CSV and column, building it when stale."""
+        if not cache_dir:
+            return cls.build(csv_path, column)
+        stat = csv_path.stat()
+        source = (
+            f"{HOTEL_INDEX_VERSION}|{csv_path.resolve()}|{column}|"
+            f"{stat.st_size}|{stat.st_mtime_ns}"
+        )
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()[:24]
+        cache_path = cache_dir / f"{digest}.npz"
+        try:
+            with np.load(cache_path, allow_pickle=False) as data:
+                return cls(*(data[name] for name in cls.FIELDS))
+        except (OSError, KeyError, ValueError):
+            pass
+        index = cls.build(csv_path, column)
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp.npz")
+            np.savez(tmp_path, **{name: getattr(index, name) for name in cls.FIELDS})
+            os.replace(tmp_path, cache_path)
+        except OSError as exc:
+            print(f"[warn] Could not cache hotel index {cache_path}: {exc}", file=sys.stderr)
+        return index
+
+    def within(self, lat: float, lon: float, radius_km: float) -> np.ndarray:
+        """Row mask of hotels within radius_km (great-circle) of lat/lon."""
+        mask = np.zeros(len(self.ids), dtype=bool)
+        angle = radius_km / EARTH_RADIUS_KM
+        lat_lo = lat - math.degrees(angle)
+        lat_hi = lat + math.degrees(angle)
+        if lat_lo <= -90 or lat_hi >= 90 or math.sin(angle) >= math.cos(math.radians(lat)):
+            lon_ranges = [(0, self.LON_CELLS - 1)]
+        else:
+            # Bounding longitudes of a spherical cap (they are reached off the centre latitude).
+            spread = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+            west, east = lon - spread, lon + spread
+            if west < -180 or east > 180:
+                west, east = (west + 540) % 360 - 180, (east + 540) % 360 - 180
+                lon_ranges = [
+                    (0, int(self._lon_cell(east))),
+                    (int(self._lon_cell(west)), self.LON_CELLS - 1),
+                ]
+            else:
+                lon_ranges = [(int(self._lon_cell(west)), int(self._lon_cell(east)))]
+        slices = []
+        first_row = int(self._lat_cell(max(lat_lo, -90)))
+        last_row = int(self._lat_cell(min(lat_hi, 90)))
+        for lat_cell in range(first_row, last_row + 1):
+            for first, last in lon_ranges:
+                start, stop = np.searchsorted(
+                    self.cells, [self._cell(lat_cell, first), self._cell(lat_cell, last) + 1]
+                )
+                slices.append(self.order[start:stop])
+        candidates = np.concatenate(slices) if slices else np.empty(0, dtype=np.intp)
+        distances = haversine_km(lat, lon, self.lat[candidates], self.lon[candidates])
+        mask[candidates[distances <= radius_km]] = True
+        return mask
+
+    def select(
+        self,
+        *,
+        near: tuple[float, float] | None = None,
+        radius_km: float = DEFAULT_RADIUS_KM,
+        cities: Sequence[str] = (),
+        min_stars: float | None = None,
+        min_rooms: int | None = None,
+    ) -> set[str]:
+        """IDs of the hotels passing every given filter; rows missing a value fail it."""
+        mask = np.ones(len(self.ids), dtype=bool)
+        if near:
+            mask &= self.within(near[0], near[1], radius_km)
+        if cities:
+            mask &= np.isin(self.city, [city.strip().casefold() for city in cities])
+        if min_stars is not None:
+            mask &= self.stars >= min_stars
+        if min_rooms is not None:
+            mask &= self.rooms >= min_rooms
+        return set(self.ids[mask].tolist())
+
+
+def haversine_km(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    lat1, lat2 = math.radians(lat), np.radians(lats)
+    half_dlat = (lat2 - lat1) / 2
+    half_dlon = np.radians(lons - lon) / 2
+    h = np.sin(half_dlat) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(half_dlon) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def parse_point(value: str) -> tuple[float, float]:
+    """Parse a --near LAT,LON point."""
+    try:
+        lat, lon = (float(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected LAT,LON (e.g. 47.38,8.52), got '{value}'"
+        ) from None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise argparse.ArgumentTypeError(f"point {value} is out of range")
+    return lat, lon
+
+
+def select_hotel_ids(hotel_ids: list[str], args: argparse.Namespace) -> list[str]:
+    """Apply the --near/--city/--min-stars/--min-rooms filters, keeping CSV order."""
+    near = args.near
+    radius_km = args.radius_km
+    if args.near_pricing:
+        if near:
+            raise ValueError("--near and --near-pricing are mutually exclusive")
+        lat, lon, pricing_radius = pricing_reference_point(args.near_pricing)
+        near = (lat, lon)
+        radius_km = radius_km if radius_km is not None else pricing_radius
+    if radius_km is not None and radius_km <= 0:
+        raise ValueError("--radius-km must be positive")
+    filters = []
+    if near:
+        radius_km = radius_km if radius_km is not None else DEFAULT_RADIUS_KM
+        filters.append(f"within {radius_km:g} km of {near[0]:.5f},{near[1]:.5f}")
+    if args.city:
+        filters.append(f"city {' / '.join(args.city)}")
+    if args.min_stars is not None:
+        filters.append(f"{args.min_stars:g}+ stars")
+    if args.min_rooms is not None:
+        filters.append(f"{args.min_rooms}+ rooms")
+    if not filters:
+        return hotel_ids
+    started = time.perf_counter()
+    index = HotelIndex.load(args.csv_path, args.hotel_column)
+    selected = index.select(
+        near=near,
+        radius_km=radius_km or DEFAULT_RADIUS_KM,
+        cities=args.city or (),
+        min_stars=args.min_stars,
+        min_rooms=args.min_rooms,
+    )
+    chosen = [hotel_id for hotel_id in hotel_ids if hotel_id in selected]
+    print(
+        f"Selected {len(chosen)} of {len(hotel_ids)} hotels ({', '.join(filters)}) "
+        f"in {time.perf_counter() - started:.3f}s"
+    )
+    if not chosen:
+        raise ValueError("No hotels match the selection filters")
+    return chosen
+
+
+def pricing_reference_point(path: Path) -> tuple[float, float, float | None]:
+    """Read (lat, lon, radius_km) from a pricing batch's progress file."""
+    with path.open(encoding="utf-8") as handle:
+        params = json.load(handle).get("search_params") or {}
+    try:
+        lat, lon = float(params["reference_lat"]), float(params["reference_lon"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"{path} has no search_params reference_lat/reference_lon") from None
+    radius_m = params.get("reference_radius_m")
+    return lat, lon, float(radius_m) / 1000 if radius_m else None
+
+
 def call_booking_search(
     *,
     session: requests.Session,
@@ -101,25 +965,169 @@ def call_booking_search(
     token: str,
     payload: Mapping[str, Any],
     timeout: float,
-) -> Mapping[str, Any]:
+    scheduler: RequestScheduler | None = None,
+    token_manager: TokenManager | None = None,
+    cache: ResponseCache | None = None,
+    events: RunEvents | None = None,
+    stream_to: Callable[[Iterable[bytes]], tuple[Any, bool]] | None = None,
+) -> Any:
+    """POST one booking search with retries, token refresh and caching.
+
+    Returns the decoded JSON body. With `stream_to`, the body is never decoded here:
+    its chunks (from the network or a cached entry) are passed to stream_to, which
+    returns (result, cacheable), and the result is returned instead. The raw bytes
+    are cached as-is when cacheable.
+    """
+    started = time.perf_counter()
+    hotel_id = payload.get("hotel_id")
+
+    def report(status: int | str, size: int = 0, cached: bool = False) -> None:
+        if events:
+            events.request(
+                hotel_id=hotel_id,
+                status=status,
+                latency=time.perf_counter() - started,
+                size=size,
+                retries=attempt + replayed,
+                cached=cached,
+            )
+
+    attempt = 0
+    replayed = False
+    if cache and stream_to is not None:
+        handle = cache.open_raw(url, payload)
+        if handle is not None:
+            with handle:
+                result, _ = stream_to(iter(lambda: handle.read(STREAM_CHUNK_BYTES), b""))
+            report(200, cached=True)
+            return result
+    elif cache:
+        cached = cache.get(url, payload)
+        if cached is not None:
+            report(200, cached=True)
+            return cached
+    if token_manager:
+        token = token_manager.get()
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
     }
-    response = session.post(url, json=payload, headers=headers, timeout=timeout)
+    max_retries = scheduler.max_retries if scheduler else 0
+    while True:
+        if scheduler:
+            scheduler.acquire()
+        try:
+            response = session.post(
+                url, json=payload, headers=headers, timeout=timeout, stream=stream_to is not None
+            )
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            if attempt >= max_retries:
+                if scheduler:
+                    scheduler.record_failure()
+                report("error")
+                raise KuoniBookingsAPIError(f"Request failed for {hotel_id}: {exc}") from exc
+            attempt += 1
+            time.sleep(scheduler.backoff(attempt))
+            continue
+
+        status = response.status_code
+        if status == 401 and token_manager and not replayed:
+            fresh_token = token_manager.refresh(token)
+            if fresh_token:
+                token = fresh_token
+                headers["Authorization"] = f"Bearer {token}"
+                replayed = True
+                response.close()
+                continue
+        if scheduler and status in RETRYABLE_STATUS:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if status in THROTTLE_STATUS:
+                scheduler.on_throttle(retry_after)
+            if attempt < max_retries:
+                attempt += 1
+                response.close()
+                time.sleep(scheduler.backoff(attempt, retry_after))
+                continue
+        break
+
     try:
         response.raise_for_status()
     except requests.HTTPError as exc:
+        report(response.status_code, len(response.content))
+        if scheduler:
+            scheduler.record_failure()
         raise KuoniBookingsAPIError(
-            f"{response.status_code} error for {payload.get('hotel_id')}: {response.text}"
+            f"{response.status_code} error for {hotel_id}: {response.text}"
         ) from exc
+    if scheduler:
+        scheduler.on_success()
+    if stream_to is not None:
+        return _stream_response(
+            response,
+            stream_to,
+            hotel_id=hotel_id,
+            report=report,
+            cache=cache,
+            url=url,
+            payload=payload,
+        )
+    report(response.status_code, len(response.content))
     try:
-        return response.json()
+        data = response.json()
     except ValueError as exc:
         raise KuoniBookingsAPIError("Non-JSON response received") from exc
+    if cache and isinstance(data, Mapping) and data.get("success"):
+        cache.put(url, payload, data)
+    return data
 
 
-def fetch_auth_token(
+def _stream_response(
+    response: requests.Response,
+    stream_to: Callable[[Iterable[bytes]], tuple[Any, bool]],
+    *,
+    hotel_id: str | None,
+    report: Callable[[int | str, int], None],
+    cache: ResponseCache | None,
+    url: str,
+    payload: Mapping[str, Any],
+) -> Any:
+    """Feed a streamed response body to stream_to, teeing it into the cache."""
+    received = 0
+    tmp_path = None
+    entry: IO[bytes] | None = None
+    if cache:
+        try:
+            tmp_path = cache.reserve(url, payload)
+            entry = tmp_path.open("wb")
+        except OSError as exc:
+            print(f"[warn] Could not write cache entry: {exc}", file=sys.stderr)
+
+    def chunks() -> Iterator[bytes]:
+        nonlocal received
+        for chunk in response.iter_content(STREAM_CHUNK_BYTES):
+            received += len(chunk)
+            if entry:
+                entry.write(chunk)
+            yield chunk
+
+    cacheable = False
+    try:
+        with response:
+            result, cacheable = stream_to(chunks())
+    except (ValueError, requests.RequestException) as exc:
+        raise KuoniBookingsAPIError(f"Unreadable response for {hotel_id}: {exc}") from exc
+    finally:
+        report(response.status_code, received)
+        if entry:
+            entry.close()
+            if cacheable:
+                cache.commit(url, payload, tmp_path)
+            else:
+                tmp_path.unlink(missing_ok=True)
+    return result
+
+
+def request_auth_token(
     session: requests.Session,
     *,
     url: str,
@@ -128,7 +1136,8 @@ def fetch_auth_token(
     audience: str,
     grant_type: str = "client_credentials",
     timeout: float = 15.0,
-) -> str:
+) -> dict[str, Any]:
+    """Run the client credentials flow and return the raw token response."""
     payload = {
         "client_id": client_id,
         "client_secret": client_secret,
@@ -146,10 +1155,165 @@ def fetch_auth_token(
         data = response.json()
     except ValueError as exc:
         raise KuoniBookingsAPIError("Auth endpoint returned non-JSON") from exc
-    token = data.get("access_token")
-    if not token:
+    if not data.get("access_token"):
         raise KuoniBookingsAPIError("Auth response missing access_token")
-    return str(token)
+    return data
+
+
+def fetch_auth_token(
+    session: requests.Session,
+    *,
+    url: str,
+    client_id: str,
+    client_secret: str,
+    audience: str,
+    grant_type: str = "client_credentials",
+    timeout: float = 15.0,
+) -> str:
+    data = request_auth_token(
+        session,
+        url=url,
+        client_id=client_id,
+        client_secret=client_secret,
+        audience=audience,
+        grant_type=grant_type,
+        timeout=timeout,
+    )
+    return str(data["access_token"])
+
+
+class TokenManager:
+    """Hand out bearer tokens, caching client-credential tokens on disk until expiry.
+
+    A static token (from --token) is used as-is and cannot be refreshed. Tokens from
+    the client credentials flow are cached per client id and audience in a file only
+    readable by the current user, and refreshed once when a request gets a 401.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        *,
+        token: str | None = None,
+        url: str | None = None,
+        client_id: str | None = None,
+        client_secret: str | None = None,
+        audience: str | None = None,
+        grant_type: str = "client_credentials",
+        timeout: float = 15.0,
+        cache_path: Path | None = DEFAULT_TOKEN_CACHE,
+    ) -> None:
+        self.session = session
+        self.url = url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.audience = audience
+        self.grant_type = grant_type
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._token = token
+        self._expires_at: float | None = None
+        self.source = "static" if token else None
+
+    @property
+    def can_refresh(self) -> bool:
+        return bool(self.url and self.client_id and self.client_secret)
+
+    @property
+    def cache_key(self) -> str:
+        raw = f"{self.client_id}|{self.audience}|{self.url}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self) -> str:
+        with self._lock:
+            if self._token and not self._expiring():
+                return self._token
+            if not self.can_refresh:
+                if self._token:
+                    return self._token
+                raise KuoniBookingsAPIError("No bearer token or auth client credentials available")
+            cached = self._read_cache()
+            if cached:
+                self._token, self._expires_at = cached
+                self.source = "cache"
+                return self._token
+            return self._fetch()
+
+    def refresh(self, stale_token: str) -> str | None:
+        """Replace `stale_token` after a 401; returns None if no refresh is possible."""
+        if not self.can_refresh:
+            return None
+        with self._lock:
+            if self._token and self._token != stale_token:
+                # Another worker already refreshed it.
+                return self._token
+            return self._fetch()
+
+    def _expiring(self) -> bool:
+        return self._expires_at is not None and time.time() >= self._expires_at - TOKEN_EXPIRY_MARGIN
+
+    def _fetch(self) -> str:
+        data = request_auth_token(
+            self.session,
+            url=str(self.url),
+            client_id=str(self.client_id),
+            client_secret=str(self.client_secret),
+            audience=str(self.audience),
+            grant_type=self.grant_type,
+            timeout=self.timeout,
+        )
+        self._token = str(data["access_token"])
+        expires_in = _coerce_int(data.get("expires_in"))
+        self._expires_at = time.time() + expires_in if expires_in else None
+        self.source = "fetched"
+        self._write_cache()
+        return self._token
+
+    def _load_cache_file(self) -> dict[str, Any]:
+        if not self.cache_path:
+            return {}
+        try:
+            with self.cache_path.open(encoding="utf-8") as handle:
+                data = json.load(handle)
+        except (OSError, json.JSONDecodeError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _read_cache(self) -> tuple[str, float] | None:
+        entry = self._load_cache_file().get(self.cache_key)
+        if not isinstance(entry, Mapping):
+            return None
+        token = entry.get("access_token")
+        expires_at = entry.get("expires_at")
+        if not token or not isinstance(expires_at, (int, float)):
+            return None
+        if time.time() >= expires_at - TOKEN_EXPIRY_MARGIN:
+            return None
+        return str(token), float(expires_at)
+
+    def _write_cache(self) -> None:
+        # Tokens without an expiry are never cached: we could not tell when to drop them.
+        if not self.cache_path or self._expires_at is None:
+            return
+        data = self._load_cache_file()
+        now = time.time()
+        data = {
+            key: entry
+            for key, entry in data.items()
+            if isinstance(entry, Mapping) and entry.get("expires_at", 0) > now
+        }
+        data[self.cache_key] = {"access_token": self._token, "expires_at": self._expires_at}
+        try:
+            self.cache_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_name(self.cache_path.name + ".tmp")
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as handle:
+                json.dump(data, handle)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as exc:
+            print(f"[warn] Could not write token cache {self.cache_path}: {exc}", file=sys.stderr)
 
 
 def iter_payloads(
@@ -207,197 +1371,2999 @@ def extract_hotel_nightly_counts(response: Mapping[str, Any]) -> dict[str, int]:
     return nightly
 
 
-def apply_excel_formatting(path: Path) -> None:
-    """Insert padding rows and basic styling to match heatmap expectations."""
-    wb = load_workbook(path)
-    ws = wb.active
+class _ChunkReader(io.RawIOBase):
+    """Minimal readable file over an iterable of byte chunks, for ijson."""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._buffer:
+            self._buffer = next(self._chunks, b"")
+            if not self._buffer:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
 
-    # Insert spacer rows so headers land on row 5 (matches kuoni_generate_sheet layout)
-    ws.insert_rows(1, amount=3)
-    ws.cell(row=2, column=2).value = "Params"
-    ws.cell(row=2, column=3).value = "Bookings availability (rooms)"
+def _tee_chunks(chunks: Iterable[bytes], sink: IO[bytes]) -> Iterator[bytes]:
+    for chunk in chunks:
+        sink.write(chunk)
+        yield chunk
 
+
+def stream_nightly_counts(
+    chunks: Iterable[bytes], raw_path: Path | None = None
+) -> tuple[dict[str, int], bool]:
+    """Incremental extract_hotel_nightly_counts over a response body's byte chunks.
+
+    Only rates[].nightly and rates[].rooms[].nightly[] are kept, so memory stays flat
+    however many rates and rooms an --all-rates response carries. With raw_path the
+    bytes are also written there verbatim (via a .part file renamed on success).
+    Returns (nightly, success); raises ValueError when the body is not valid JSON.
+    """
+    ijson = _import_optional("ijson", "--stream-extract")
+    nightly: dict[str, int] = {}
+    success = False
+    # Room nights dominate the event stream, so they are matched on exact prefixes.
+    room_date = ROOM_NIGHT_PREFIX + ".date"
+    room_count = ROOM_NIGHT_PREFIX + ".rooms"
+    date: str | None = None
+    count: Any = None
+
+    def update(night: str | None, value: Any) -> None:
+        rooms = _coerce_int(value)
+        if not night or rooms is None:
+            return
+        current = nightly.get(night)
+        nightly[night] = rooms if current is None or rooms > current else current
+
+    part_path = raw_path.with_name(raw_path.name + ".part") if raw_path else None
+    with contextlib.ExitStack() as stack:
+        if part_path:
+            part_path.parent.mkdir(parents=True, exist_ok=True)
+            raw = stack.enter_context(part_path.open("wb"))
+            chunks = _tee_chunks(chunks, raw)
+        try:
+            for prefix, event, value in ijson.parse(_ChunkReader(chunks)):
+                if prefix == room_date:
+                    date = value
+                elif prefix == room_count:
+                    count = value
+                elif prefix == ROOM_NIGHT_PREFIX:
+                    if event == "end_map":
+                        update(date, count)
+                        date = count = None
+                elif prefix.startswith(RATE_NIGHTLY_PREFIX):
+                    date_key = prefix[len(RATE_NIGHTLY_PREFIX):]
+                    if "." not in date_key and event in ("number", "string"):
+                        update(date_key, value)
+                elif prefix == "success":
+                    success = bool(value)
+        except BaseException as exc:
+            stack.close()
+            if part_path:
+                part_path.unlink(missing_ok=True)
+            if isinstance(exc, ijson.JSONError):
+                raise ValueError(f"Invalid JSON response: {exc}") from exc
+            raise
+    if part_path:
+        os.replace(part_path, raw_path)
+    return (nightly if success else {}), success
+
+
+def merge_nightly_counts(target: dict[str, int], nightly: Mapping[str, int]) -> dict[str, int]:
+    """Fold `nightly` into `target`, keeping the max per date like the extractor does."""
+    for date_key, count in nightly.items():
+        current = target.get(date_key)
+        target[date_key] = count if current is None else max(current, count)
+    return target
+
+
+EXCEL_HEADER_ROW = 5  # matches the kuoni_generate_sheet layout
+
+
+def _register_excel_styles(wb: Workbook) -> dict[tuple[bool, bool], str]:
+    """Add the four shared named styles, keyed by (is_header, is_id_column)."""
     black_fill = PatternFill(fill_type="solid", fgColor="000000")
     grey_fill = PatternFill(fill_type="solid", fgColor="444444")
     white_font = Font(color="FFFFFF")
     orange_font = Font(color="FFA500")
+    names: dict[tuple[bool, bool], str] = {}
+    for is_header, fill in ((False, black_fill), (True, grey_fill)):
+        for is_id, font in ((True, orange_font), (False, white_font)):
+            name = f"roomberg_{'header' if is_header else 'body'}_{'id' if is_id else 'value'}"
+            wb.add_named_style(NamedStyle(name=name, fill=fill, font=font))
+            names[(is_header, is_id)] = name
+    return names
 
-    max_row = ws.max_row
-    max_col = ws.max_column
 
-    for row in ws.iter_rows(min_row=1, max_row=max_row, min_col=1, max_col=max_col):
-        for col_idx, cell in enumerate(row, start=1):
-            cell.fill = black_fill
-            cell.font = orange_font if col_idx <= 2 else white_font
+class AvailabilityGrid:
+    """Hotel x date room counts held as a dense int16 matrix plus a missing-value mask.
 
-    header_row_idx = 5
-    if header_row_idx <= max_row:
-        for col_idx, cell in enumerate(ws[header_row_idx], start=1):
-            cell.fill = grey_fill
-            cell.font = orange_font if col_idx <= 2 else white_font
+    Hotels and dates are sorted, matching the row and column order of the CSV.
+    """
 
-    wb.save(path)
+    def __init__(
+        self,
+        hotel_ids: list[str],
+        dates: list[str],
+        counts: np.ndarray,
+        missing: np.ndarray,
+    ) -> None:
+        self.hotel_ids = hotel_ids
+        self.dates = dates
+        self.counts = counts
+        self.missing = missing
 
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.hotel_ids), len(self.dates)
 
-def build_availability_rows(
-    hotel_map: Mapping[str, Mapping[str, int]]
-) -> tuple[list[str], list[dict[str, object]]]:
+    def available(self) -> np.ndarray:
+        """Boolean matrix of nights with at least one room."""
+        return (self.counts > 0) & ~self.missing
+
+    def coverage(self) -> list[float]:
+        """Per-hotel share of dates with at least 1 room available, rounded to 4 places."""
+        total_nights = len(self.dates)
+        if not total_nights:
+            return [0.0] * len(self.hotel_ids)
+        available_nights = self.available().sum(axis=1)
+        # Python's round() on the scalar keeps the CSV byte-identical to the old rows.
+        return [round(int(nights) / total_nights, 4) for nights in available_nights]
+
+    def cell_strings(self) -> np.ndarray:
+        """Counts as strings with "" for missing cells, as written to the CSV."""
+        cells = self.counts.astype(str).astype(object)
+        cells[self.missing] = ""
+        return cells
+
+
+def build_availability_grid(hotel_map: Mapping[str, Mapping[str, int]]) -> AvailabilityGrid:
     all_dates: set[str] = set()
     for nightly in hotel_map.values():
         all_dates.update(nightly.keys())
 
-    sorted_dates = sorted(all_dates)
+    hotel_ids = sorted(hotel_map.keys())
+    dates = sorted(all_dates)
+    date_index = {date_key: column for column, date_key in enumerate(dates)}
+    counts = np.zeros((len(hotel_ids), len(dates)), dtype=np.int16)
+    missing = np.ones((len(hotel_ids), len(dates)), dtype=bool)
+    int16_max = np.iinfo(np.int16).max
+    for row, hotel_id in enumerate(hotel_ids):
+        nightly = hotel_map[hotel_id]
+        if not nightly:
+            continue
+        columns = np.fromiter((date_index[d] for d in nightly), dtype=np.intp, count=len(nightly))
+        values = np.fromiter(
+            (_coerce_int(v) or 0 for v in nightly.values()), dtype=np.int64, count=len(nightly)
+        )
+        counts[row, columns] = np.clip(values, -int16_max, int16_max)
+        missing[row, columns] = False
+    return AvailabilityGrid(hotel_ids, dates, counts, missing)
+
+
+def build_availability_rows(
+    hotel_map: Mapping[str, Mapping[str, int]]
+) -> tuple[list[str], list[dict[str, object]]]:
+    """Row-dict view of the grid, kept for callers that want plain Python rows."""
+    grid = build_availability_grid(hotel_map)
     rows: list[dict[str, object]] = []
-    for hotel_id in sorted(hotel_map.keys()):
+    for hotel_id, coverage in zip(grid.hotel_ids, grid.coverage()):
+        row: dict[str, object] = {"hotel_id": hotel_id, "coverage": coverage}
         nightly = hotel_map[hotel_id]
-        # Coverage = % of dates with at least 1 room available
-        available_nights = 0
-        total_nights = len(sorted_dates)
-        for date in sorted_dates:
-            count = _coerce_int(nightly.get(date))
-            if count and count > 0:
-                available_nights += 1
-        coverage = round(available_nights / total_nights, 4) if total_nights else 0.0
-        row: dict[str, object] = {"hotel_id": hotel_id}
-        row["coverage"] = coverage
-        row.update({date: nightly.get(date, "") for date in sorted_dates})
+        row.update({date_key: nightly.get(date_key, "") for date_key in grid.dates})
         rows.append(row)
-    return sorted_dates, rows
+    return grid.dates, rows
+
+
+def parse_stay_profile(value: str) -> tuple[int, ...]:
+    """Parse a --feasibility profile: ROOMSxNIGHTS (10x3) or rooms per night (10,10,8)."""
+    try:
+        if "x" in value:
+            rooms, nights = (int(part) for part in value.lower().split("x"))
+            profile = (rooms,) * nights
+        else:
+            profile = tuple(int(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected ROOMSxNIGHTS (e.g. 10x3) or rooms per night (e.g. 10,10,8), got '{value}'"
+        ) from None
+    if any(rooms < 0 for rooms in profile) or not any(profile):
+        raise argparse.ArgumentTypeError(f"profile '{value}' needs at least one night with rooms")
+    return profile
+
+
+def stay_profile(config: Sequence[Mapping[str, Any]]) -> tuple[int, ...]:
+    """Turn --stay DATE:ROOMS entries into a profile relative to the first stay date.
+
+    Nights between the stay dates need no rooms; repeated dates keep the largest need.
+    """
+    nights = {date.fromisoformat(stay["date"]).toordinal(): int(stay["rooms"]) for stay in config}
+    first = min(nights)
+    profile = [0] * (max(nights) - first + 1)
+    for ordinal, rooms in nights.items():
+        offset = ordinal - first
+        profile[offset] = max(profile[offset], rooms)
+    if not any(profile):
+        raise ValueError("--stay entries need at least one night with rooms for feasibility")
+    return tuple(profile)
+
+
+def stay_profile_label(profile: Sequence[int]) -> str:
+    if len(set(profile)) == 1:
+        return f"{profile[0]}x{len(profile)}"
+    return ",".join(str(rooms) for rooms in profile)
+
+
+def sliding_min(values: np.ndarray, window: int) -> np.ndarray:
+    """Row-wise minimum over every run of `window` consecutive columns.
+
+    Uses the van Herk/Gil-Werman block trick (prefix and suffix minima within blocks of
+    `window` columns), so the cost is linear in the matrix size whatever the window.
+    Returns shape (rows, columns - window + 1).
+    """
+    rows, columns = values.shape
+    count = columns - window + 1
+    if count <= 0:
+        return np.empty((rows, 0), dtype=values.dtype)
+    if window == 1:
+        return values
+    blocks = -(-columns // window)
+    padded = np.full((rows, blocks * window), np.iinfo(values.dtype).max, dtype=values.dtype)
+    padded[:, :columns] = values
+    shaped = padded.reshape(rows, blocks, window)
+    prefix = np.minimum.accumulate(shaped, axis=2).reshape(rows, -1)
+    suffix = np.minimum.accumulate(shaped[:, :, ::-1], axis=2)[:, :, ::-1].reshape(rows, -1)
+    return np.minimum(suffix[:, :count], prefix[:, window - 1 : window - 1 + count])
+
+
+def calendar_counts(grid: AvailabilityGrid) -> tuple[list[str], np.ndarray]:
+    """Grid counts on a gap-free day axis; missing and unfetched nights hold int16 min.
+
+    Feasibility windows must span consecutive calendar nights, which grid.dates (only
+    the dates some hotel reported) does not guarantee.
+    """
+    try:
+        ordinals = np.array([date.fromisoformat(d).toordinal() for d in grid.dates], dtype=np.int64)
+    except ValueError as exc:
+        raise ValueError(f"Feasibility needs ISO dates in the grid: {exc}") from None
+    if not len(ordinals):
+        return [], np.empty((len(grid.hotel_ids), 0), dtype=np.int16)
+    first = int(ordinals.min())
+    days = int(ordinals.max()) - first + 1
+    unknown = np.iinfo(np.int16).min
+    values = np.full((len(grid.hotel_ids), days), unknown, dtype=np.int16)
+    values[:, ordinals - first] = np.where(grid.missing, unknown, grid.counts)
+    dates = [date.fromordinal(first + offset).isoformat() for offset in range(days)]
+    return dates, values
+
+
+def stay_feasibility(
+    grid: AvailabilityGrid, profiles: Sequence[Sequence[int]]
+) -> tuple[list[str], list[np.ndarray]]:
+    """Which hotels can host each profile, per check-in date.
+
+    Returns the calendar dates and, per profile, a boolean (hotels x dates) matrix that
+    is True where every night of the stay starting that date has the rooms it needs.
+    Check-ins whose stay runs past the last date are False. Each profile is split into
+    runs of nights needing the same rooms; a run is met when the sliding minimum over
+    its length reaches the rooms, and minima are shared between profiles.
+    """
+    dates, values = calendar_counts(grid)
+    minima: dict[int, np.ndarray] = {}
+    results: list[np.ndarray] = []
+    for profile in profiles:
+        starts = len(dates) - len(profile) + 1
+        feasible = np.zeros((len(grid.hotel_ids), len(dates)), dtype=bool)
+        if starts > 0:
+            met = np.ones((len(grid.hotel_ids), starts), dtype=bool)
+            offset = 0
+            while offset < len(profile):
+                rooms = profile[offset]
+                length = 1
+                while offset + length < len(profile) and profile[offset + length] == rooms:
+                    length += 1
+                if rooms > 0:
+                    if length not in minima:
+                        minima[length] = sliding_min(values, length)
+                    met &= minima[length][:, offset : offset + starts] >= rooms
+                offset += length
+            feasible[:, :starts] = met
+        results.append(feasible)
+    return dates, results
 
 
-def write_csv(rows: list[dict[str, object]], dates: list[str], path: Path) -> None:
+def write_feasibility_csv(
+    grid: AvailabilityGrid, profiles: Sequence[Sequence[int]], path: Path
+) -> None:
+    """One row per hotel and profile: feasible check-in count, then 1/0 per check-in date.
+
+    Check-ins whose stay would run past the last fetched date are left blank.
+    """
+    dates, results = stay_feasibility(grid, profiles)
+    labels = [stay_profile_label(profile) for profile in profiles]
     path.parent.mkdir(parents=True, exist_ok=True)
     with path.open("w", newline="", encoding="utf-8") as handle:
-        writer = csv.DictWriter(handle, fieldnames=["hotel_id", "coverage", *dates])
-        writer.writeheader()
-        writer.writerows(rows)
-    print(f"Wrote {len(rows)} hotels to {path}")
+        writer = csv.writer(handle)
+        writer.writerow(["hotel_id", "profile", "feasible_windows", *dates])
+        cells = []
+        for profile, feasible in zip(profiles, results):
+            profile_cells = np.where(feasible, "1", "0").astype(object)
+            profile_cells[:, max(0, len(dates) - len(profile) + 1) :] = ""
+            cells.append(profile_cells)
+        windows = [feasible.sum(axis=1) for feasible in results]
+        for row, hotel_id in enumerate(grid.hotel_ids):
+            for label, profile_cells, profile_windows in zip(labels, cells, windows):
+                writer.writerow([hotel_id, label, int(profile_windows[row]), *profile_cells[row]])
+    for label, profile_windows in zip(labels, windows):
+        print(
+            f"Feasibility {label}: {int((profile_windows > 0).sum())} of "
+            f"{len(grid.hotel_ids)} hotels have a window ({int(profile_windows.sum())} windows)"
+        )
+    print(f"Wrote {len(profiles)} stay profile(s) for {len(grid.hotel_ids)} hotels to {path}")
+
+
+def write_csv(grid: AvailabilityGrid, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", newline="", encoding="utf-8") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["hotel_id", "coverage", *grid.dates])
+        cells = grid.cell_strings()
+        for hotel_id, coverage, row_cells in zip(grid.hotel_ids, grid.coverage(), cells):
+            writer.writerow([hotel_id, coverage, *row_cells])
+    print(f"Wrote {len(grid.hotel_ids)} hotels to {path}")
+
+
+def write_excel(grid: AvailabilityGrid, path: Path) -> None:
+    """Stream the grid into a write-only workbook in a single pass.
+
+    Rows 1-4 are spacers with a "Params" banner on row 2, the header sits on row
+    EXCEL_HEADER_ROW in grey, and every cell uses one of four shared named styles
+    (orange text for hotel_id/coverage, white for dates) so memory stays flat.
+    """
+    wb = Workbook(write_only=True)
+    styles = _register_excel_styles(wb)
+    ws = wb.create_sheet("Sheet1")
+    width = 2 + len(grid.dates)
 
+    def styled_row(values: Sequence[object], is_header: bool = False) -> list[WriteOnlyCell]:
+        cells = []
+        for col_idx, value in enumerate(values, start=1):
+            cell = WriteOnlyCell(ws, value=value)
+            cell.style = styles[(is_header, col_idx <= 2)]
+            cells.append(cell)
+        return cells
+
+    for row_idx in range(1, EXCEL_HEADER_ROW):
+        values: list[object] = [None] * max(width, 3)
+        if row_idx == 2:
+            values[1] = "Params"
+            values[2] = "Bookings availability (rooms)"
+        ws.append(styled_row(values))
+    ws.append(styled_row(["hotel_id", "coverage", *grid.dates], is_header=True))
+
+    for hotel_id, coverage, counts, missing in zip(
+        grid.hotel_ids, grid.coverage(), grid.counts.tolist(), grid.missing.tolist()
+    ):
+        cells = [None if gap else count for count, gap in zip(counts, missing)]
+        ws.append(styled_row([hotel_id, coverage, *cells]))
 
-def write_excel(rows: list[dict[str, object]], path: Path) -> None:
-    df = pd.DataFrame(rows)
     path.parent.mkdir(parents=True, exist_ok=True)
-    df.to_excel(path, index=False)
-    apply_excel_formatting(path)
+    wb.save(path)
     print(f"Wrote Excel grid to {path}")
 
 
-def write_png(rows: list[dict[str, object]], size: tuple[int, int], path: Path) -> None:
-    grid_df = pd.DataFrame(rows)
-    drop_cols = [col for col in ("hotel_id", "coverage") if col in grid_df.columns]
-    if drop_cols:
-        grid_df = grid_df.drop(columns=drop_cols)
-    num_df = grid_df.apply(pd.to_numeric, errors="coerce").fillna(0)
-    if num_df.empty or num_df.shape[1] == 0:
+BINARY_COLORS = np.array([[127, 0, 0], [0, 176, 80]], dtype=np.uint8)  # dark red, green
+MISSING_COLOR = (64, 64, 64)
+
+
+def _graded_lut(rooms_required: int) -> np.ndarray:
+    """Colours for 0..rooms_required rooms plus a final entry for missing nights.
+
+    0 rooms is dark red, partial availability ramps from red to amber, and meeting
+    the requirement is green.
+    """
+    rooms_required = max(1, rooms_required)
+    lut = np.zeros((rooms_required + 2, 3), dtype=np.uint8)
+    lut[0] = BINARY_COLORS[0]
+    if rooms_required > 1:
+        ramp = np.linspace(0.0, 1.0, rooms_required - 1)[:, None]
+        start = np.array([200, 40, 40], dtype=np.float64)
+        end = np.array([255, 192, 0], dtype=np.float64)
+        lut[1:rooms_required] = np.round(start + (end - start) * ramp).astype(np.uint8)
+    lut[rooms_required] = BINARY_COLORS[1]
+    lut[rooms_required + 1] = MISSING_COLOR
+    return lut
+
+
+def colorize_counts(
+    counts: np.ndarray,
+    missing: np.ndarray,
+    *,
+    mode: str = "binary",
+    rooms_required: int = DEFAULT_ROOMS_REQUIRED,
+) -> np.ndarray:
+    """Map a (hotels, dates) block of room counts to an RGB uint8 image array."""
+    if mode == "binary":
+        return BINARY_COLORS[((counts > 0) & ~missing).astype(np.uint8)]
+    if mode != "graded":
+        raise ValueError(f"Unknown PNG mode '{mode}'; use one of {PNG_MODES}")
+    rooms_required = max(1, rooms_required)
+    lut = _graded_lut(rooms_required)
+    index = np.clip(counts, 0, rooms_required).astype(np.intp)
+    index[missing] = rooms_required + 1
+    return lut[index]
+
+
+def _scale_cells(rgb: np.ndarray, cell: tuple[int, int]) -> np.ndarray:
+    cell_width, cell_height = cell
+    return np.repeat(np.repeat(rgb, cell_height, axis=0), cell_width, axis=1)
+
+
+def write_png(
+    grid: AvailabilityGrid,
+    size: tuple[int, int],
+    path: Path,
+    *,
+    mode: str = "binary",
+    rooms_required: int = DEFAULT_ROOMS_REQUIRED,
+    cell: tuple[int, int] | None = None,
+) -> None:
+    """Render the grid as one image: resized to `size`, or `cell` pixels per grid cell."""
+    if 0 in grid.shape:
         print("No data to render for PNG; skipping.")
         return
 
-    avail = (num_df > 0).astype(np.uint8).to_numpy()
-    colors = np.array([[127, 0, 0], [0, 176, 80]], dtype=np.uint8)  # dark red, green
-    rgb = colors[avail]
-    img = Image.fromarray(rgb, mode="RGB")
-    width, height = size
-    img = img.resize((width, height), resample=Image.NEAREST)
+    rgb = colorize_counts(grid.counts, grid.missing, mode=mode, rooms_required=rooms_required)
+    if cell:
+        img = Image.fromarray(_scale_cells(rgb, cell), mode="RGB")
+    else:
+        img = Image.fromarray(rgb, mode="RGB")
+        width, height = size
+        img = img.resize((width, height), resample=Image.NEAREST)
     path.parent.mkdir(parents=True, exist_ok=True)
     img.save(path)
     print(f"Wrote PNG heatmap to {path}")
 
 
-def read_jsonl(path: Path) -> Iterable[dict[str, Any]]:
-    with path.open() as handle:
-        for line in handle:
-            line = line.strip()
-            if not line:
-                continue
+def write_png_tiles(
+    grid: AvailabilityGrid,
+    directory: Path,
+    *,
+    mode: str = "binary",
+    rooms_required: int = DEFAULT_ROOMS_REQUIRED,
+    cell: tuple[int, int] = (1, 1),
+    tile_size: int = DEFAULT_TILE_SIZE,
+) -> None:
+    """Write a tile pyramid of the heatmap to directory/{level}/{x}_{y}.png.
+
+    The deepest level is rendered tile by tile straight from grid slices; each
+    coarser level is built by halving 2x2 blocks of child tiles read back from disk,
+    so memory stays at a few tiles however large the grid is. Level 0 fits in a
+    single tile. A tiles.json manifest describes the pyramid; tiles left over from
+    an earlier, larger pyramid in the same directory are removed.
+    """
+    if 0 in grid.shape:
+        print("No data to render for PNG tiles; skipping.")
+        return
+    cell_width, cell_height = cell
+    full_width = len(grid.dates) * cell_width
+    full_height = len(grid.hotel_ids) * cell_height
+    max_level = max(0, math.ceil(math.log2(max(full_width, full_height) / tile_size)))
+
+    def level_size(level: int) -> tuple[int, int]:
+        factor = 2 ** (max_level - level)
+        return math.ceil(full_width / factor), math.ceil(full_height / factor)
+
+    def tile_path(level: int, tx: int, ty: int) -> Path:
+        return directory / str(level) / f"{tx}_{ty}.png"
+
+    written: set[Path] = set()
+    for level in range(max_level, -1, -1):
+        width, height = level_size(level)
+        (directory / str(level)).mkdir(parents=True, exist_ok=True)
+        for ty in range(math.ceil(height / tile_size)):
+            for tx in range(math.ceil(width / tile_size)):
+                x0, y0 = tx * tile_size, ty * tile_size
+                x1, y1 = min(x0 + tile_size, width), min(y0 + tile_size, height)
+                if level == max_level:
+                    col0, col1 = x0 // cell_width, math.ceil(x1 / cell_width)
+                    row0, row1 = y0 // cell_height, math.ceil(y1 / cell_height)
+                    block = colorize_counts(
+                        grid.counts[row0:row1, col0:col1],
+                        grid.missing[row0:row1, col0:col1],
+                        mode=mode,
+                        rooms_required=rooms_required,
+                    )
+                    block = _scale_cells(block, cell)
+                    ox, oy = x0 - col0 * cell_width, y0 - row0 * cell_height
+                    tile = Image.fromarray(block[oy : oy + y1 - y0, ox : ox + x1 - x0], mode="RGB")
+                else:
+                    # Size the canvas to the children that exist so partial edge
+                    # tiles are not averaged with padding.
+                    child_width, child_height = level_size(level + 1)
+                    canvas = Image.new(
+                        "RGB",
+                        (
+                            min(tile_size * 2, child_width - x0 * 2),
+                            min(tile_size * 2, child_height - y0 * 2),
+                        ),
+                        MISSING_COLOR,
+                    )
+                    for dy in (0, 1):
+                        for dx in (0, 1):
+                            child = tile_path(level + 1, tx * 2 + dx, ty * 2 + dy)
+                            if child.exists():
+                                with Image.open(child) as child_img:
+                                    canvas.paste(child_img, (dx * tile_size, dy * tile_size))
+                    tile = canvas.reduce(2).crop((0, 0, x1 - x0, y1 - y0))
+                path = tile_path(level, tx, ty)
+                tile.save(path)
+                written.add(path)
+
+    manifest = {
+        "version": 1,
+        "tile_size": tile_size,
+        "max_level": max_level,
+        "cell": [cell_width, cell_height],
+        "width": full_width,
+        "height": full_height,
+        "levels": {str(level): list(level_size(level)) for level in range(max_level + 1)},
+        "mode": mode,
+        "rooms_required": rooms_required,
+        "hotel_ids": grid.hotel_ids,
+        "dates": grid.dates,
+    }
+    with (directory / "tiles.json").open("w", encoding="utf-8") as handle:
+        json.dump(manifest, handle)
+
+    stale = 0
+    for level_dir in directory.iterdir():
+        if not (level_dir.is_dir() and level_dir.name.isdigit()):
+            continue
+        for path in level_dir.glob("*_*.png"):
+            if path not in written:
+                path.unlink()
+                stale += 1
+        if int(level_dir.name) > max_level and not any(level_dir.iterdir()):
+            level_dir.rmdir()
+    stale_note = f"; removed {stale} stale tiles" if stale else ""
+    print(
+        f"Wrote {len(written)} PNG tiles across {max_level + 1} levels to {directory}{stale_note}"
+    )
+
+
+def is_compressed(path: Path) -> bool:
+    return path.suffix.lower() in COMPRESSED_SUFFIXES
+
+
+def _import_optional(module: str, purpose: str, package: str | None = None) -> Any:
+    """Import an optional dependency, explaining what needs it when it is missing."""
+    try:
+        return importlib.import_module(module)
+    except ImportError as exc:
+        package = package or module
+        raise RuntimeError(
+            f"{purpose} needs the optional '{package}' package (pip install {package})"
+        ) from exc
+
+
+def open_jsonl(path: Path, mode: str = "r") -> IO[str]:
+    """Open a JSONL file for text I/O, compressing by extension (.gz, .zst/.zstd).
+
+    Appending to a compressed file adds a new gzip member or zstd frame, which the
+    readers below decode transparently.
+    """
+    suffix = path.suffix.lower()
+    if suffix == ".gz":
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if suffix in (".zst", ".zstd"):
+        zstandard = _import_optional("zstandard", "Reading or writing .zst JSONL")
+        raw = path.open(mode + "b")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        else:
+            stream = zstandard.ZstdCompressor(level=3).stream_writer(raw)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return path.open(mode, encoding="utf-8")
+
+
+def _gunzip_chunks(handle: IO[bytes]) -> Iterator[bytes]:
+    """Decompress concatenated gzip members, yielding output as soon as it is decoded.
+
+    Raises EOFError when the last member is cut off, after yielding everything
+    before the cut (gzip.GzipFile drops the output of the read that hits it).
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    in_member = False
+    while data := handle.read(STREAM_CHUNK_BYTES):
+        while data:
+            in_member = True
+            output = decompressor.decompress(data)
+            if output:
+                yield output
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            in_member = False
+    if in_member:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def jsonl_chunks(path: Path) -> Iterator[bytes]:
+    """Decompressed bytes of a JSONL file (by extension), in chunks."""
+    suffix = path.suffix.lower()
+    with path.open("rb") as raw:
+        if suffix == ".gz":
+            yield from _gunzip_chunks(raw)
+            return
+        if suffix in (".zst", ".zstd"):
+            zstandard = _import_optional("zstandard", "Reading .zst JSONL")
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+            yield from iter(lambda: stream.read(STREAM_CHUNK_BYTES), b"")
+            return
+        yield from iter(lambda: raw.read(STREAM_CHUNK_BYTES), b"")
+
+
+def _zstd_errors() -> tuple[type[Exception], ...]:
+    try:
+        import zstandard
+    except ImportError:
+        return ()
+    return (zstandard.ZstdError,)
+
+
+def write_parquet(grid: AvailabilityGrid, path: Path, layout: str = "long") -> None:
+    """Write the grid as Parquet with int16 rooms, date32 dates and dictionary hotel ids.
+
+    The long layout has one row per known (hotel_id, date) cell plus the hotel's
+    coverage; the wide layout mirrors the CSV with one nullable column per date.
+    """
+    pa = _import_optional("pyarrow", "Parquet output")
+    pq = _import_optional("pyarrow.parquet", "Parquet output", package="pyarrow")
+    hotel_dictionary = pa.array(grid.hotel_ids, type=pa.string())
+    coverage = np.asarray(grid.coverage(), dtype=np.float64)
+
+    if layout == "long":
+        rows, columns = np.nonzero(~grid.missing)
+        dates = np.asarray(grid.dates, dtype="datetime64[D]")
+        table = pa.table(
+            {
+                "hotel_id": pa.DictionaryArray.from_arrays(
+                    pa.array(rows.astype(np.int32)), hotel_dictionary
+                ),
+                "date": pa.array(dates[columns], type=pa.date32()),
+                "rooms": pa.array(grid.counts[rows, columns], type=pa.int16()),
+                "coverage": pa.array(coverage[rows], type=pa.float64()),
+            }
+        )
+    elif layout == "wide":
+        columns_data: dict[str, Any] = {
+            "hotel_id": pa.DictionaryArray.from_arrays(
+                pa.array(np.arange(len(grid.hotel_ids), dtype=np.int32)), hotel_dictionary
+            ),
+            "coverage": pa.array(coverage, type=pa.float64()),
+        }
+        for column, date_key in enumerate(grid.dates):
+            columns_data[date_key] = pa.array(
+                grid.counts[:, column], type=pa.int16(), mask=grid.missing[:, column]
+            )
+        table = pa.table(columns_data)
+    else:
+        raise ValueError(f"Unknown Parquet layout '{layout}'; use one of {PARQUET_LAYOUTS}")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, path, compression="zstd")
+    print(f"Wrote {layout} Parquet grid ({table.num_rows} rows) to {path}")
+
+
+def read_hotel_lookup(csv_path: Path, column: str | None) -> dict[str, tuple[str, str]]:
+    """Map hotel id -> (city, hmid) from the hotel summary CSV, like the web views join."""
+    lookup: dict[str, tuple[str, str]] = {}
+    with csv_path.open(newline="", encoding="utf-8-sig") as handle:
+        reader = csv.DictReader(handle)
+        target_column = column or (reader.fieldnames or [""])[0]
+        for row in reader:
+            hotel_id = str(row.get(target_column) or "").strip()
+            if hotel_id:
+                lookup[hotel_id] = (row.get("city") or "", str(row.get("hmid") or "").strip())
+    return lookup
+
+
+def _publish_file(directory: Path, stem: str, suffix: str, data: bytes) -> dict[str, Any]:
+    """Write content-addressed `stem.<hash>suffix` atomically; returns its manifest entry."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = directory / f"{stem}.{digest[:12]}{suffix}"
+    if not path.exists():
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    return {"name": path.name, "bytes": len(data), "sha256": digest}
+
+
+def write_heatmap_payload(
+    grid: AvailabilityGrid,
+    directory: Path,
+    *,
+    hotel_summary: Path | None = None,
+    hotel_column: str | None = DEFAULT_HOTEL_COLUMN,
+    source: str | None = None,
+    csv_path: Path | None = None,
+) -> Path:
+    """Write the precomputed payload the availability heatmap serves instead of the CSV.
+
+    `directory` gets a little-endian int16 hotels x days grid on a gap-free calendar
+    (int16 min marks unknown nights) that loads straight into an Int16Array, a
+    minified JSON of hotel/city lookups, per-city rollups and grid stats, and last a
+    manifest.json naming both by content hash. Swapping the manifest publishes a
+    batch atomically; files it no longer names are removed afterwards.
+
+    The manifest also fingerprints `csv_path`, the availability CSV written from the
+    same grid, so the web view ignores the payload once a later run rewrites the CSV.
+    """
+    lookup: dict[str, tuple[str, str]] = {}
+    if hotel_summary:
+        try:
+            lookup = read_hotel_lookup(hotel_summary, hotel_column)
+        except OSError as exc:
+            print(f"[warn] No city/hmid lookup for the heatmap payload: {exc}", file=sys.stderr)
+    dates, values = calendar_counts(grid)
+    missing_value = int(np.iinfo(np.int16).min)
+
+    cities = sorted({lookup[h][0] for h in grid.hotel_ids if h in lookup and lookup[h][0]})
+    city_index = {city: number for number, city in enumerate(cities)}
+    hotel_city = np.array(
+        [city_index.get(lookup.get(h, ("", ""))[0], -1) for h in grid.hotel_ids], dtype=np.int64
+    )
+    coverage = np.asarray(grid.coverage(), dtype=np.float64)
+    known = ~grid.missing
+    available = grid.available()
+    known_per_hotel = known.sum(axis=1)
+    available_per_hotel = available.sum(axis=1)
+    total_cells = grid.missing.size
+
+    def rollup(weights: np.ndarray) -> np.ndarray:
+        located = hotel_city >= 0
+        return np.bincount(hotel_city[located], weights=weights[located], minlength=len(cities))
+
+    city_hotels = rollup(np.ones(len(grid.hotel_ids)))
+    city_cells = city_hotels * len(grid.dates)
+
+    def ratio(numerator: np.ndarray, denominator: np.ndarray) -> list[float]:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = np.where(denominator > 0, numerator / denominator, 0.0)
+        return [round(float(value), 4) for value in result]
+
+    known_counts = grid.counts[known]
+    payload = {
+        "version": HEATMAP_PAYLOAD_VERSION,
+        "source": source,
+        "start_date": dates[0] if dates else None,
+        "days": len(dates),
+        "hotels": {
+            "ids": grid.hotel_ids,
+            "hmid": [lookup.get(h, ("", ""))[1] for h in grid.hotel_ids],
+            "city": hotel_city.tolist(),
+            "coverage": coverage.tolist(),
+        },
+        "cities": {
+            "names": cities,
+            "hotels": city_hotels.astype(int).tolist(),
+            "coverage_mean": ratio(rollup(coverage), city_hotels),
+            "available_ratio": ratio(rollup(available_per_hotel.astype(float)), city_cells),
+            "missing_ratio": ratio(
+                city_cells - rollup(known_per_hotel.astype(float)), city_cells
+            ),
+        },
+        "stats": {
+            "hotels": len(grid.hotel_ids),
+            "dates": len(grid.dates),
+            "avg_rooms": round(float(known_counts.mean()), 4) if known_counts.size else 0.0,
+            "max_rooms": int(known_counts.max()) if known_counts.size else 0,
+            "available_ratio": ratio(np.array([available.sum()]), np.array([total_cells]))[0],
+            "missing_ratio": ratio(np.array([grid.missing.sum()]), np.array([total_cells]))[0],
+        },
+    }
+
+    directory.mkdir(parents=True, exist_ok=True)
+    grid_entry = _publish_file(directory, "grid", ".i16", values.astype("<i2").tobytes())
+    payload_entry = _publish_file(
+        directory,
+        "payload",
+        ".json",
+        json.dumps(payload, separators=(",", ":")).encode("utf-8"),
+    )
+    manifest = {
+        "format": "roomberg-heatmap",
+        "version": HEATMAP_PAYLOAD_VERSION,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "source": source,
+        "shape": [len(grid.hotel_ids), len(dates)],
+        "start_date": payload["start_date"],
+        "grid": {**grid_entry, "dtype": "int16", "byte_order": "little", "missing": missing_value},
+        "payload": payload_entry,
+        "csv": None,
+    }
+    if csv_path and csv_path.exists():
+        stat = csv_path.stat()
+        manifest["csv"] = {
+            "name": csv_path.name,
+            "bytes": stat.st_size,
+            # A string: nanosecond timestamps do not survive JSON numbers in JavaScript.
+            "mtime_ns": str(stat.st_mtime_ns),
+            "sha256": hashlib.sha256(csv_path.read_bytes()).hexdigest(),
+        }
+    manifest_path = directory / "manifest.json"
+    write_progress(manifest_path, manifest)
+    keep = {grid_entry["name"], payload_entry["name"], manifest_path.name}
+    for stale in [*directory.glob("grid.*.i16"), *directory.glob("payload.*.json")]:
+        if stale.name not in keep:
+            stale.unlink(missing_ok=True)
+    print(
+        f"Wrote heatmap payload ({len(grid.hotel_ids)} hotels x {len(dates)} days, "
+        f"{grid_entry['bytes'] + payload_entry['bytes']} bytes) to {directory}"
+    )
+    return manifest_path
+
+
+class SnapshotStore:
+    """Append-only SQLite history of each run's hotel x date room counts.
+
+    Every recorded run gets a row in `runs`; its known cells go to `counts`, keyed
+    by (hotel_id, date, run_id) so a hotel's time series is a single index range
+    scan, with a secondary run_id index for run-to-run diffs.
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            source TEXT,
+            hotels INTEGER NOT NULL,
+            dates INTEGER NOT NULL,
+            cells INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS counts (
+            hotel_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            run_id INTEGER NOT NULL REFERENCES runs (run_id),
+            rooms INTEGER NOT NULL,
+            PRIMARY KEY (hotel_id, date, run_id)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS counts_run ON counts (run_id)",
+        "CREATE INDEX IF NOT EXISTS runs_created_at ON runs (created_at)",
+    )
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "SnapshotStore":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def record(
+        self, grid: AvailabilityGrid, *, source: str | None = None, created_at: str | None = None
+    ) -> int:
+        """Store one run's known cells in a single transaction; returns its run_id."""
+        rows, columns = np.nonzero(~grid.missing)
+        created_at = created_at or datetime.now().isoformat(timespec="seconds")
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (created_at, source, hotels, dates, cells) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (created_at, source, len(grid.hotel_ids), len(grid.dates), len(rows)),
+            )
+            run_id = cursor.lastrowid
+            hotel_ids = grid.hotel_ids
+            dates = grid.dates
+            counts = grid.counts[rows, columns].tolist()
+            self.conn.executemany(
+                "INSERT INTO counts (hotel_id, date, run_id, rooms) VALUES (?, ?, ?, ?)",
+                (
+                    (hotel_ids[row], dates[column], run_id, rooms)
+                    for row, column, rooms in zip(rows.tolist(), columns.tolist(), counts)
+                ),
+            )
+        return run_id
+
+    def runs(self, limit: int = DEFAULT_HISTORY_RUNS) -> list[tuple[Any, ...]]:
+        """Most recent runs first: (run_id, created_at, source, hotels, dates, cells)."""
+        return self.conn.execute(
+            "SELECT run_id, created_at, source, hotels, dates, cells FROM runs "
+            "ORDER BY run_id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+
+    def series(
+        self, hotel_id: str, date_key: str | None = None, limit: int = DEFAULT_HISTORY_RUNS
+    ) -> list[tuple[Any, ...]]:
+        """(date, run_id, created_at, rooms) for a hotel over its last `limit` runs."""
+        query = (
+            "SELECT c.date, c.run_id, r.created_at, c.rooms FROM counts c "
+            "JOIN runs r ON r.run_id = c.run_id "
+            "WHERE c.hotel_id = ? AND c.run_id IN "
+            "(SELECT run_id FROM runs ORDER BY run_id DESC LIMIT ?)"
+        )
+        params: list[Any] = [hotel_id, limit]
+        if date_key:
+            query += " AND c.date = ?"
+            params.append(date_key)
+        return self.conn.execute(query + " ORDER BY c.date, c.run_id", params).fetchall()
+
+    def latest_run_ids(self, count: int = 2) -> list[int]:
+        rows = self.conn.execute(
+            "SELECT run_id FROM runs ORDER BY run_id DESC LIMIT ?", (count,)
+        ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def diff(
+        self, before: int, after: int, hotel_id: str | None = None
+    ) -> list[tuple[Any, ...]]:
+        """Cells whose count differs between two runs: (hotel_id, date, before, after).
+
+        A cell present in only one of the runs shows None on the other side.
+        """
+        query = (
+            "SELECT hotel_id, date, "
+            "MAX(CASE WHEN run_id = :before THEN rooms END) AS before_rooms, "
+            "MAX(CASE WHEN run_id = :after THEN rooms END) AS after_rooms "
+            "FROM counts WHERE run_id IN (:before, :after)"
+        )
+        if hotel_id:
+            query += " AND hotel_id = :hotel_id"
+        query += (
+            " GROUP BY hotel_id, date HAVING before_rooms IS NOT after_rooms"
+            " ORDER BY hotel_id, date"
+        )
+        return self.conn.execute(
+            query, {"before": before, "after": after, "hotel_id": hotel_id}
+        ).fetchall()
+
+
+def query_history(
+    path: Path,
+    query: str,
+    *,
+    hotel_id: str | None = None,
+    date_key: str | None = None,
+    limit: int = DEFAULT_HISTORY_RUNS,
+    run_ids: Sequence[int] | None = None,
+    out: IO[str] = sys.stdout,
+) -> int:
+    """Write a history query as CSV to `out`; returns the number of data rows."""
+    with SnapshotStore(path) as store:
+        if query == "runs":
+            header = ["run_id", "created_at", "source", "hotels", "dates", "cells"]
+            rows = store.runs(limit)
+        elif query == "series":
+            if not hotel_id:
+                raise ValueError("The series query needs --history-hotel")
+            header = ["date", "run_id", "created_at", "rooms"]
+            rows = store.series(hotel_id, date_key, limit)
+        elif query == "diff":
+            if run_ids:
+                if len(run_ids) != 2:
+                    raise ValueError("--history-runs takes exactly two run ids (BEFORE AFTER)")
+                before, after = run_ids
+            else:
+                latest = store.latest_run_ids(2)
+                if len(latest) < 2:
+                    raise ValueError(f"{path} has fewer than two runs to diff")
+                before, after = latest
+            header = ["hotel_id", "date", f"rooms_run_{before}", f"rooms_run_{after}", "delta"]
+            rows = [
+                (*row, "" if None in row[2:] else row[3] - row[2])
+                for row in store.diff(before, after, hotel_id)
+            ]
+        else:
+            raise ValueError(f"Unknown history query '{query}'; use one of {HISTORY_QUERIES}")
+    writer = csv.writer(out)
+    writer.writerow(header)
+    writer.writerows(["" if value is None else value for value in row] for row in rows)
+    return len(rows)
+
+
+def read_jsonl(path: Path) -> Iterable[dict[str, Any]]:
+    # Split the decompressed bytes here rather than through a text wrapper: when a
+    # truncated stream raises, the wrapper discards everything it decoded but had
+    # not returned yet, losing complete records just before the damage.
+    with contextlib.closing(jsonl_chunks(path)) as chunks:
+        tail = b""
+        while True:
             try:
-                yield json.loads(line)
+                chunk = next(chunks, b"")
+            except (EOFError, OSError, zlib.error) + _zstd_errors() as exc:
+                # A compressed stream cut off by a kill: keep every complete line.
+                print(f"[warn] {path} ends in a truncated record: {exc}", file=sys.stderr)
+                return
+            if chunk:
+                lines = (tail + chunk).split(b"\n")
+                tail = lines.pop()
+            else:
+                lines, tail = [tail], b""
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+            if not chunk:
+                return
+
+
+def record_nightly_counts(record: Mapping[str, Any]) -> dict[str, int]:
+    """Nightly counts from a full (`response`) or slim (`nightly`) JSONL record."""
+    nightly = record.get("nightly")
+    if isinstance(nightly, Mapping) and "response" not in record:
+        counts: dict[str, int] = {}
+        for date_key, count in nightly.items():
+            value = _coerce_int(count)
+            if value is not None:
+                counts[str(date_key)] = value
+        return counts
+    return extract_hotel_nightly_counts(record.get("response") or {})
+
+
+def record_succeeded(record: Mapping[str, Any]) -> bool:
+    return "error" not in record and ("response" in record or "nightly" in record)
+
+
+def slim_record(record: Mapping[str, Any], nightly: Mapping[str, int]) -> dict[str, Any]:
+    """Drop the raw response, keeping only the hotel id, status and nightly counts."""
+    slim = {key: value for key, value in record.items() if key not in ("response", "error")}
+    if record_succeeded(record):
+        slim["status"] = "ok"
+        slim["nightly"] = dict(nightly)
+    else:
+        slim["status"] = "error"
+        slim["error"] = record.get("error")
+    return slim
+
+
+HotelState = dict[str, tuple[bool, dict[str, int]]]
+
+
+def _accumulate_record(state: HotelState, record: Mapping[str, Any]) -> str | None:
+    """Fold one JSONL record into {hotel_id: (replaced, nightly)}; returns the hotel id.
+
+    Plain records replace whatever came before for that hotel; sweep records hold one
+    stay window each and are merged. `replaced` records whether a plain record was
+    seen, so partial states from consecutive byte ranges can be combined in order.
+    """
+    hotel_id = str(record.get("hotel_id") or "").strip()
+    if not hotel_id:
+        return None
+    nightly = record_nightly_counts(record)
+    if "lead_days" in record:
+        replaced, current = state.get(hotel_id, (False, {}))
+        state[hotel_id] = (replaced, merge_nightly_counts(current, nightly))
+    else:
+        state[hotel_id] = (True, nightly)
+    return hotel_id
+
+
+def _merge_states(
+    state: HotelState,
+    offsets: dict[str, int],
+    partial: HotelState,
+    partial_offsets: Mapping[str, int],
+) -> None:
+    """Combine the state of a later byte range into `state` (see _accumulate_record)."""
+    for hotel_id, (replaced, nightly) in partial.items():
+        if replaced or hotel_id not in state:
+            state[hotel_id] = (replaced, nightly)
+        else:
+            previous_replaced, current = state[hotel_id]
+            state[hotel_id] = (previous_replaced, merge_nightly_counts(current, nightly))
+    offsets.update(partial_offsets)
+
+
+def _convert_shard(path: str, start: int, end: int) -> tuple[HotelState, dict[str, int]]:
+    """Parse and extract the lines starting within bytes [start, end) of a JSONL file.
+
+    Returns the folded state and, per hotel, the byte offset of its latest record.
+    """
+    state: HotelState = {}
+    offsets: dict[str, int] = {}
+    with open(path, "rb") as handle:
+        handle.seek(start)
+        position = start
+        while position < end:
+            line = handle.readline()
+            if not line:
+                break
+            line_start = position
+            position += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
             except json.JSONDecodeError:
                 continue
+            hotel_id = _accumulate_record(state, record)
+            if hotel_id:
+                offsets[hotel_id] = line_start
+    return state, offsets
+
+
+def shard_offsets(
+    path: Path, shards: int, start: int = 0, end: int | None = None
+) -> list[tuple[int, int]]:
+    """Split bytes [start, end) into up to `shards` ranges that begin on line boundaries."""
+    end = path.stat().st_size if end is None else end
+    bounds = [start]
+    with path.open("rb") as handle:
+        for index in range(1, shards):
+            target = start + (end - start) * index // shards
+            if target <= bounds[-1]:
+                continue
+            handle.seek(target - 1)
+            handle.readline()  # finish the line straddling the target
+            offset = handle.tell()
+            if bounds[-1] < offset < end:
+                bounds.append(offset)
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _fold_jsonl_range(
+    path: Path, start: int, end: int, workers: int
+) -> tuple[HotelState, dict[str, int]]:
+    if workers <= 1 or end - start < PARALLEL_CONVERT_MIN_BYTES:
+        return _convert_shard(str(path), start, end)
+
+    # Several shards per worker so one slow shard does not hold up the pool.
+    ranges = shard_offsets(path, workers * 4, start, end)
+    state: HotelState = {}
+    offsets: dict[str, int] = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partials = executor.map(
+            _convert_shard,
+            [str(path)] * len(ranges),
+            [range_start for range_start, _ in ranges],
+            [range_end for _, range_end in ranges],
+        )
+        for partial, partial_offsets in partials:
+            _merge_states(state, offsets, partial, partial_offsets)
+    return state, offsets
+
+
+def _sidecar_path(jsonl_path: Path, suffix: str) -> Path:
+    if is_compressed(jsonl_path):
+        jsonl_path = jsonl_path.with_suffix("")
+    return jsonl_path.with_suffix(suffix)
+
+
+def index_path_for(jsonl_path: Path) -> Path:
+    """Sidecar path for the convert index, e.g. results.jsonl -> results.index.json."""
+    return _sidecar_path(jsonl_path, ".index.json")
+
+
+def _jsonl_fingerprint(path: Path, size: int) -> str:
+    """Hash the head and the last few KiB before `size` to tell appends from rewrites."""
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        digest.update(handle.read(min(size, 65536)))
+        tail_start = max(0, size - 4096)
+        handle.seek(tail_start)
+        digest.update(handle.read(size - tail_start))
+    return digest.hexdigest()
+
+
+def _complete_lines_end(path: Path, size: int) -> int:
+    """Offset just past the last newline, so a line still being written is left alone."""
+    if size == 0:
+        return 0
+    with path.open("rb") as handle:
+        position = size
+        while position > 0:
+            chunk_start = max(0, position - 65536)
+            handle.seek(chunk_start)
+            chunk = handle.read(position - chunk_start)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                return chunk_start + newline + 1
+            position = chunk_start
+    return 0
+
+
+def _load_convert_index(path: Path, jsonl_path: Path, stat: os.stat_result) -> dict[str, Any] | None:
+    index = read_progress(path)
+    if not index or index.get("version") != 1:
+        return None
+    indexed_size = index.get("size")
+    if not isinstance(indexed_size, int) or indexed_size > stat.st_size:
+        return None
+    unchanged = indexed_size == stat.st_size and index.get("mtime_ns") == stat.st_mtime_ns
+    if not unchanged and _jsonl_fingerprint(jsonl_path, indexed_size) != index.get("fingerprint"):
+        return None
+    return index
+
+
+def build_hotel_map_from_jsonl(
+    path: Path, workers: int = 1, use_index: bool = False
+) -> dict[str, dict[str, int]]:
+    """Extract per-hotel nightly counts from a bookings JSONL.
+
+    With workers > 1 and a large enough file, byte-range shards are parsed in a process
+    pool and their partial maps merged in file order, giving the same result as the
+    serial pass. With use_index, the folded state and each hotel's latest record offset
+    are kept in a *.index.json sidecar keyed by the file's size, mtime and fingerprint,
+    so later calls only parse what was appended since.
+    """
+    stat = path.stat()
+    if is_compressed(path):
+        # Byte offsets are meaningless inside a compressed stream: fold it serially.
+        state: HotelState = {}
+        for record in read_jsonl(path):
+            _accumulate_record(state, record)
+        return {hotel_id: nightly for hotel_id, (_, nightly) in state.items()}
+    if not use_index:
+        state, _ = _fold_jsonl_range(path, 0, stat.st_size, workers)
+        return {hotel_id: nightly for hotel_id, (_, nightly) in state.items()}
+
+    index_path = index_path_for(path)
+    index = _load_convert_index(index_path, path, stat)
+    state = {}
+    offsets: dict[str, int] = {}
+    start = 0
+    if index:
+        start = index["size"]
+        for hotel_id, entry in index.get("hotels", {}).items():
+            state[hotel_id] = (bool(entry["replaced"]), dict(entry["nightly"]))
+            offsets[hotel_id] = int(entry["offset"])
+
+    end = _complete_lines_end(path, stat.st_size)
+    if end > start:
+        partial, partial_offsets = _fold_jsonl_range(path, start, end, workers)
+        _merge_states(state, offsets, partial, partial_offsets)
+        print(f"Indexed {end - start} new bytes of {path} from offset {start}")
+        write_progress(
+            index_path,
+            {
+                "version": 1,
+                "size": end,
+                "mtime_ns": stat.st_mtime_ns if end == stat.st_size else None,
+                "fingerprint": _jsonl_fingerprint(path, end),
+                "hotels": {
+                    hotel_id: {
+                        "nightly": nightly,
+                        "offset": offsets.get(hotel_id),
+                        "replaced": replaced,
+                    }
+                    for hotel_id, (replaced, nightly) in state.items()
+                },
+            },
+        )
+    else:
+        print(f"Index for {path} is up to date")
+
+    hotel_map = {hotel_id: dict(nightly) for hotel_id, (_, nightly) in state.items()}
+    if end < stat.st_size:
+        # A trailing line without newline: include it now but leave it out of the index.
+        tail, _ = _convert_shard(str(path), end, stat.st_size)
+        for hotel_id, (replaced, nightly) in tail.items():
+            if replaced or hotel_id not in hotel_map:
+                hotel_map[hotel_id] = nightly
+            else:
+                merge_nightly_counts(hotel_map[hotel_id], nightly)
+    return hotel_map
+
+
+def progress_path_for(jsonl_path: Path) -> Path:
+    """Sidecar path next to the JSONL, e.g. results.jsonl -> results.progress.json."""
+    return _sidecar_path(jsonl_path, ".progress.json")
+
+
+def read_progress(path: Path) -> dict[str, Any] | None:
+    try:
+        with path.open(encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def write_progress(path: Path, progress: Mapping[str, Any]) -> None:
+    """Atomically replace the progress sidecar so a kill never leaves it half-written."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as handle:
+        json.dump(progress, handle, indent=2, sort_keys=True)
+        handle.write("\n")
+    os.replace(tmp_path, path)
+
+
+def truncate_partial_line(path: Path) -> None:
+    """Drop a trailing record cut off mid-write so appended lines stay parseable."""
+    if is_compressed(path):
+        # A killed compressed writer leaves a broken member/frame that would hide
+        # anything appended after it, so rewrite the readable records instead.
+        tmp_path = path.with_name(f"{path.stem}.tmp{path.suffix}")
+        with open_jsonl(tmp_path, "w") as outfile:
+            for record in read_jsonl(path):
+                outfile.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, path)
+        return
+    with path.open("rb+") as handle:
+        handle.seek(0, os.SEEK_END)
+        size = handle.tell()
+        if size == 0:
+            return
+        handle.seek(size - 1)
+        if handle.read(1) == b"\n":
+            return
+        chunk = 1 << 16
+        pos = size
+        while pos > 0:
+            start = max(0, pos - chunk)
+            handle.seek(start)
+            data = handle.read(pos - start)
+            newline = data.rfind(b"\n")
+            if newline != -1:
+                handle.truncate(start + newline + 1)
+                return
+            pos = start
+        handle.truncate(0)
+
+
+def record_key(hotel_id: str, lead_days: int | None = None) -> str:
+    """Identify a fetch task: the hotel, plus the lead time for sweep records."""
+    return hotel_id if lead_days is None else f"{hotel_id}@{lead_days}"
+
+
+def load_completed_records(path: Path) -> dict[str, dict[str, int]]:
+    """Return nightly counts keyed by record_key for tasks whose latest record succeeded."""
+    completed: dict[str, dict[str, int]] = {}
+    for record in read_jsonl(path):
+        hotel_id = str(record.get("hotel_id") or "").strip()
+        if not hotel_id:
+            continue
+        key = record_key(hotel_id, record.get("lead_days"))
+        if record_succeeded(record):
+            completed[key] = record_nightly_counts(record)
+        else:
+            completed.pop(key, None)
+    return completed
+
+
+def refresh_path_for(jsonl_path: Path) -> Path:
+    """Sidecar for refresh scheduling state, e.g. results.jsonl -> results.refresh.json."""
+    return _sidecar_path(jsonl_path, ".refresh.json")
+
+
+def load_refresh_state(path: Path, jsonl_path: Path) -> dict[str, dict[str, Any]]:
+    """Per-hotel {fetched_at, change_rate, observations} from the refresh sidecar.
+
+    Without a sidecar, every hotel with a successful record in the JSONL is assumed
+    to have been fetched at the JSONL's mtime.
+    """
+    state = read_progress(path)
+    if state and isinstance(state.get("hotels"), dict):
+        return state["hotels"]
+    if not jsonl_path.exists():
+        return {}
+    fetched_at = datetime.fromtimestamp(jsonl_path.stat().st_mtime, timezone.utc)
+    stamp = fetched_at.isoformat(timespec="seconds")
+    return {
+        hotel_id: {"fetched_at": stamp, "change_rate": None, "observations": 1}
+        for hotel_id in load_completed_records(jsonl_path)
+        if "@" not in hotel_id
+    }
+
+
+def change_fraction(before: Mapping[str, int], after: Mapping[str, int]) -> float | None:
+    """Share of nights present in both snapshots whose room count changed."""
+    shared = before.keys() & after.keys()
+    if not shared:
+        return None
+    return sum(1 for date_key in shared if before[date_key] != after[date_key]) / len(shared)
+
+
+def _age_hours(entry: Mapping[str, Any], now: datetime) -> float:
+    try:
+        fetched_at = datetime.fromisoformat(entry["fetched_at"])
+    except (KeyError, TypeError, ValueError):
+        return math.inf
+    return max(0.0, (now - fetched_at).total_seconds() / 3600)
+
+
+def refresh_priority(
+    entry: Mapping[str, Any],
+    nightly: Mapping[str, int],
+    coverage: float,
+    *,
+    now: datetime,
+    config: Sequence[Mapping[str, Any]] | None = None,
+) -> float:
+    """Expected value of refetching a hotel now: change rate x closeness to the
+    decision boundary x age.
+
+    The boundary term is how close each --stay night's count is to the rooms asked
+    for (nights with no data count as close); without stays it is highest for hotels
+    that are half available (coverage 0.5) and zero for fully sold out/open ones.
+    """
+    rate = entry.get("change_rate")
+    rate = REFRESH_DEFAULT_RATE if rate is None else float(rate)
+    if config:
+        closeness = [
+            1.0
+            if nightly.get(stay["date"]) is None
+            else 1.0 / (1 + abs(nightly[stay["date"]] - int(stay["rooms"])))
+            for stay in config
+        ]
+        boundary = sum(closeness) / len(closeness)
+    else:
+        boundary = 4 * coverage * (1 - coverage)
+    return (REFRESH_RATE_FLOOR + rate) * (1 + boundary) * _age_hours(entry, now) / 24
+
+
+def plan_refresh(
+    hotel_ids: Sequence[str],
+    *,
+    previous: Mapping[str, Mapping[str, int]],
+    state: Mapping[str, Mapping[str, Any]],
+    budget: int,
+    now: datetime,
+    config: Sequence[Mapping[str, Any]] | None = None,
+    max_age_hours: float = DEFAULT_REFRESH_MAX_AGE_HOURS,
+) -> tuple[list[str], list[str]]:
+    """Split hotel_ids into (fetch, carry_forward) with at most `budget` fetches.
+
+    Hotels without usable previous data come first (in input order), then any older
+    than max_age_hours (oldest first), then the rest by refresh_priority.
+    """
+    known = [hotel_id for hotel_id in hotel_ids if hotel_id in previous and hotel_id in state]
+    coverage: dict[str, float] = {}
+    if known:
+        grid = build_availability_grid({hotel_id: previous[hotel_id] for hotel_id in known})
+        coverage = dict(zip(grid.hotel_ids, grid.coverage()))
+
+    ranked: list[tuple[int, float, int, str]] = []
+    for position, hotel_id in enumerate(hotel_ids):
+        if hotel_id not in coverage:
+            ranked.append((0, 0.0, position, hotel_id))
+            continue
+        entry = state[hotel_id]
+        age = _age_hours(entry, now)
+        if age > max_age_hours:
+            ranked.append((1, -age, position, hotel_id))
+            continue
+        score = refresh_priority(
+            entry, previous[hotel_id], coverage[hotel_id], now=now, config=config
+        )
+        ranked.append((2, -score, position, hotel_id))
+    ranked.sort()
+    fetch = [hotel_id for *_, hotel_id in ranked[:budget]]
+    chosen = set(fetch)
+    carry = [hotel_id for hotel_id in hotel_ids if hotel_id not in chosen and hotel_id in coverage]
+    return fetch, carry
+
+
+def carried_record(
+    hotel_id: str, nightly: Mapping[str, int], entry: Mapping[str, Any], now: datetime
+) -> dict[str, Any]:
+    """Slim JSONL record re-emitting a hotel's previous counts, tagged with their age."""
+    return {
+        "hotel_id": hotel_id,
+        "status": "ok",
+        "nightly": dict(nightly),
+        "carried_forward": True,
+        "fetched_at": entry.get("fetched_at"),
+        "age_hours": round(_age_hours(entry, now), 2),
+    }
+
+
+def skipped_record(hotel_id: str) -> dict[str, Any]:
+    """JSONL record for a hotel with no previous data that did not fit the refresh budget.
+
+    It renders as a row of missing nights, and the next run fetches it first.
+    """
+    return {
+        "hotel_id": hotel_id,
+        "status": "skipped",
+        "error": "not fetched: over the refresh budget with no previous data",
+    }
+
+
+def update_refresh_state(
+    state: dict[str, dict[str, Any]],
+    fetched: Mapping[str, Mapping[str, int]],
+    previous: Mapping[str, Mapping[str, int]],
+    now: datetime,
+) -> dict[str, dict[str, Any]]:
+    """Fold this run's successful fetches into the per-hotel change-rate state.
+
+    An empty fetch is still an observation: the hotel stopped returning rates.
+    """
+    stamp = now.isoformat(timespec="seconds")
+    for hotel_id, nightly in fetched.items():
+        entry = dict(state.get(hotel_id) or {"change_rate": None, "observations": 0})
+        before = previous.get(hotel_id) or {}
+        fraction = change_fraction(before, nightly)
+        if fraction is None and hotel_id in previous and bool(before) != bool(nightly):
+            # Going from rates to none (or back) is a full change, not "no overlap".
+            fraction = 1.0
+        if fraction is not None:
+            rate = entry.get("change_rate")
+            entry["change_rate"] = round(
+                fraction
+                if rate is None
+                else REFRESH_EWMA_ALPHA * fraction + (1 - REFRESH_EWMA_ALPHA) * rate,
+                4,
+            )
+        entry["observations"] = int(entry.get("observations") or 0) + 1
+        entry["fetched_at"] = stamp
+        state[hotel_id] = entry
+    return state
+
+
+def window_min_rooms(nightly: Mapping[str, int], window: Mapping[str, Any]) -> int | None:
+    """Rooms available on every night of a sweep window, or None if any night is missing."""
+    counts = [nightly.get(entry["date"]) for entry in window["config"]]
+    if not counts or any(count is None for count in counts):
+        return None
+    return min(counts)
+
+
+def write_sweep_csv(rows: list[dict[str, object]], path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", newline="", encoding="utf-8") as handle:
+        writer = csv.DictWriter(
+            handle,
+            fieldnames=["hotel_id", "lead_days", "check_in", "check_out", "min_rooms", "status"],
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Wrote {len(rows)} sweep windows to {path}")
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse a --shard K/N spec (K is 1-based)."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K/N (e.g. 2/4), got '{value}'") from None
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {value} needs 1 <= K <= N")
+    return index, count
+
+
+def shard_of(hotel_id: str, count: int) -> int:
+    """Stable 1-based shard for a hotel, independent of input order, process and host."""
+    digest = hashlib.sha256(hotel_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count + 1
+
+
+def shard_path(path: Path, index: int, count: int) -> Path:
+    """Per-shard output path, e.g. results.jsonl.gz -> results.shard-2-of-4.jsonl.gz."""
+    compression = path.suffix if is_compressed(path) else ""
+    inner = path.with_suffix("") if compression else path
+    return inner.with_name(f"{inner.stem}.shard-{index}-of-{count}{inner.suffix}{compression}")
+
+
+def merge_shard_outputs(
+    jsonl_path: Path,
+    count: int,
+    *,
+    workers: int = 1,
+    use_index: bool = False,
+    sweep_csv: Path | None = None,
+) -> dict[str, dict[str, int]]:
+    """Combine the nightly counts of all `count` shard JSONLs written for jsonl_path.
+
+    Raises ValueError when a shard file is missing or the shards' progress sidecars
+    disagree on the search parameters. Shards that did not finish are merged with a
+    warning. Per-shard sweep CSVs, if any, are concatenated lead-major into sweep_csv.
+    """
+    paths = [shard_path(jsonl_path, index, count) for index in range(1, count + 1)]
+    missing = [str(path) for path in paths if not path.exists()]
+    if missing:
+        raise ValueError(f"{len(missing)} of {count} shard(s) missing: {', '.join(missing)}")
+
+    reference: dict[str, Any] | None = None
+    for index, path in enumerate(paths, 1):
+        progress = read_progress(progress_path_for(path)) or {}
+        status = progress.get("status") or "without a progress file"
+        if status != "completed":
+            print(f"[warn] Shard {index}/{count} ({path}) is {status}", file=sys.stderr)
+        params = {
+            key: value
+            for key, value in (progress.get("search_params") or {}).items()
+            if key not in ("hotel_count", "shard")
+        }
+        if not params:
+            continue
+        if reference is None:
+            reference = params
+        elif params != reference:
+            raise ValueError(
+                f"Shard {index}/{count} ({path}) was fetched with different search parameters"
+            )
+
+    hotel_map: dict[str, dict[str, int]] = {}
+    for index, path in enumerate(paths, 1):
+        shard_map = build_hotel_map_from_jsonl(path, workers=workers, use_index=use_index)
+        strays = sum(1 for hotel_id in shard_map if shard_of(hotel_id, count) != index)
+        if strays:
+            print(
+                f"[warn] {strays} hotel(s) in {path} do not hash to shard {index}/{count}",
+                file=sys.stderr,
+            )
+        hotel_map.update(shard_map)
+    print(f"Merged {len(hotel_map)} hotels from {count} shards of {jsonl_path}")
+
+    if sweep_csv:
+        sweep_paths = [shard_path(sweep_csv, index, count) for index in range(1, count + 1)]
+        present = [path for path in sweep_paths if path.exists()]
+        if present:
+            if len(present) < count:
+                print(
+                    f"[warn] Only {len(present)} of {count} shard sweep CSVs found",
+                    file=sys.stderr,
+                )
+            rows: list[dict[str, object]] = []
+            for path in present:
+                with path.open(newline="", encoding="utf-8") as handle:
+                    rows.extend(csv.DictReader(handle))
+            # Stable sort keeps each shard's hotel order within a lead time.
+            rows.sort(key=lambda row: int(row["lead_days"]))
+            write_sweep_csv(rows, sweep_csv)
+    return hotel_map
+
+
+# Python literals as repr() writes them inside the pricing dicts
+_PY_STRING = r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|None"""
+# No inf/nan: literal_eval rejects them, so such rows take the fallback and match it.
+_PY_NUMBER = r"-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|None|True|False"
+_PRICING_PATTERNS = {
+    key: re.compile(rf"[{{,]\s*'{key}':\s*({literal})\s*[,}}]")
+    for keys, literal in ((PRICING_NUMBER_FIELDS, _PY_NUMBER), (PRICING_TEXT_FIELDS, _PY_STRING))
+    for key in keys
+}
+
+
+def _pricing_status(prices: pd.Series) -> pd.Series:
+    """Classify raw price cells the way web/lib/heatmap.js normalizePrice does."""
+    lowered = prices.str.strip().str.lower()
+    status = pd.Series("error", index=prices.index, dtype=object)
+    status[lowered.isin(("", "na", "nan"))] = "missing"
+    status[lowered.isin(("no rates", "no rates found"))] = "no_rates"
+    status[lowered.str.contains("no market", regex=False)] = "no_market_price"
+    status[lowered.str.startswith("{")] = "ok"
+    return status
+
+
+def _decode_py_strings(literals: pd.Series) -> pd.Series:
+    """Turn matched string literals into values; only escaped ones go through ast."""
+    values = literals.str[1:-1].astype(object)
+    values[literals.isna() | (literals == "None")] = None
+    escaped = literals.str.contains("\\", regex=False, na=False)
+    if escaped.any():
+        values[escaped] = literals[escaped].map(ast.literal_eval)
+    return values
+
+
+def _py_numbers(literals: pd.Series) -> pd.Series:
+    """Matched number literals as float64, rounded exactly as float() rounds them.
+
+    pd.to_numeric's fast parser can be off by one ulp on 17-digit reprs such as
+    '1938.6200000000001', so the strings go through Python float parsing instead.
+    """
+    literals = literals.replace({"True": "1", "False": "0"}).mask(literals == "None")
+    try:
+        return literals.astype(np.float64)
+    except (TypeError, ValueError):
+        return literals.map(_py_number)
+
+
+def _py_number(value: Any) -> float:
+    """float() of a parsed literal; None and anything non-numeric become NaN."""
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError):
+        return math.nan
+
+
+def parse_pricing_prices(prices: pd.Series) -> pd.DataFrame:
+    """Split price cells into status, number and text columns without evaluating them.
+
+    Each dict key is pulled out with one vectorized regex over the whole series.
+    Rows where any key fails to match (reordered, missing or unusual keys) fall back
+    to ast.literal_eval; rows that still do not parse get status "invalid".
+    """
+    prices = prices.fillna("").astype(str)
+    status = _pricing_status(prices)
+    is_dict = status == "ok"
+    dicts = prices[is_dict]
+    columns: dict[str, pd.Series] = {"status": status}
+    matched = pd.Series(True, index=dicts.index)
+    for key, pattern in _PRICING_PATTERNS.items():
+        literals = dicts.str.extract(pattern, expand=False)
+        matched &= literals.notna()
+        if key in PRICING_NUMBER_FIELDS:
+            values = _py_numbers(literals)
+        else:
+            values = _decode_py_strings(literals)
+        columns[key] = values.reindex(prices.index)
+    frame = pd.DataFrame(columns, index=prices.index)
+
+    for row in dicts.index[~matched]:
+        try:
+            parsed = ast.literal_eval(dicts[row])
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            parsed = None
+        if not isinstance(parsed, dict):
+            frame.loc[row, list(_PRICING_PATTERNS)] = None
+            frame.at[row, "status"] = "invalid"
+            continue
+        for key in PRICING_NUMBER_FIELDS:
+            frame.at[row, key] = _py_number(parsed.get(key))
+        for key in PRICING_TEXT_FIELDS:
+            value = parsed.get(key)
+            frame.at[row, key] = None if value is None else str(value)
+    return frame
+
+
+def iter_pricing_batch(
+    csv_path: Path, chunk_rows: int = PRICING_CHUNK_ROWS
+) -> Iterator[pd.DataFrame]:
+    """Yield typed frames for a pricing_hotels_all.csv batch, `chunk_rows` at a time.
+
+    Columns: hmid, lead_days, check_in, check_out (datetime64), status, the numeric
+    Kuoni/Market/HotelMap/sell prices, currencies and room names.
+    """
+    reader = pd.read_csv(
+        csv_path, dtype=str, keep_default_na=False, chunksize=max(1, chunk_rows)
+    )
+    for chunk in reader:
+        missing = {"hmid", "lead_days", "check_in", "price"} - set(chunk.columns)
+        if missing:
+            raise ValueError(f"{csv_path} is missing pricing column(s): {sorted(missing)}")
+        frame = pd.DataFrame(
+            {
+                "hmid": pd.to_numeric(chunk["hmid"], errors="coerce").astype("Int64"),
+                "lead_days": pd.to_numeric(chunk["lead_days"], errors="coerce").astype("Int16"),
+                "check_in": pd.to_datetime(chunk["check_in"], format="%Y-%m-%d", errors="coerce"),
+                "check_out": pd.to_datetime(
+                    chunk.get("check_out", pd.Series("", index=chunk.index)),
+                    format="%Y-%m-%d",
+                    errors="coerce",
+                ),
+            },
+            index=chunk.index,
+        )
+        yield pd.concat([frame, parse_pricing_prices(chunk["price"])], axis=1)
+
+
+def pricing_output_for(csv_path: Path) -> Path:
+    return csv_path.with_suffix(".parquet")
+
+
+def write_pricing_parquet(
+    csv_path: Path, path: Path, chunk_rows: int = PRICING_CHUNK_ROWS
+) -> dict[str, int]:
+    """Convert a pricing batch CSV to Parquet one row group per chunk; returns status counts."""
+    pa = _import_optional("pyarrow", "Pricing batch conversion")
+    pq = _import_optional("pyarrow.parquet", "Pricing batch conversion", package="pyarrow")
+    schema = pa.schema(
+        [
+            ("hmid", pa.int64()),
+            ("lead_days", pa.int16()),
+            ("check_in", pa.date32()),
+            ("check_out", pa.date32()),
+            ("status", pa.string()),
+            *((key, pa.float64()) for key in PRICING_NUMBER_FIELDS),
+            *((key, pa.string()) for key in PRICING_TEXT_FIELDS),
+        ]
+    )
+    counts: dict[str, int] = {}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    # Low-cardinality strings (status, currencies, room names) are dictionary-encoded
+    # on disk by the Parquet writer, so plain string columns stay compact.
+    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        for frame in iter_pricing_batch(csv_path, chunk_rows):
+            arrays = []
+            for field in schema:
+                column = frame[field.name]
+                if pa.types.is_date32(field.type):
+                    arrays.append(
+                        pa.array(
+                            column.to_numpy().astype("datetime64[D]"),
+                            type=field.type,
+                            mask=column.isna().to_numpy(),
+                        )
+                    )
+                else:
+                    arrays.append(pa.array(column, type=field.type, from_pandas=True))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            for status, count in frame["status"].value_counts().items():
+                counts[status] = counts.get(status, 0) + int(count)
+    os.replace(tmp_path, path)
+    breakdown = ", ".join(f"{status} {count}" for status, count in sorted(counts.items()))
+    print(f"Wrote {sum(counts.values())} pricing rows ({breakdown}) to {path}")
+    return counts
+
+
+def generate_outputs(
+    hotel_map: Mapping[str, Mapping[str, int]],
+    *,
+    csv_path: Path | None,
+    excel_path: Path | None,
+    png_path: Path | None,
+    png_size: tuple[int, int],
+    no_csv: bool,
+    no_excel: bool,
+    no_png: bool,
+    parquet_path: Path | None = None,
+    parquet_layout: str = "long",
+    png_mode: str = "binary",
+    png_rooms_required: int = DEFAULT_ROOMS_REQUIRED,
+    png_cell: tuple[int, int] | None = None,
+    png_tiles_dir: Path | None = None,
+    png_tile_size: int = DEFAULT_TILE_SIZE,
+    history_db: Path | None = None,
+    history_source: str | None = None,
+    feasibility_path: Path | None = None,
+    feasibility_profiles: Sequence[Sequence[int]] = (DEFAULT_STAY_PROFILE,),
+    heatmap_dir: Path | None = None,
+    hotel_summary: Path | None = None,
+    hotel_column: str | None = DEFAULT_HOTEL_COLUMN,
+    events: RunEvents | None = None,
+) -> None:
+    if not hotel_map:
+        print("No hotel data parsed; nothing to write.")
+        return
+
+    with _phase(events, "grid"):
+        grid = build_availability_grid(hotel_map)
+    if not no_csv and csv_path:
+        with _phase(events, "csv"):
+            write_csv(grid, csv_path)
+    if not no_excel and excel_path:
+        with _phase(events, "excel"):
+            write_excel(grid, excel_path)
+    if not no_png and png_path:
+        with _phase(events, "png"):
+            write_png(
+                grid,
+                png_size,
+                png_path,
+                mode=png_mode,
+                rooms_required=png_rooms_required,
+                cell=png_cell,
+            )
+    if not no_png and png_tiles_dir:
+        with _phase(events, "png_tiles"):
+            write_png_tiles(
+                grid,
+                png_tiles_dir,
+                mode=png_mode,
+                rooms_required=png_rooms_required,
+                cell=png_cell or (1, 1),
+                tile_size=png_tile_size,
+            )
+    if parquet_path:
+        with _phase(events, "parquet"):
+            write_parquet(grid, parquet_path, parquet_layout)
+    if feasibility_path:
+        with _phase(events, "feasibility"):
+            write_feasibility_csv(grid, feasibility_profiles, feasibility_path)
+    if heatmap_dir:
+        with _phase(events, "heatmap_payload"):
+            write_heatmap_payload(
+                grid,
+                heatmap_dir,
+                hotel_summary=hotel_summary,
+                hotel_column=hotel_column,
+                source=history_source,
+                csv_path=None if no_csv else csv_path,
+            )
+    if history_db:
+        with _phase(events, "history"), SnapshotStore(history_db) as store:
+            run_id = store.record(grid, source=history_source)
+        print(f"Recorded run {run_id} ({int((~grid.missing).sum())} cells) in {history_db}")
+
+
+def configure_session(session: requests.Session, pool_size: int) -> requests.Session:
+    """Size the session's connection pool so concurrent workers reuse connections."""
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_hotel_record(
+    *,
+    payload: Mapping[str, Any],
+    args: argparse.Namespace,
+    session: requests.Session,
+    scheduler: RequestScheduler | None = None,
+    token_manager: TokenManager | None = None,
+    cache: ResponseCache | None = None,
+    events: RunEvents | None = None,
+    raw_path: Path | None = None,
+) -> tuple[dict[str, Any], dict[str, int], Exception | None]:
+    """Run one booking search and return (jsonl record, nightly counts, error).
+
+    With args.stream_extract the counts are pulled out of the body as it arrives
+    (stream_nightly_counts) and the record is always slim; raw_path, if given,
+    receives the untouched body and is noted in the record.
+    """
+    hotel_id = payload["hotel_id"]
+    if getattr(args, "stream_extract", False):
+        return _fetch_streamed_record(
+            payload=payload,
+            args=args,
+            session=session,
+            scheduler=scheduler,
+            token_manager=token_manager,
+            cache=cache,
+            events=events,
+            raw_path=raw_path,
+        )
+    try:
+        response = call_booking_search(
+            session=session,
+            url=args.url,
+            token=args.token,
+            payload=payload,
+            timeout=args.timeout,
+            scheduler=scheduler,
+            token_manager=token_manager,
+            cache=cache,
+            events=events,
+        )
+    except Exception as exc:
+        record: dict[str, Any] = {"hotel_id": hotel_id, "error": str(exc)}
+        if getattr(args, "slim", False):
+            record = slim_record(record, {})
+        return record, {}, exc
+    extract_started = time.perf_counter()
+    nightly = extract_hotel_nightly_counts(response)
+    if events:
+        events.add_phase_time("extract", time.perf_counter() - extract_started)
+    record = {"hotel_id": hotel_id, "response": response}
+    if getattr(args, "slim", False):
+        record = slim_record(record, nightly)
+    return record, nightly, None
+
+
+def _fetch_streamed_record(
+    *,
+    payload: Mapping[str, Any],
+    args: argparse.Namespace,
+    session: requests.Session,
+    scheduler: RequestScheduler | None,
+    token_manager: TokenManager | None,
+    cache: ResponseCache | None,
+    events: RunEvents | None,
+    raw_path: Path | None,
+) -> tuple[dict[str, Any], dict[str, int], Exception | None]:
+    hotel_id = payload["hotel_id"]
+    extract_seconds = 0.0
+
+    def extract(chunks: Iterable[bytes]) -> tuple[dict[str, int], bool]:
+        nonlocal extract_seconds
+        started = time.perf_counter()
+        nightly, success = stream_nightly_counts(chunks, raw_path)
+        # Parsing overlaps the body download, so this includes network time.
+        extract_seconds = time.perf_counter() - started
+        return nightly, success
+
+    try:
+        nightly = call_booking_search(
+            session=session,
+            url=args.url,
+            token=args.token,
+            payload=payload,
+            timeout=args.timeout,
+            scheduler=scheduler,
+            token_manager=token_manager,
+            cache=cache,
+            events=events,
+            stream_to=extract,
+        )
+    except Exception as exc:
+        return slim_record({"hotel_id": hotel_id, "error": str(exc)}, {}), {}, exc
+    if events:
+        events.add_phase_time("extract", extract_seconds)
+    record = slim_record({"hotel_id": hotel_id, "nightly": nightly}, nightly)
+    if raw_path:
+        record["raw"] = str(raw_path)
+    return record, nightly, None
+
+
+def fetch_bookings_availability(
+    *,
+    hotel_ids: Sequence[str],
+    config: list[dict[str, Any]] | None,
+    args: argparse.Namespace,
+    session: requests.Session,
+    scheduler: RequestScheduler | None = None,
+    token_manager: TokenManager | None = None,
+    cache: ResponseCache | None = None,
+    windows: Sequence[Mapping[str, Any]] | None = None,
+    events: RunEvents | None = None,
+    carried: Sequence[Mapping[str, Any]] = (),
+    cancel: threading.Event | None = None,
+    slot: Callable[[], contextlib.AbstractContextManager[Any]] | None = None,
+    failed: set[str] | None = None,
+) -> dict[str, dict[str, int]]:
+    """Fetch every hotel (or every hotel x sweep window) and return merged nightly counts.
+
+    With `windows` (see build_sweep_windows) each stay window replaces `config`, every
+    JSONL record is tagged with its lead_days/check_in/check_out, nightly counts are
+    merged per hotel, and a long-format sweep CSV is written to args.sweep_csv_output.
+    `carried` records (see carried_record and skipped_record) are written ahead of the
+    fetched ones so the JSONL stays a complete snapshot; they are not part of the
+    returned map.
+    Setting `cancel` stops submitting work and raises RunCancelled once the progress
+    sidecar is saved, leaving the JSONL ready for --resume. Each search runs inside
+    `slot()` when given (the --jobs in-flight cap). Hotels whose search errored are
+    added to `failed`, so callers can tell them apart from a successful empty result.
+    """
+    args.jsonl_output.parent.mkdir(parents=True, exist_ok=True)
+    concurrency = max(1, getattr(args, "concurrency", 1) or 1)
+    resume = getattr(args, "resume", False)
+    progress_path = progress_path_for(args.jsonl_output)
+    search_params: dict[str, Any] = {
+        "best_only": args.best_only,
+        "config": config,
+        "event_id": args.event_id,
+        "hotel_count": len(hotel_ids),
+        "language": args.language,
+        "mcode": args.mcode,
+        "url": args.url,
+    }
+    if getattr(args, "shard", None):
+        search_params["shard"] = "{}/{}".format(*args.shard)
+
+    # Lead-major task order, like the pricing sweeps: every hotel for lead 0, then 7, ...
+    tasks: list[tuple[str, str, Mapping[str, Any] | None]] = []
+    if windows:
+        search_params["config"] = None
+        search_params["sweep"] = {
+            "first_check_in": windows[0]["check_in"],
+            "last_check_in": windows[-1]["check_in"],
+            "rooms": windows[0]["config"][0]["rooms"],
+            "stay_length": len(windows[0]["config"]),
+            "windows": len(windows),
+        }
+        for window in windows:
+            tasks.extend(
+                (record_key(hotel_id, window["lead_days"]), hotel_id, window)
+                for hotel_id in hotel_ids
+            )
+    else:
+        tasks.extend((record_key(hotel_id), hotel_id, None) for hotel_id in hotel_ids)
+
+    now = datetime.now().isoformat(timespec="seconds")
+    progress: dict[str, Any] = {
+        "created_at": now,
+        "progress": {"last_hotel_id": None, "rows_written": 0, "tasks_done": 0},
+        "search_params": search_params,
+        "status": "running",
+        "updated_at": now,
+    }
+
+    results: dict[str, dict[str, int] | None] = {}
+    mode = "w"
+    if resume and args.jsonl_output.exists():
+        previous = read_progress(progress_path)
+        if previous:
+            old_params = dict(previous.get("search_params") or {})
+            old_params.pop("hotel_count", None)
+            new_params = {k: v for k, v in search_params.items() if k != "hotel_count"}
+            if old_params != new_params:
+                raise ValueError(
+                    f"{args.jsonl_output} was written with different search parameters; "
+                    "rerun without --resume or choose another --jsonl-output"
+                )
+            progress["created_at"] = previous.get("created_at", now)
+            previous_rows = (previous.get("progress") or {}).get("rows_written", 0)
+            progress["progress"]["rows_written"] = previous_rows
+        truncate_partial_line(args.jsonl_output)
+        completed = load_completed_records(args.jsonl_output)
+        results.update({key: completed[key] for key, _, _ in tasks if key in completed})
+        mode = "a"
+        print(f"Resuming: {len(results)}/{len(tasks)} requests already fetched")
+
+    remaining = [task for task in tasks if task[0] not in results]
+
+    def iter_remaining() -> Iterable[tuple[str, Mapping[str, Any] | None, dict[str, Any]]]:
+        for key, hotel_id, window in remaining:
+            payload = next(
+                iter_payloads(
+                    [hotel_id],
+                    mcode=args.mcode,
+                    event_id=args.event_id,
+                    best_only=args.best_only,
+                    language=args.language,
+                    config=window["config"] if window else config,
+                )
+            )
+            yield key, window, payload
+
+    raw_dir = getattr(args, "raw_dir", None)
+
+    def fetch(payload: Mapping[str, Any], key: str) -> tuple[dict[str, Any], dict[str, int], Exception | None]:
+        with slot() if slot else contextlib.nullcontext():
+            return fetch_hotel_record(
+                payload=payload,
+                args=args,
+                session=session,
+                scheduler=scheduler,
+                token_manager=token_manager,
+                cache=cache,
+                events=events,
+                raw_path=raw_dir / f"{key}.json" if raw_dir else None,
+            )
+
+    def checkpoint(status: str) -> None:
+        progress["progress"]["tasks_done"] = index
+        progress["status"] = status
+        progress["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        write_progress(progress_path, progress)
+
+    index = len(tasks) - len(remaining)
+    status = "interrupted"
+    if events:
+        events.emit(
+            "fetch_start",
+            tasks=len(tasks),
+            remaining=len(remaining),
+            concurrency=concurrency,
+            sweep_windows=len(windows) if windows else None,
+        )
+    with open_jsonl(args.jsonl_output, mode) as outfile, ThreadPoolExecutor(
+        max_workers=concurrency
+    ) as executor:
+        # Keep a bounded window of in-flight requests and drain it in input order so
+        # the JSONL and progress output match the serial run exactly.
+        pending: deque[tuple[str, Mapping[str, Any] | None, str, Future]] = deque()
+        if mode == "w":
+            for record in carried:
+                outfile.write(json.dumps(record) + "\n")
+
+        def drain_one() -> None:
+            nonlocal index
+            key, window, hotel_id, future = pending.popleft()
+            label = f"{hotel_id} lead {window['lead_days']}" if window else hotel_id
+            print(f"[{index + 1}/{len(tasks)}] {label}")
+            record, nightly, error = future.result()
+            if window:
+                record = {
+                    "hotel_id": hotel_id,
+                    "lead_days": window["lead_days"],
+                    "check_in": window["check_in"],
+                    "check_out": window["check_out"],
+                    **{k: v for k, v in record.items() if k != "hotel_id"},
+                }
+            if error is None:
+                results[key] = nightly
+            else:
+                results[key] = None
+                print(f"    [warn] {error}", file=sys.stderr)
+            outfile.write(json.dumps(record) + "\n")
+            index += 1
+            progress["progress"]["rows_written"] += 1
+            progress["progress"]["last_hotel_id"] = hotel_id
+            if window:
+                progress["progress"]["last_lead_days"] = window["lead_days"]
+            if events:
+                events.progress(index, len(tasks))
+            if index % PROGRESS_EVERY == 0:
+                outfile.flush()
+                checkpoint("running")
+
+        try:
+            checkpoint("running")
+            for key, window, payload in iter_remaining():
+                if cancel is not None and cancel.is_set():
+                    raise RunCancelled(f"Cancelled after {index}/{len(tasks)} requests")
+                # Carry the job's output routing (see _JobOutput) into the fetch thread.
+                future = executor.submit(contextvars.copy_context().run, fetch, payload, key)
+                pending.append((key, window, payload["hotel_id"], future))
+                if len(pending) >= concurrency * 2:
+                    drain_one()
+            while pending:
+                drain_one()
+            status = "completed"
+        finally:
+            for *_, future in pending:
+                future.cancel()
+            outfile.flush()
+            checkpoint(status)
+            if events:
+                events.emit("fetch_end", status=status, done=index, total=len(tasks))
+
+    print(f"Results written to {args.jsonl_output}")
+    # Under --jobs (`slot` set) the scheduler and caches are shared by every job, so
+    # their counters are batch totals; report_jobs prints them once at the end.
+    if scheduler and slot is None:
+        print(scheduler.summary())
+    if cache and slot is None:
+        print(cache.summary())
+
+    nightly_map: dict[str, dict[str, int]] = {}
+    sweep_rows: list[dict[str, object]] = []
+    for key, hotel_id, window in tasks:
+        nightly = results.get(key)
+        if nightly is None and failed is not None:
+            failed.add(hotel_id)
+        if window is None:
+            nightly_map[hotel_id] = nightly or {}
+            continue
+        merge_nightly_counts(nightly_map.setdefault(hotel_id, {}), nightly or {})
+        min_rooms = window_min_rooms(nightly, window) if nightly is not None else None
+        sweep_rows.append(
+            {
+                "hotel_id": hotel_id,
+                "lead_days": window["lead_days"],
+                "check_in": window["check_in"],
+                "check_out": window["check_out"],
+                "min_rooms": "" if min_rooms is None else min_rooms,
+                "status": "ok" if nightly is not None else "error",
+            }
+        )
+    sweep_csv = getattr(args, "sweep_csv_output", None)
+    if windows and sweep_csv:
+        write_sweep_csv(sweep_rows, sweep_csv)
+    return nightly_map
+
+
+class WarmResources:
+    """Session, token managers and response caches shared by --serve and --jobs runs.
+
+    A --jobs batch also sets `scheduler` (one request budget for every job) and
+    `slots` (the global in-flight cap), which runs then use instead of their own.
+    """
+
+    def __init__(self, pool_size: int = SERVE_POOL_SIZE) -> None:
+        self.session = configure_session(requests.Session(), pool_size)
+        self.scheduler: RequestScheduler | None = None
+        self.slots: FairSlots | None = None
+        self._lock = threading.Lock()
+        self._token_managers: dict[tuple[Any, ...], TokenManager] = {}
+        self._caches: dict[tuple[Any, ...], ResponseCache] = {}
+
+    def token_manager(self, **options: Any) -> tuple[TokenManager, bool]:
+        """Return (manager, reused) for these TokenManager options."""
+        key = tuple(sorted(options.items()))
+        with self._lock:
+            manager = self._token_managers.get(key)
+            if manager is not None:
+                return manager, True
+            manager = self._token_managers[key] = TokenManager(self.session, **options)
+        return manager, False
+
+    def response_cache(self, directory: Path, **options: Any) -> ResponseCache:
+        key = (directory, *sorted(options.items()))
+        with self._lock:
+            if key not in self._caches:
+                self._caches[key] = ResponseCache(directory, **options)
+            return self._caches[key]
+
+    def caches(self) -> list[ResponseCache]:
+        with self._lock:
+            return list(self._caches.values())
+
+
+class FairSlots:
+    """Global cap on in-flight searches across the jobs of a --jobs batch.
+
+    Free slots go round-robin to the jobs that have searches waiting, so a job with a
+    long hotel list cannot starve a short one; within a job, requests keep their order.
+    """
+
+    def __init__(self, slots: int) -> None:
+        self.free = slots
+        self._changed = threading.Condition()
+        self._waiting: dict[str, deque[object]] = {}
+        self._turns: deque[str] = deque()
+
+    def acquire(self, job: str) -> None:
+        ticket = object()
+        with self._changed:
+            queue = self._waiting.setdefault(job, deque())
+            if not queue:
+                self._turns.append(job)
+            queue.append(ticket)
+            while not (self.free and self._waiting[self._turns[0]][0] is ticket):
+                self._changed.wait()
+            queue.popleft()
+            self._turns.popleft()
+            if queue:
+                self._turns.append(job)
+            else:
+                del self._waiting[job]
+            self.free -= 1
+            self._changed.notify_all()
+
+    def release(self) -> None:
+        with self._changed:
+            self.free += 1
+            self._changed.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, job: str) -> Iterator[None]:
+        self.acquire(job)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def _redact_argv(argv: Sequence[str]) -> list[str]:
+    """Mask the values of --token/--auth-client-secret style arguments for logging."""
+    redacted: list[str] = []
+    hide_next = False
+    for arg in argv:
+        flag, has_value, _ = arg.partition("=")
+        secret = flag.startswith("--") and ("secret" in flag or flag == "--token")
+        if hide_next:
+            redacted.append("***")
+        elif secret and has_value:
+            redacted.append(f"{flag}=***")
+        else:
+            redacted.append(arg)
+        hide_next = secret and not has_value
+    return redacted
+
+
+class ServeJob(io.TextIOBase):
+    """One queued run of the --serve worker; also the text sink its output goes to."""
+
+    def __init__(self, argv: Sequence[str]) -> None:
+        super().__init__()
+        self.job_id = uuid.uuid4().hex[:12]
+        self.argv = list(argv)
+        self.status = "queued"
+        self.exit_code: int | None = None
+        self.created_at = datetime.now().isoformat(timespec="seconds")
+        self.cancel = threading.Event()
+        self._chunks: list[str] = []
+        self._done = False
+        self._changed = threading.Condition()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        with self._changed:
+            self._chunks.append(text)
+            self._changed.notify_all()
+        return len(text)
 
+    def finish(self, status: str, exit_code: int) -> None:
+        with self._changed:
+            self.status = status
+            self.exit_code = exit_code
+            self._done = True
+            self._changed.notify_all()
 
-def build_hotel_map_from_jsonl(path: Path) -> dict[str, dict[str, int]]:
-    hotel_map: dict[str, dict[str, int]] = {}
-    for record in read_jsonl(path):
-        hotel_id = str(record.get("hotel_id") or "").strip()
-        if not hotel_id:
-            continue
-        nightly = extract_hotel_nightly_counts(record.get("response") or {})
-        hotel_map[hotel_id] = nightly
-    return hotel_map
+    def follow(self) -> Iterator[str]:
+        """Yield the job's output from the start, blocking for more until it finishes."""
+        position = 0
+        while True:
+            with self._changed:
+                while position == len(self._chunks) and not self._done:
+                    self._changed.wait()
+                chunks = self._chunks[position:]
+                position += len(chunks)
+                done = self._done
+            if chunks:
+                yield "".join(chunks)
+            elif done:
+                return
 
+    def summary(self) -> dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "argv": _redact_argv(self.argv),
+            "status": self.status,
+            "exit_code": self.exit_code,
+            "created_at": self.created_at,
+        }
 
-def generate_outputs(
-    hotel_map: Mapping[str, Mapping[str, int]],
-    *,
-    csv_path: Path | None,
-    excel_path: Path | None,
-    png_path: Path | None,
-    png_size: tuple[int, int],
-    no_csv: bool,
-    no_excel: bool,
-    no_png: bool,
+
+class ServeWorker:
+    """Runs queued jobs one at a time in-process, reusing WarmResources between them.
+
+    Relative paths in a job resolve against `base_dir`, not the process cwd.
+    """
+
+    def __init__(self, resources: WarmResources, base_dir: Path) -> None:
+        self.resources = resources
+        self.base_dir = base_dir
+        self.jobs: dict[str, ServeJob] = {}
+        self._queue: deque[ServeJob] = deque()
+        self._lock = threading.Condition()
+        self.current: ServeJob | None = None
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name="roomberg-serve", daemon=True)
+        self._thread.start()
+
+    def submit(self, argv: Sequence[str]) -> ServeJob:
+        job = ServeJob(argv)
+        with self._lock:
+            self.jobs[job.job_id] = job
+            finished = [job_id for job_id, old in self.jobs.items() if old.exit_code is not None]
+            for job_id in finished[: max(0, len(finished) - SERVE_KEEP_JOBS)]:
+                del self.jobs[job_id]
+            self._queue.append(job)
+            position = len(self._queue) + (self.current is not None)
+            self._lock.notify()
+        if position > 1:
+            job.write(f"[queued] {position - 1} job(s) ahead\n")
+        return job
+
+    def list_jobs(self) -> list[ServeJob]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return len(self._queue)
+
+    def cancel(self, job: ServeJob) -> None:
+        job.cancel.set()
+        with self._lock:
+            if job in self._queue:
+                self._queue.remove(job)
+                job.write("[cancelled] before starting\n")
+                job.finish("cancelled", 130)
+
+    def stop(self) -> None:
+        """Cancel queued jobs and the running one, then wait for it to checkpoint."""
+        with self._lock:
+            self._stopping = True
+            for job in list(self._queue):
+                self.cancel(job)
+            if self.current:
+                self.current.cancel.set()
+            self._lock.notify()
+        self._thread.join()
+
+    def _loop(self) -> None:
+        while True:
+            with self._lock:
+                while not self._queue and not self._stopping:
+                    self._lock.wait()
+                if self._stopping:
+                    return
+                job = self.current = self._queue.popleft()
+            job.status = "running"
+            started = time.perf_counter()
+            argv = " ".join(_redact_argv(job.argv)) or "(defaults)"
+            print(f"[serve] job {job.job_id} started: {argv}")
+            status, exit_code = self._run(job)
+            job.write(f"\n[done] exit code {exit_code}\n")
+            job.finish(status, exit_code)
+            with self._lock:
+                self.current = None
+            print(
+                f"[serve] job {job.job_id} {status} (exit {exit_code}) "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+
+    def _run(self, job: ServeJob) -> tuple[str, int]:
+        # serve() routes sys.stdout/sys.stderr through _JobOutput, which sends this
+        # thread's (and its fetch threads') output to the job instead of the console.
+        sink = _job_sink.set(job)
+        try:
+            parser = build_parser()
+            args = parser.parse_args(job.argv)
+            check_serve_job_args(parser, args)
+            resolve_job_paths(parser, args, self.base_dir)
+            exit_code = execute(parser, args, resources=self.resources, cancel=job.cancel)
+        except RunCancelled as exc:
+            print(f"[cancelled] {exc}; rerun with --resume to continue", file=sys.stderr)
+            return "cancelled", 130
+        except SystemExit as exc:
+            exit_code = exc.code if isinstance(exc.code, int) else 1
+        except Exception as exc:  # keep the worker alive for the next job
+            print(f"[error] {type(exc).__name__}: {exc}", file=sys.stderr)
+            exit_code = 1
+        finally:
+            _job_sink.reset(sink)
+        return ("completed" if exit_code == 0 else "failed"), exit_code
+
+
+def _changed_options(
+    parser: argparse.ArgumentParser, args: argparse.Namespace, allowed: Iterable[str]
+) -> list[str]:
+    """Flags (or positional names) set away from their default, other than `allowed`."""
+    allowed = {*allowed, "help"}
+    return [
+        action.option_strings[0] if action.option_strings else action.dest
+        for action in parser._actions
+        if action.dest not in allowed and getattr(args, action.dest, None) != action.default
+    ]
+
+
+def check_serve_job_args(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Reject --serve job arguments outside SERVE_JOB_OPTIONS (via parser.error)."""
+    blocked = _changed_options(parser, args, SERVE_JOB_OPTIONS)
+    if args.heatmap_payload:
+        blocked.append("--heatmap-payload DIR")
+    if blocked:
+        parser.error(f"not allowed in a --serve job: {', '.join(blocked)}")
+
+
+def resolve_job_paths(
+    parser: argparse.ArgumentParser, args: argparse.Namespace, base_dir: Path
 ) -> None:
-    if not hotel_map:
-        print("No hotel data parsed; nothing to write.")
-        return
+    """Make every relative path argument absolute against `base_dir`, in place."""
+    for action in parser._actions:
+        value = getattr(args, action.dest, None)
+        if isinstance(value, Path) and not value.is_absolute():
+            setattr(args, action.dest, base_dir / value)
 
-    dates, rows = build_availability_rows(hotel_map)
-    if not no_csv and csv_path:
-        write_csv(rows, dates, csv_path)
-    if not no_excel and excel_path:
-        write_excel(rows, excel_path)
-    if not no_png and png_path:
-        write_png(rows, png_size, png_path)
 
+def make_serve_handler(worker: ServeWorker, token: str) -> type[BaseHTTPRequestHandler]:
+    class ServeHandler(BaseHTTPRequestHandler):
+        def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+            pass
 
-def fetch_bookings_availability(
+        def _authorized(self) -> bool:
+            supplied = self.headers.get(SERVE_TOKEN_HEADER) or ""
+            if hmac.compare_digest(supplied.encode("utf-8"), token.encode("utf-8")):
+                return True
+            self._send_json(401, {"error": f"missing or wrong {SERVE_TOKEN_HEADER} header"})
+            return False
+
+        def _send_json(self, status: int, body: Any) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, job: ServeJob, *, cancel_on_disconnect: bool) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("X-Job-Id", job.job_id)
+            self.end_headers()
+            try:
+                for text in job.follow():
+                    self.wfile.write(text.encode("utf-8"))
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                if cancel_on_disconnect:
+                    worker.cancel(job)
+
+        def _job(self, job_id: str) -> ServeJob | None:
+            job = worker.jobs.get(job_id)
+            if job is None:
+                self._send_json(404, {"error": f"unknown job {job_id}"})
+            return job
+
+        def do_GET(self) -> None:  # noqa: N802
+            if not self._authorized():
+                return
+            parts = self.path.split("?", 1)[0].strip("/").split("/")
+            if parts == ["health"]:
+                current = worker.current
+                self._send_json(
+                    200,
+                    {
+                        "status": "ok",
+                        "running": current.job_id if current else None,
+                        "queued": worker.queued,
+                    },
+                )
+            elif parts == ["runs"]:
+                self._send_json(200, [job.summary() for job in worker.list_jobs()])
+            elif len(parts) == 2 and parts[0] == "runs":
+                job = self._job(parts[1])
+                if job:
+                    self._send_json(200, job.summary())
+            elif len(parts) == 3 and parts[0] == "runs" and parts[2] == "log":
+                job = self._job(parts[1])
+                if job:
+                    self._stream(job, cancel_on_disconnect=False)
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self) -> None:  # noqa: N802
+            if not self._authorized():
+                return
+            path, _, query = self.path.partition("?")
+            parts = path.strip("/").split("/")
+            if parts == ["runs"]:
+                if self.headers.get_content_type() != "application/json":
+                    self._send_json(415, {"error": "POST /runs needs Content-Type: application/json"})
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                    argv = body.get("args") or []
+                    if not isinstance(argv, list):
+                        raise ValueError("args must be a list of CLI arguments")
+                except (ValueError, AttributeError) as exc:
+                    self._send_json(400, {"error": str(exc)})
+                    return
+                job = worker.submit([str(arg) for arg in argv])
+                if "wait=0" in query.split("&"):
+                    self._send_json(202, job.summary())
+                else:
+                    self._stream(job, cancel_on_disconnect=True)
+            elif len(parts) == 3 and parts[0] == "runs" and parts[2] == "cancel":
+                job = self._job(parts[1])
+                if job:
+                    worker.cancel(job)
+                    self._send_json(202, job.summary())
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    return ServeHandler
+
+
+def serve(
+    host: str,
+    port: int,
     *,
-    hotel_ids: Sequence[str],
-    config: list[dict[str, Any]] | None,
-    args: argparse.Namespace,
-    session: requests.Session,
-) -> dict[str, dict[str, int]]:
-    args.jsonl_output.parent.mkdir(parents=True, exist_ok=True)
-    nightly_map: dict[str, dict[str, int]] = {}
+    pool_size: int = SERVE_POOL_SIZE,
+    base_dir: Path | None = None,
+) -> int:
+    """Serve the CLI over HTTP with a warm session/token, running jobs one at a time.
 
-    with args.jsonl_output.open("w", encoding="utf-8") as outfile:
-        for index, payload in enumerate(
-            iter_payloads(
-                hotel_ids,
-                mcode=args.mcode,
-                event_id=args.event_id,
-                best_only=args.best_only,
-                language=args.language,
-                config=config,
-            ),
-            start=1,
-        ):
-            hotel_id = payload["hotel_id"]
-            print(f"[{index}/{len(hotel_ids)}] {hotel_id}")
+    POST /runs {"args": [...CLI args...]} queues a run and streams its output, ending
+    with "[done] exit code N" (?wait=0 returns the job id instead). GET /runs,
+    /runs/<id>, /runs/<id>/log and /health report on jobs; POST /runs/<id>/cancel or
+    dropping the streaming request cancels one.
+
+    Every request must send the SERVE_TOKEN_ENV secret in SERVE_TOKEN_HEADER, job
+    args are limited to SERVE_JOB_OPTIONS, and relative paths resolve against
+    `base_dir` (default: the repository root, like the web runner's spawned CLI).
+    """
+    token = os.getenv(SERVE_TOKEN_ENV)
+    if not token:
+        print(f"[error] set {SERVE_TOKEN_ENV} to a shared secret before --serve", file=sys.stderr)
+        return 2
+    base_dir = (base_dir or Path(__file__).parent).resolve()
+    worker = ServeWorker(WarmResources(pool_size), base_dir)
+    server = ThreadingHTTPServer((host, port), make_serve_handler(worker, token))
+    server.daemon_threads = True
+    print(f"Serving availability runs on http://{host}:{server.server_address[1]}")
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _JobOutput(stdout), _JobOutput(stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # Let the running job save its progress sidecar before the process exits.
+        worker.stop()
+        sys.stdout, sys.stderr = stdout, stderr
+    return 0
+
+
+# Where the current run's output goes: a --serve job's sink, or a --jobs name prefix.
+# Context variables (copied into fetch threads) rather than swapping sys.stdout per
+# run, so concurrent runs and the HTTP threads never write into each other's output.
+_job_sink: contextvars.ContextVar[IO[str] | None] = contextvars.ContextVar(
+    "roomberg_job_sink", default=None
+)
+_job_name: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "roomberg_job_name", default=None
+)
+
+
+class _JobOutput(io.TextIOBase):
+    """sys.stdout/sys.stderr stand-in routing run output by _job_sink/_job_name."""
+
+    def __init__(self, stream: IO[str]) -> None:
+        super().__init__()
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._partial = threading.local()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        sink = _job_sink.get()
+        if sink is not None:
+            return sink.write(text)
+        name = _job_name.get()
+        if name is None:
+            with self._lock:
+                return self.stream.write(text)
+        *lines, rest = (getattr(self._partial, "text", "") + text).split("\n")
+        self._partial.text = rest
+        if lines:
+            with self._lock:
+                self.stream.write("".join(f"[{name}] {line}\n" for line in lines))
+        return len(text)
+
+    def flush(self) -> None:
+        with self._lock:
+            self.stream.flush()
+
+
+def load_job_file(path: Path) -> list[tuple[str, dict[str, Any]]]:
+    """Read a --jobs file into (name, options) pairs.
+
+    The file is JSON, or TOML by extension: {"defaults": {...}, "jobs": [{...}, ...]}
+    (or just the job list). Options are CLI long option names with dashes or
+    underscores, e.g. {"event_id": "E1", "stay": ["2026-08-30:10"], "all_rates": true,
+    "jsonl_output": "out/e1.jsonl"}; each job's options override the defaults.
+    """
+    with path.open("rb") as handle:
+        if path.suffix.lower() == ".toml":
             try:
-                response = call_booking_search(
-                    session=session,
-                    url=args.url,
-                    token=args.token,
-                    payload=payload,
-                    timeout=args.timeout,
+                import tomllib
+            except ImportError:  # Python < 3.11
+                tomllib = _import_optional("tomli", "TOML job files")
+            data = tomllib.load(handle)
+        else:
+            data = json.load(handle)
+    defaults: Mapping[str, Any] = {}
+    jobs = data
+    if isinstance(data, Mapping):
+        defaults, jobs = data.get("defaults") or {}, data.get("jobs")
+    if not isinstance(defaults, Mapping) or not isinstance(jobs, list) or not jobs:
+        raise ValueError(f"{path} needs a non-empty 'jobs' list")
+    specs: list[tuple[str, dict[str, Any]]] = []
+    for number, job in enumerate(jobs, start=1):
+        if not isinstance(job, Mapping):
+            raise ValueError(f"Job {number} in {path} is not a table/object")
+        options = {**defaults, **job}
+        name = str(options.pop("name", None) or f"job{number}")
+        if name in (existing for existing, _ in specs):
+            raise ValueError(f"Duplicate job name '{name}' in {path}")
+        specs.append((name, options))
+    return specs
+
+
+def job_argv(parser: argparse.ArgumentParser, options: Mapping[str, Any]) -> list[str]:
+    """Turn one job's options into CLI arguments for `parser`."""
+    argv: list[str] = []
+    positional: list[str] = []
+    for key, value in options.items():
+        if key == "csv_path":
+            positional.append(str(value))
+            continue
+        flag = "--" + key.replace("_", "-")
+        action = parser._option_string_actions.get(flag)
+        if action is None:
+            raise ValueError(f"Unknown job option '{key}'")
+        if value is None or value is False:
+            continue
+        if value is True:
+            argv.append(flag)
+        elif isinstance(value, list) and action.nargs not in (None, "?"):
+            argv += [flag, *(str(item) for item in value)]
+        elif isinstance(value, list):
+            for item in value:
+                argv += [flag, str(item)]
+        else:
+            argv += [flag, str(value)]
+    return argv + positional
+
+
+# Rendered outputs a job writes next to its JSONL unless it names them itself
+JOB_OUTPUT_SUFFIXES = {
+    "csv_output": ".csv",
+    "excel_output": ".xlsx",
+    "png_output": ".png",
+    "sweep_csv_output": ".sweep.csv",
+}
+
+
+def job_outputs(args: argparse.Namespace) -> dict[Path, str]:
+    """Every file or directory a run with `args` writes, resolved, mapped to its flag."""
+    outputs = {args.jsonl_output: "--jsonl-output"}
+    if not args.no_csv:
+        outputs[args.csv_output] = "--csv-output"
+    if not args.no_excel:
+        outputs[args.excel_output] = "--excel-output"
+    if not args.no_png:
+        outputs[args.png_output] = "--png-output"
+        if args.png_tiles:
+            outputs[args.png_tiles] = "--png-tiles"
+    if args.sweep:
+        outputs[args.sweep_csv_output] = "--sweep-csv-output"
+    if args.heatmap_payload is not None:
+        outputs[Path(args.heatmap_payload or args.csv_output.parent / HEATMAP_DIRNAME)] = (
+            "--heatmap-payload"
+        )
+    for dest in (
+        "parquet_output",
+        "feasibility_output",
+        "raw_dir",
+        "events_output",
+        "metrics_textfile",
+    ):
+        path = getattr(args, dest)
+        if path:
+            outputs[Path(path)] = "--" + dest.replace("_", "-")
+    return {path.resolve(): flag for path, flag in outputs.items()}
+
+
+def run_jobs(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
+    """Run a --jobs file: all jobs at once, sharing one session, token and budget.
+
+    Every job is parsed and validated before any starts. A job that sets its own
+    --jsonl-output but not the CSV/Excel/PNG/sweep outputs writes those next to it
+    (see JOB_OUTPUT_SUFFIXES), and two jobs writing the same path is an error. Jobs
+    get the batch --concurrency unless they set their own (which then caps just that
+    job), and their output is prefixed with the job name. Returns the worst job exit
+    code.
+    """
+    try:
+        specs = load_job_file(args.jobs)
+        argvs = [(name, job_argv(parser, options)) for name, options in specs]
+    except (OSError, ValueError) as exc:
+        print(f"[error] {exc}", file=sys.stderr)
+        return 2
+    jobs: list[tuple[str, argparse.Namespace]] = []
+    outputs: dict[Path, tuple[str, str]] = {}
+    for (name, argv), (_, options) in zip(argvs, specs):
+        try:
+            job_args = parser.parse_args(argv)
+        except SystemExit:
+            print(f"[error] job '{name}' has invalid options (see above)", file=sys.stderr)
+            return 2
+        if job_args.serve or job_args.jobs:
+            print(f"[error] job '{name}': --serve and --jobs cannot be nested", file=sys.stderr)
+            return 2
+        if job_args.jsonl_output != parser.get_default("jsonl_output"):
+            for dest, suffix in JOB_OUTPUT_SUFFIXES.items():
+                if getattr(job_args, dest) == parser.get_default(dest):
+                    setattr(job_args, dest, _sidecar_path(job_args.jsonl_output, suffix))
+        for output, flag in job_outputs(job_args).items():
+            if output in outputs:
+                other, other_flag = outputs[output]
+                print(
+                    f"[error] jobs '{other}' ({other_flag}) and '{name}' ({flag}) both "
+                    f"write {output}",
+                    file=sys.stderr,
                 )
-                record: dict[str, Any] = {"hotel_id": hotel_id, "response": response}
-                nightly_map[hotel_id] = extract_hotel_nightly_counts(response)
-            except Exception as exc:
-                record = {"hotel_id": hotel_id, "error": str(exc)}
-                nightly_map.setdefault(hotel_id, {})
-                print(f"    [warn] {exc}", file=sys.stderr)
+                return 2
+            outputs[output] = (name, flag)
+        if "concurrency" not in options:
+            job_args.concurrency = args.concurrency
+        job_args.job_name = name
+        jobs.append((name, job_args))
 
-            outfile.write(json.dumps(record) + "\n")
+    resources = WarmResources(max(args.concurrency, SERVE_POOL_SIZE))
+    resources.scheduler = RequestScheduler(
+        rate=args.rate,
+        max_rate=args.max_rate,
+        min_rate=scheduler_floor(args.concurrency),
+        max_retries=max(0, args.max_retries),
+    )
+    resources.slots = FairSlots(args.concurrency)
+    cancel = threading.Event()
+    results: dict[str, dict[str, Any]] = {}
+    print(
+        f"Running {len(jobs)} jobs from {args.jobs} with {args.concurrency} searches in flight "
+        f"and a {args.max_rate:g} req/s budget"
+    )
 
-    print(f"Results written to {args.jsonl_output}")
-    return nightly_map
+    def run_job(name: str, job_args: argparse.Namespace) -> None:
+        _job_name.set(name)
+        result: dict[str, Any] = {"name": name, "summary": None}
+        started = time.perf_counter()
+        try:
+            exit_code = execute(
+                parser,
+                job_args,
+                resources=resources,
+                cancel=cancel,
+                on_summary=lambda summary: result.update(summary=summary),
+            )
+        except RunCancelled as exc:
+            print(f"[cancelled] {exc}; rerun with --resume to continue", file=sys.stderr)
+            exit_code = 130
+        except SystemExit as exc:
+            exit_code = exc.code if isinstance(exc.code, int) else 1
+        except Exception as exc:  # one failing job must not take the batch down
+            print(f"[error] {type(exc).__name__}: {exc}", file=sys.stderr)
+            exit_code = 1
+        print(f"[done] exit code {exit_code}")
+        _job_name.set(None)
+        result.update(exit_code=exit_code, elapsed_seconds=round(time.perf_counter() - started, 3))
+        results[name] = result
 
+    started = time.perf_counter()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _JobOutput(stdout), _JobOutput(stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="roomberg-job") as pool:
+            futures = [pool.submit(run_job, name, job_args) for name, job_args in jobs]
+            try:
+                wait(futures)
+            except BaseException:
+                # Let every job checkpoint its progress sidecar before exiting.
+                cancel.set()
+                wait(futures)
+                raise
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    elapsed = time.perf_counter() - started
+    return report_jobs([results[name] for name, _ in jobs], elapsed, resources, args.jobs_summary)
 
-def main(argv: Sequence[str] | None = None) -> int:
-    load_dotenv()
 
+def report_jobs(
+    results: Sequence[Mapping[str, Any]],
+    elapsed: float,
+    resources: WarmResources,
+    summary_path: Path | None,
+) -> int:
+    """Print the merged --jobs summary (and write it as JSON); returns the worst exit code."""
+    serial = sum(result["elapsed_seconds"] for result in results)
+    requests_total = sum((result["summary"] or {}).get("requests", 0) for result in results)
+    print(
+        f"\nBatch: {len(results)} jobs in {elapsed:.1f}s "
+        f"(jobs summed {serial:.1f}s, {serial / elapsed if elapsed else 0:.1f}x), "
+        f"{requests_total} searches, {requests_total / elapsed if elapsed else 0:.1f} req/s"
+    )
+    width = max(len(result["name"]) for result in results)
+    for result in results:
+        summary = result["summary"] or {}
+        latency = summary.get("latency_ms") or {}
+        status = "ok" if result["exit_code"] == 0 else f"exit {result['exit_code']}"
+        print(
+            f"  {result['name']:<{width}}  {status:<8} {result['elapsed_seconds']:7.1f}s  "
+            f"{summary.get('requests', 0)} searches ({summary.get('cached', 0)} cached, "
+            f"{summary.get('errors', 0)} errors, {summary.get('retries', 0)} retries)"
+            + (f", p50 {latency['p50']} ms, p95 {latency['p95']} ms" if latency else "")
+        )
+    print(resources.scheduler.summary())
+    for cache in resources.caches():
+        print(cache.summary())
+    if summary_path:
+        summary_path.parent.mkdir(parents=True, exist_ok=True)
+        write_progress(
+            summary_path,
+            {
+                "version": 1,
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "elapsed_seconds": round(elapsed, 3),
+                "jobs_elapsed_seconds": round(serial, 3),
+                "requests": requests_total,
+                "scheduler": {**resources.scheduler.stats, "final_rate": resources.scheduler.rate},
+                "jobs": list(results),
+            },
+        )
+        print(f"Wrote batch summary to {summary_path}")
+    return max(result["exit_code"] for result in results)
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description=(
             "Fetch Kuoni HotelMap bookings availability for a list of hotels and "
@@ -419,6 +4385,44 @@ def main(argv: Sequence[str] | None = None) -> int:
             f"(default: {DEFAULT_HOTEL_COLUMN})"
         ),
     )
+    parser.add_argument(
+        "--near",
+        type=parse_point,
+        default=None,
+        metavar="LAT,LON",
+        help="Only fetch hotels within --radius-km of this point",
+    )
+    parser.add_argument(
+        "--near-pricing",
+        type=Path,
+        default=None,
+        metavar="PROGRESS_JSON",
+        help=(
+            "Like --near, using the reference point (and radius, unless --radius-km is "
+            "given) of a pricing batch's progress file"
+        ),
+    )
+    parser.add_argument(
+        "--radius-km",
+        type=float,
+        default=None,
+        help=f"Radius for --near/--near-pricing (default: {DEFAULT_RADIUS_KM:g})",
+    )
+    parser.add_argument(
+        "--city",
+        action="append",
+        default=None,
+        help="Only fetch hotels in this city (case-insensitive; repeatable)",
+    )
+    parser.add_argument(
+        "--min-stars", type=float, default=None, help="Only fetch hotels with at least these stars"
+    )
+    parser.add_argument(
+        "--min-rooms",
+        type=int,
+        default=None,
+        help="Only fetch hotels with at least this many rooms (number_of_rooms)",
+    )
     parser.add_argument(
         "--stay",
         action="append",
@@ -429,6 +4433,60 @@ def main(argv: Sequence[str] | None = None) -> int:
             f"Repeat for multiple dates. Defaults to {DEFAULT_STAY_ARGS or 'none'}."
         ),
     )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help=(
+            "Query every hotel for a grid of stay windows (one per lead time) instead of "
+            "the --stay dates, and write one batch tagged with lead_days"
+        ),
+    )
+    parser.add_argument(
+        "--start-date",
+        type=date.fromisoformat,
+        default=None,
+        metavar="YYYY-MM-DD",
+        help="Sweep reference date that lead times count from (default: today)",
+    )
+    parser.add_argument(
+        "--lead-start",
+        type=int,
+        default=DEFAULT_LEAD_START,
+        help=f"First sweep lead time in days (default: {DEFAULT_LEAD_START})",
+    )
+    parser.add_argument(
+        "--lead-end",
+        type=int,
+        default=DEFAULT_LEAD_END,
+        help=f"Last sweep lead time in days (default: {DEFAULT_LEAD_END})",
+    )
+    parser.add_argument(
+        "--lead-step",
+        type=int,
+        default=DEFAULT_LEAD_STEP,
+        help=f"Days between sweep check-ins (default: {DEFAULT_LEAD_STEP})",
+    )
+    parser.add_argument(
+        "--stay-length",
+        type=int,
+        default=DEFAULT_STAY_LENGTH,
+        help=f"Nights per sweep window (default: {DEFAULT_STAY_LENGTH})",
+    )
+    parser.add_argument(
+        "--rooms",
+        type=int,
+        default=DEFAULT_SWEEP_ROOMS,
+        help=f"Rooms requested per night in sweep windows (default: {DEFAULT_SWEEP_ROOMS})",
+    )
+    parser.add_argument(
+        "--sweep-csv-output",
+        type=Path,
+        default=DEFAULT_SWEEP_CSV,
+        help=(
+            "Long-format CSV with one row per hotel and sweep window "
+            f"(default: {DEFAULT_SWEEP_CSV})"
+        ),
+    )
     parser.add_argument("--mcode", default=DEFAULT_MCODE, help="MCode for the booking request")
     parser.add_argument("--event-id", default=DEFAULT_EVENT_ID, help="Event ID for the booking request")
     parser.add_argument(
@@ -449,53 +4507,224 @@ def main(argv: Sequence[str] | None = None) -> int:
         help=f"Override bookings search URL (default: {DEFAULT_URL})",
     )
     parser.add_argument(
-        "--token",
-        default=os.getenv("KUONI_BOOKINGS_TOKEN") or os.getenv("KUONI_BEARER_TOKEN"),
-        help="Bearer token for Authorization header (or set KUONI_BOOKINGS_TOKEN)",
+        "--token",
+        default=os.getenv("KUONI_BOOKINGS_TOKEN") or os.getenv("KUONI_BEARER_TOKEN"),
+        help="Bearer token for Authorization header (or set KUONI_BOOKINGS_TOKEN)",
+    )
+    parser.add_argument(
+        "--auth-url",
+        default=DEFAULT_AUTH_URL,
+        help=f"Auth token URL for client credentials flow (default: {DEFAULT_AUTH_URL})",
+    )
+    parser.add_argument(
+        "--auth-client-id",
+        default=DEFAULT_AUTH_CLIENT_ID,
+        help="Client ID for auth token fetch (default: env KUONI_AUTH_CLIENT_ID)",
+    )
+    parser.add_argument(
+        "--auth-client-secret",
+        default=DEFAULT_AUTH_CLIENT_SECRET,
+        help="Client secret for auth token fetch (default: env KUONI_AUTH_CLIENT_SECRET)",
+    )
+    parser.add_argument(
+        "--auth-audience",
+        default=DEFAULT_AUTH_AUDIENCE,
+        help=f"Audience for auth token fetch (default: {DEFAULT_AUTH_AUDIENCE})",
+    )
+    parser.add_argument(
+        "--auth-grant-type",
+        default=DEFAULT_AUTH_GRANT_TYPE,
+        help=f"Grant type for auth token fetch (default: {DEFAULT_AUTH_GRANT_TYPE})",
+    )
+    parser.add_argument(
+        "--token-cache",
+        type=Path,
+        default=DEFAULT_TOKEN_CACHE,
+        help=(
+            "File caching client-credential tokens until they expire "
+            f"(default: {DEFAULT_TOKEN_CACHE}, or env KUONI_TOKEN_CACHE)"
+        ),
+    )
+    parser.add_argument(
+        "--no-token-cache",
+        action="store_true",
+        help="Always fetch a fresh bearer token instead of using the on-disk cache",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=(
+            "Reuse booking search responses cached within --cache-ttl instead of querying "
+            "the API again (off by default so results are always live)"
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=DEFAULT_CACHE_DIR,
+        help=(
+            "Directory caching booking search responses by payload hash "
+            f"(default: {DEFAULT_CACHE_DIR}, or env KUONI_CACHE_DIR)"
+        ),
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help=(
+            "Seconds a cached response stays fresh; implies --cache "
+            f"(default: {DEFAULT_CACHE_TTL:g})"
+        ),
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=DEFAULT_CACHE_MAX_MB,
+        help=(
+            "Evict least recently used cache entries beyond this size "
+            f"(default: {DEFAULT_CACHE_MAX_MB})"
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always query the API and leave the response cache untouched (overrides --cache)",
+    )
+    parser.add_argument(
+        "--jsonl-output",
+        "--output",
+        dest="jsonl_output",
+        type=Path,
+        default=DEFAULT_JSONL,
+        help=(
+            "Path to write newline-delimited JSON results; a .gz or .zst suffix "
+            f"compresses it (default: {DEFAULT_JSONL})"
+        ),
+    )
+    parser.add_argument(
+        "--slim",
+        action="store_true",
+        help=(
+            "Store only hotel_id, status and the extracted nightly counts per JSONL "
+            "record instead of the full API response"
+        ),
+    )
+    parser.add_argument(
+        "--stream-extract",
+        action="store_true",
+        help=(
+            "Parse each response incrementally and keep only its nightly counts (needs "
+            "ijson); records are written slim. Recommended with --all-rates, whose "
+            "responses carry every rate and room"
+        ),
+    )
+    parser.add_argument(
+        "--raw-dir",
+        type=Path,
+        default=None,
+        help=(
+            "Also save each response body byte-for-byte as DIR/<hotel_id>.json "
+            "(implies --stream-extract)"
+        ),
+    )
+    parser.add_argument(
+        "--jsonl-input",
+        type=Path,
+        default=None,
+        help="Existing JSONL file to read when using --convert-only (defaults to --jsonl-output)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Append to an existing --jsonl-output, reusing successful records and "
+            "refetching only missing or errored hotels (progress kept in *.progress.json)"
+        ),
     )
     parser.add_argument(
-        "--auth-url",
-        default=DEFAULT_AUTH_URL,
-        help=f"Auth token URL for client credentials flow (default: {DEFAULT_AUTH_URL})",
+        "--refresh-budget",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            "Fetch at most N hotels, chosen by observed change rate, closeness to the "
+            "--stay room counts and age, and carry the rest forward from the previous "
+            "--jsonl-output with their age (state kept in *.refresh.json)"
+        ),
     )
     parser.add_argument(
-        "--auth-client-id",
-        default=DEFAULT_AUTH_CLIENT_ID,
-        help="Client ID for auth token fetch (default: env KUONI_AUTH_CLIENT_ID)",
+        "--refresh-max-age",
+        type=float,
+        default=DEFAULT_REFRESH_MAX_AGE_HOURS,
+        metavar="HOURS",
+        help=(
+            "With --refresh-budget, refetch hotels older than this ahead of scored ones "
+            f"(default: {DEFAULT_REFRESH_MAX_AGE_HOURS:g})"
+        ),
     )
     parser.add_argument(
-        "--auth-client-secret",
-        default=DEFAULT_AUTH_CLIENT_SECRET,
-        help="Client secret for auth token fetch (default: env KUONI_AUTH_CLIENT_SECRET)",
+        "--shard",
+        type=parse_shard,
+        default=None,
+        metavar="K/N",
+        help=(
+            "Fetch only the hotels that hash to shard K of N and write "
+            "*.shard-K-of-N JSONL/sweep outputs; render later with --merge-shards N"
+        ),
     )
     parser.add_argument(
-        "--auth-audience",
-        default=DEFAULT_AUTH_AUDIENCE,
-        help=f"Audience for auth token fetch (default: {DEFAULT_AUTH_AUDIENCE})",
+        "--merge-shards",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            "Skip API calls and render outputs from all N shard JSONLs of --jsonl-output, "
+            "failing if any shard is missing"
+        ),
     )
     parser.add_argument(
-        "--auth-grant-type",
-        default=DEFAULT_AUTH_GRANT_TYPE,
-        help=f"Grant type for auth token fetch (default: {DEFAULT_AUTH_GRANT_TYPE})",
+        "--convert-only",
+        action="store_true",
+        help="Skip API calls and only render outputs from the JSONL input file.",
     )
     parser.add_argument(
-        "--jsonl-output",
-        "--output",
-        dest="jsonl_output",
+        "--pricing-input",
         type=Path,
-        default=DEFAULT_JSONL,
-        help=f"Path to write newline-delimited JSON results (default: {DEFAULT_JSONL})",
+        default=None,
+        metavar="CSV",
+        help=(
+            "Skip API calls and convert a pricing batch (output_sheets/<batch>/"
+            "pricing_hotels_all.csv) into typed Parquet columns, then exit"
+        ),
     )
     parser.add_argument(
-        "--jsonl-input",
+        "--pricing-output",
         type=Path,
         default=None,
-        help="Existing JSONL file to read when using --convert-only (defaults to --jsonl-output)",
+        help="Parquet path for --pricing-input (default: the CSV path with a .parquet suffix)",
     )
     parser.add_argument(
-        "--convert-only",
+        "--chunk-rows",
+        type=int,
+        default=PRICING_CHUNK_ROWS,
+        help=f"CSV rows parsed per chunk with --pricing-input (default: {PRICING_CHUNK_ROWS})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Processes used to parse large JSONL inputs with --convert-only "
+            "(default: 1, i.e. serial)"
+        ),
+    )
+    parser.add_argument(
+        "--no-index",
         action="store_true",
-        help="Skip API calls and only render outputs from the JSONL input file.",
+        help=(
+            "With --convert-only, re-read the whole JSONL instead of parsing only what "
+            "was appended since the last run (tracked in *.index.json)"
+        ),
     )
     parser.add_argument(
         "--csv-output",
@@ -536,23 +4765,341 @@ def main(argv: Sequence[str] | None = None) -> int:
         default=DEFAULT_PNG_SIZE,
         help="PNG dimensions in pixels (default: 520 700)",
     )
+    parser.add_argument(
+        "--png-mode",
+        choices=PNG_MODES,
+        default="binary",
+        help=(
+            "'binary' colours any availability green; 'graded' ramps from red to amber "
+            "below --png-rooms-required and greys out missing nights (default: binary)"
+        ),
+    )
+    parser.add_argument(
+        "--png-rooms-required",
+        type=int,
+        default=DEFAULT_ROOMS_REQUIRED,
+        help=f"Rooms needed for a green cell in graded mode (default: {DEFAULT_ROOMS_REQUIRED})",
+    )
+    parser.add_argument(
+        "--png-cell",
+        nargs=2,
+        type=int,
+        metavar=("WIDTH", "HEIGHT"),
+        default=None,
+        help="Render each grid cell as WIDTH x HEIGHT pixels instead of resizing to --png-size",
+    )
+    parser.add_argument(
+        "--png-tiles",
+        type=Path,
+        default=None,
+        metavar="DIR",
+        help="Also write a PNG tile pyramid with a tiles.json manifest to DIR",
+    )
+    parser.add_argument(
+        "--png-tile-size",
+        type=int,
+        default=DEFAULT_TILE_SIZE,
+        help=f"Tile edge in pixels for --png-tiles (default: {DEFAULT_TILE_SIZE})",
+    )
     parser.add_argument(
         "--no-png",
         action="store_true",
         help="Skip writing the PNG heatmap",
     )
+    parser.add_argument(
+        "--parquet-output",
+        type=Path,
+        default=None,
+        help="Also write the grid as a Parquet file (needs pyarrow; off by default)",
+    )
+    parser.add_argument(
+        "--parquet-layout",
+        choices=PARQUET_LAYOUTS,
+        default="long",
+        help=(
+            "Parquet shape: 'long' rows of hotel_id/date/rooms/coverage, or 'wide' "
+            "with one column per date like the CSV (default: long)"
+        ),
+    )
+    parser.add_argument(
+        "--heatmap-payload",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="DIR",
+        help=(
+            "Also write the precomputed grid, lookups and rollups the web availability "
+            f"heatmap serves (default DIR: {HEATMAP_DIRNAME}/ next to --csv-output, the only "
+            "place the web view looks; it falls back to the CSV once that is rewritten)"
+        ),
+    )
+    parser.add_argument(
+        "--feasibility-output",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help=(
+            "Write per hotel and check-in date whether each stay profile fits (CSV); "
+            "profiles come from --feasibility and --stay"
+        ),
+    )
+    parser.add_argument(
+        "--feasibility",
+        action="append",
+        type=parse_stay_profile,
+        default=None,
+        metavar="PROFILE",
+        help=(
+            "Stay profile to test: ROOMSxNIGHTS (10x3) or rooms per night (10,10,8). "
+            "Repeatable; defaults to "
+            f"{stay_profile_label(DEFAULT_STAY_PROFILE)} when no --stay is given either"
+        ),
+    )
+    parser.add_argument(
+        "--history-db",
+        type=Path,
+        default=DEFAULT_HISTORY_DB,
+        metavar="PATH",
+        help=(
+            "Append each run's hotel x date counts to this SQLite history "
+            "(default: env KUONI_HISTORY_DB, off when unset)"
+        ),
+    )
+    parser.add_argument(
+        "--history-query",
+        choices=HISTORY_QUERIES,
+        default=None,
+        help=(
+            "Query --history-db and print CSV instead of fetching: 'runs' lists recent "
+            "runs, 'series' a hotel's counts per run, 'diff' cells changed between two runs"
+        ),
+    )
+    parser.add_argument(
+        "--history-hotel",
+        default=None,
+        metavar="HOTEL_ID",
+        help="Hotel for the series query (also filters diff)",
+    )
+    parser.add_argument(
+        "--history-date",
+        default=None,
+        metavar="YYYY-MM-DD",
+        help="Restrict the series query to one night",
+    )
+    parser.add_argument(
+        "--history-limit",
+        type=int,
+        default=DEFAULT_HISTORY_RUNS,
+        help=f"Most recent runs covered by runs/series (default: {DEFAULT_HISTORY_RUNS})",
+    )
+    parser.add_argument(
+        "--history-runs",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("BEFORE", "AFTER"),
+        help="Run ids to diff (default: the two most recent runs)",
+    )
     parser.add_argument(
         "--timeout",
         type=float,
         default=30.0,
         help="HTTP timeout in seconds (default: 30)",
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        metavar="N",
+        help=(
+            "Number of booking searches to run in parallel "
+            f"(default: {DEFAULT_CONCURRENCY}, or env KUONI_BOOKINGS_CONCURRENCY)"
+        ),
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=DEFAULT_MAX_RETRIES,
+        help=(
+            "Retries per hotel for timeouts, 429 and 5xx responses, with jittered "
+            f"exponential backoff (default: {DEFAULT_MAX_RETRIES})"
+        ),
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help=(
+            "Initial request rate in requests/second; halves on throttling (429/503), "
+            "down to one request/s per --concurrency worker, and adapts back up on "
+            "success (default: --max-rate)"
+        ),
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=DEFAULT_MAX_RATE,
+        help=f"Upper bound for the adaptive request rate (default: {DEFAULT_MAX_RATE})",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help=(
+            "Run as a long-lived local worker: POST /runs with {\"args\": [...]} queues a "
+            "run with a warm session and token and streams its output"
+        ),
+    )
+    parser.add_argument(
+        "--serve-host",
+        default=DEFAULT_SERVE_HOST,
+        help=f"Bind address for --serve (default: {DEFAULT_SERVE_HOST})",
+    )
+    parser.add_argument(
+        "--serve-port",
+        type=int,
+        default=DEFAULT_SERVE_PORT,
+        help=f"Port for --serve (default: {DEFAULT_SERVE_PORT}, or env ROOMBERG_SERVE_PORT)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=Path,
+        default=None,
+        metavar="FILE",
+        help=(
+            "Run every job of a JSON/TOML job file concurrently in this process with one "
+            "token, connection pool and request budget (--rate/--max-rate); --concurrency "
+            "caps in-flight searches across all jobs, shared round-robin"
+        ),
+    )
+    parser.add_argument(
+        "--jobs-summary",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help="Also write the merged --jobs summary as JSON",
+    )
+    parser.add_argument(
+        "--events",
+        choices=EVENT_FORMATS,
+        default=None,
+        help=(
+            "Emit machine-readable run events (per-request latency/bytes/status/retries, "
+            "phase timings, throughput/ETA and a closing summary), one JSON object per "
+            "line, to stdout or --events-output"
+        ),
+    )
+    parser.add_argument(
+        "--events-output",
+        type=Path,
+        default=None,
+        help="Write --events to this file instead of interleaving them with stdout",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help=(
+            "Write run metrics in Prometheus text format to PATH (e.g. a *.prom file "
+            "in the node_exporter textfile collector directory)"
+        ),
+    )
 
+    return parser
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    load_dotenv()
+
+    parser = build_parser()
     args = parser.parse_args(argv)
+    if args.serve:
+        # Jobs bring their own options; credentials and endpoints come from the
+        # KUONI_* environment, so anything else here would be silently ignored.
+        ignored = _changed_options(parser, args, {"serve", "serve_host", "serve_port"})
+        if ignored:
+            parser.error(
+                f"--serve only takes --serve-host/--serve-port, not {', '.join(ignored)}; "
+                "pass run options per job and credentials via the KUONI_* environment"
+            )
+        return serve(args.serve_host, args.serve_port)
+    if args.jobs:
+        return run_jobs(parser, args)
+    return execute(parser, args)
+
+
+def execute(
+    parser: argparse.ArgumentParser,
+    args: argparse.Namespace,
+    *,
+    resources: WarmResources | None = None,
+    cancel: threading.Event | None = None,
+    on_summary: Callable[[dict[str, Any]], None] | None = None,
+) -> int:
+    """Run parsed CLI args with their --events/--metrics-textfile reporting."""
+    events_stream: IO[str] | None = None
+    if args.events_output:
+        args.events_output.parent.mkdir(parents=True, exist_ok=True)
+        events_stream = args.events_output.open("w", encoding="utf-8")
+    elif args.events:
+        events_stream = sys.stdout
+    events = RunEvents(events_stream)
+    try:
+        return run(parser, args, events, resources=resources, cancel=cancel)
+    finally:
+        summary = events.summary()
+        if on_summary:
+            on_summary(summary)
+        if args.metrics_textfile:
+            try:
+                events.write_textfile(args.metrics_textfile)
+            except OSError as exc:
+                print(
+                    f"[warn] Could not write metrics to {args.metrics_textfile}: {exc}",
+                    file=sys.stderr,
+                )
+        if args.events_output:
+            events_stream.close()
+
+
+def run(
+    parser: argparse.ArgumentParser,
+    args: argparse.Namespace,
+    events: RunEvents,
+    *,
+    resources: WarmResources | None = None,
+    cancel: threading.Event | None = None,
+) -> int:
+    """Fetch (or convert) and render outputs for parsed CLI args; returns the exit code.
 
+    With `resources` (the --serve worker) the HTTP session, token managers and
+    response caches are shared with earlier runs instead of being built afresh.
+    """
     hotel_map: dict[str, dict[str, int]] = {}
     jsonl_input = args.jsonl_input or args.jsonl_output
-    session = requests.Session()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if (args.rate is not None and args.rate <= 0) or args.max_rate <= 0:
+        parser.error("--rate and --max-rate must be positive")
+    if args.png_cell and min(args.png_cell) < 1:
+        parser.error("--png-cell WIDTH and HEIGHT must be at least 1")
+    if args.png_tile_size < 1:
+        parser.error("--png-tile-size must be at least 1")
+    if args.raw_dir:
+        args.stream_extract = True
+    profiles = list(args.feasibility or [])
+    stay_args = args.stay if args.stay is not None else DEFAULT_STAY_ARGS
+    if args.feasibility_output and stay_args and not args.sweep:
+        try:
+            profiles.append(stay_profile(parse_stays(stay_args)))
+        except ValueError as exc:
+            print(f"[error] {exc}", file=sys.stderr)
+            return 1
+    profiles = profiles or [DEFAULT_STAY_PROFILE]
+    if resources:
+        session = resources.session
+    else:
+        session = configure_session(requests.Session(), args.concurrency)
 
     # Late-bind auth defaults so .env values (loaded above) are honored even though
     # module-level constants may have been initialised before load_dotenv().
@@ -562,52 +5109,280 @@ def main(argv: Sequence[str] | None = None) -> int:
     args.auth_grant_type = args.auth_grant_type or os.getenv("KUONI_AUTH_GRANT_TYPE", DEFAULT_AUTH_GRANT_TYPE)
     args.auth_url = args.auth_url or os.getenv("KUONI_AUTH_URL", DEFAULT_AUTH_URL)
 
-    if args.convert_only:
+    if args.history_query:
+        if not args.history_db or not args.history_db.exists():
+            print(f"[error] History database {args.history_db} not found", file=sys.stderr)
+            return 1
+        try:
+            query_history(
+                args.history_db,
+                args.history_query,
+                hotel_id=args.history_hotel,
+                date_key=args.history_date,
+                limit=args.history_limit,
+                run_ids=args.history_runs,
+            )
+        except (sqlite3.Error, ValueError) as exc:
+            print(f"[error] {exc}", file=sys.stderr)
+            return 1
+        return 0
+
+    if args.pricing_input:
+        if not args.pricing_input.exists():
+            print(f"[error] Pricing input {args.pricing_input} not found", file=sys.stderr)
+            return 1
+        try:
+            with events.phase("pricing"):
+                write_pricing_parquet(
+                    args.pricing_input,
+                    args.pricing_output or pricing_output_for(args.pricing_input),
+                    args.chunk_rows,
+                )
+        except (RuntimeError, ValueError) as exc:
+            print(f"[error] {exc}", file=sys.stderr)
+            return 1
+        return 0
+
+    if args.merge_shards is not None:
+        if args.merge_shards < 1:
+            parser.error("--merge-shards must be at least 1")
+        if args.shard:
+            parser.error("--shard cannot be combined with --merge-shards")
+        try:
+            with events.phase("extract"):
+                hotel_map = merge_shard_outputs(
+                    args.jsonl_output,
+                    args.merge_shards,
+                    workers=args.workers,
+                    use_index=not args.no_index,
+                    sweep_csv=args.sweep_csv_output,
+                )
+        except ValueError as exc:
+            print(f"[error] {exc}", file=sys.stderr)
+            return 1
+        jsonl_input = args.jsonl_output
+    elif args.convert_only:
         if not jsonl_input.exists():
             print(f"[error] JSONL input {jsonl_input} not found", file=sys.stderr)
             return 1
-        hotel_map = build_hotel_map_from_jsonl(jsonl_input)
+        with events.phase("extract"):
+            hotel_map = build_hotel_map_from_jsonl(
+                jsonl_input, workers=args.workers, use_index=not args.no_index
+            )
     else:
-        token = args.token
-        if not token:
-            # Try client credentials flow
-            if args.auth_client_id and args.auth_client_secret and args.auth_url:
-                try:
-                    token = fetch_auth_token(
-                        session,
-                        url=args.auth_url,
-                        client_id=args.auth_client_id,
-                        client_secret=args.auth_client_secret,
-                        audience=args.auth_audience,
-                        grant_type=args.auth_grant_type,
-                        timeout=args.timeout,
-                    )
-                    print("Fetched bearer token via client credentials.")
-                except Exception as exc:
-                    print(f"[error] Failed to fetch bearer token: {exc}", file=sys.stderr)
-                    return 1
-            else:
-                parser.error(
-                    "No bearer token provided; set --token or provide auth client credentials."
-                )
-        args.token = token
+        has_credentials = bool(args.auth_client_id and args.auth_client_secret and args.auth_url)
+        if not args.token and not has_credentials:
+            parser.error(
+                "No bearer token provided; set --token or provide auth client credentials."
+            )
+        token_options: dict[str, Any] = {
+            "token": args.token,
+            "url": args.auth_url if has_credentials else None,
+            "client_id": args.auth_client_id,
+            "client_secret": args.auth_client_secret,
+            "audience": args.auth_audience,
+            "grant_type": args.auth_grant_type,
+            "timeout": args.timeout,
+            "cache_path": None if args.no_token_cache else args.token_cache,
+        }
+        token_reused = False
+        if resources:
+            token_manager, token_reused = resources.token_manager(**token_options)
+        else:
+            token_manager = TokenManager(session, **token_options)
+        try:
+            args.token = token_manager.get()
+        except Exception as exc:
+            print(f"[error] Failed to fetch bearer token: {exc}", file=sys.stderr)
+            return 1
+        if token_reused:
+            print("Reusing the worker's bearer token.")
+        elif token_manager.source == "fetched":
+            print("Fetched bearer token via client credentials.")
+        elif token_manager.source == "cache":
+            print(f"Using cached bearer token from {args.token_cache}.")
 
         stay_args = args.stay if args.stay is not None else DEFAULT_STAY_ARGS
+        windows = None
         try:
+            if args.sweep:
+                if args.stay:
+                    raise ValueError("--stay cannot be combined with --sweep")
+                stay_args = []
+                windows = build_sweep_windows(
+                    start_date=args.start_date or date.today(),
+                    lead_start=args.lead_start,
+                    lead_end=args.lead_end,
+                    lead_step=args.lead_step,
+                    stay_length=args.stay_length,
+                    rooms=args.rooms,
+                )
             config = parse_stays(stay_args) if stay_args else None
             hotel_ids = read_hotel_ids(args.csv_path, args.hotel_column)
+            hotel_ids = select_hotel_ids(hotel_ids, args)
         except Exception as exc:
             print(f"[error] {exc}", file=sys.stderr)
             return 1
+        if args.shard:
+            shard_index, shard_count = args.shard
+            total_hotels = len(hotel_ids)
+            hotel_ids = [
+                hotel_id for hotel_id in hotel_ids if shard_of(hotel_id, shard_count) == shard_index
+            ]
+            args.jsonl_output = shard_path(args.jsonl_output, shard_index, shard_count)
+            args.sweep_csv_output = shard_path(args.sweep_csv_output, shard_index, shard_count)
+            print(
+                f"Shard {shard_index}/{shard_count}: {len(hotel_ids)} of {total_hotels} hotels "
+                f"-> {args.jsonl_output}"
+            )
 
-        hotel_map = fetch_bookings_availability(
-            hotel_ids=hotel_ids,
-            config=config,
-            args=args,
-            session=session,
-        )
+        carried: list[dict[str, Any]] = []
+        skipped: list[dict[str, Any]] = []
+        failed: set[str] = set()
+        if args.refresh_budget is not None:
+            if args.refresh_budget < 0:
+                parser.error("--refresh-budget must not be negative")
+            if windows or args.resume:
+                parser.error("--refresh-budget cannot be combined with --sweep or --resume")
+            refresh_path = refresh_path_for(args.jsonl_output)
+            refresh_now = datetime.now(timezone.utc)
+            # Read the previous snapshot before the fetch overwrites the JSONL.
+            previous = (
+                load_completed_records(args.jsonl_output) if args.jsonl_output.exists() else {}
+            )
+            refresh_state = load_refresh_state(refresh_path, args.jsonl_output)
+            fetch_ids, carry_ids = plan_refresh(
+                hotel_ids,
+                previous=previous,
+                state=refresh_state,
+                budget=args.refresh_budget,
+                now=refresh_now,
+                config=config,
+                max_age_hours=args.refresh_max_age,
+            )
+            carried = [
+                carried_record(hotel_id, previous[hotel_id], refresh_state[hotel_id], refresh_now)
+                for hotel_id in carry_ids
+            ]
+            planned = set(fetch_ids) | set(carry_ids)
+            skipped = [
+                skipped_record(hotel_id) for hotel_id in hotel_ids if hotel_id not in planned
+            ]
+            ages = sorted(record["age_hours"] for record in carried)
+            age_note = (
+                f" (median age {ages[len(ages) // 2]:.1f}h, oldest {ages[-1]:.1f}h)" if ages else ""
+            )
+            print(
+                f"Refreshing {len(fetch_ids)} of {len(hotel_ids)} hotels; carrying forward "
+                f"{len(carried)}{age_note}"
+            )
+            if skipped:
+                print(
+                    f"[warn] {len(skipped)} hotel(s) have no previous data and did not fit the "
+                    "budget; they are reported as missing",
+                    file=sys.stderr,
+                )
+            hotel_ids = fetch_ids
+
+        cache = None
+        if (args.cache or args.cache_ttl is not None) and not args.no_cache:
+            cache_options = {
+                "ttl": DEFAULT_CACHE_TTL if args.cache_ttl is None else args.cache_ttl,
+                "max_bytes": int(args.cache_max_mb * 1024 * 1024),
+            }
+            if resources:
+                cache = resources.response_cache(args.cache_dir, **cache_options)
+            else:
+                cache = ResponseCache(args.cache_dir, **cache_options)
+        if resources and resources.scheduler:
+            scheduler = resources.scheduler
+        else:
+            scheduler = RequestScheduler(
+                rate=args.rate,
+                max_rate=args.max_rate,
+                min_rate=scheduler_floor(args.concurrency),
+                max_retries=max(0, args.max_retries),
+            )
+        slot = None
+        if resources and resources.slots:
+            slots, job_name = resources.slots, getattr(args, "job_name", "")
+
+            def slot() -> contextlib.AbstractContextManager[None]:
+                return slots.slot(job_name)
+
+        # Turn SIGTERM (e.g. the web runner's cancel) into a normal exit so the JSONL
+        # is flushed and the progress sidecar records where --resume should pick up.
+        # The --serve worker runs jobs off the main thread and cancels them via `cancel`.
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        try:
+            with events.phase("fetch"):
+                hotel_map = fetch_bookings_availability(
+                    hotel_ids=hotel_ids,
+                    config=config,
+                    args=args,
+                    session=session,
+                    scheduler=scheduler,
+                    token_manager=token_manager,
+                    cache=cache,
+                    windows=windows,
+                    events=events,
+                    carried=carried + skipped,
+                    cancel=cancel,
+                    slot=slot,
+                    failed=failed,
+                )
+        except ValueError as exc:
+            print(f"[error] {exc}", file=sys.stderr)
+            return 1
         jsonl_input = args.jsonl_output
+        if args.refresh_budget is not None:
+            write_progress(
+                refresh_path,
+                {
+                    "version": 1,
+                    "updated_at": refresh_now.isoformat(timespec="seconds"),
+                    "hotels": update_refresh_state(
+                        refresh_state,
+                        {h: nightly for h, nightly in hotel_map.items() if h not in failed},
+                        previous,
+                        refresh_now,
+                    ),
+                },
+            )
+            # A failed refresh keeps the hotel's last good counts instead of blanking it;
+            # re-emit them after the error record so the JSONL snapshot agrees. A search
+            # that succeeded with no rates is a real observation and blanks the hotel.
+            stale = [
+                hotel_id for hotel_id in hotel_ids if hotel_id in failed and hotel_id in previous
+            ]
+            if stale:
+                with open_jsonl(args.jsonl_output, "a") as outfile:
+                    for hotel_id in stale:
+                        record = carried_record(
+                            hotel_id,
+                            previous[hotel_id],
+                            refresh_state.get(hotel_id) or {},
+                            refresh_now,
+                        )
+                        outfile.write(json.dumps(record) + "\n")
+                        carried.append(record)
+                print(
+                    f"[warn] {len(stale)} refresh(es) failed; carrying forward their "
+                    "previous counts",
+                    file=sys.stderr,
+                )
+            for record in carried:
+                hotel_map[record["hotel_id"]] = record["nightly"]
+            for record in skipped:
+                hotel_map.setdefault(record["hotel_id"], {})
+        if args.shard:
+            print(f"Shard done; render all shards with --merge-shards {args.shard[1]}")
+            return 0
 
+    heatmap_dir = None
+    if args.heatmap_payload is not None:
+        heatmap_dir = Path(args.heatmap_payload or args.csv_output.parent / HEATMAP_DIRNAME)
     generate_outputs(
         hotel_map,
         csv_path=args.csv_output,
@@ -617,6 +5392,21 @@ def main(argv: Sequence[str] | None = None) -> int:
         no_csv=args.no_csv,
         no_excel=args.no_excel,
         no_png=args.no_png,
+        parquet_path=args.parquet_output,
+        parquet_layout=args.parquet_layout,
+        png_mode=args.png_mode,
+        png_rooms_required=args.png_rooms_required,
+        png_cell=tuple(args.png_cell) if args.png_cell else None,
+        png_tiles_dir=args.png_tiles,
+        png_tile_size=args.png_tile_size,
+        history_db=args.history_db,
+        history_source=str(jsonl_input),
+        feasibility_path=args.feasibility_output,
+        feasibility_profiles=profiles,
+        heatmap_dir=heatmap_dir,
+        hotel_summary=args.csv_path,
+        hotel_column=args.hotel_column,
+        events=events,
     )
     return 0
 
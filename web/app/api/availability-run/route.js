@@ -16,7 +16,64 @@ function resolveRepoRoot() {
   return cwd;
 }
 
+// Stream a run from a warm `kuoni_room_availability.py --serve` worker instead of
+// cold-starting Python. Closing the stream drops the request, which cancels the job.
+// The worker only accepts requests carrying its ROOMBERG_WORKER_TOKEN secret.
+async function runOnWorker(workerUrl) {
+  const controller = new AbortController();
+  let upstream;
+  try {
+    upstream = await fetch(`${workerUrl.replace(/\/$/, "")}/runs`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        "X-Roomberg-Worker-Token": process.env.ROOMBERG_WORKER_TOKEN || "",
+      },
+      body: JSON.stringify({ args: [] }),
+      signal: controller.signal,
+    });
+  } catch (error) {
+    return new Response(`Worker at ${workerUrl} unreachable: ${error?.message || error}\n`, {
+      status: 502,
+    });
+  }
+  if (!upstream.ok || !upstream.body) {
+    return new Response(await upstream.text(), { status: upstream.status });
+  }
+
+  const reader = upstream.body.getReader();
+  const stream = new ReadableStream({
+    async pull(streamController) {
+      try {
+        const { done, value } = await reader.read();
+        if (done) {
+          streamController.close();
+        } else {
+          streamController.enqueue(value);
+        }
+      } catch (error) {
+        streamController.close();
+      }
+    },
+    cancel() {
+      controller.abort();
+    },
+  });
+
+  return new Response(stream, {
+    headers: {
+      "Content-Type": "text/plain; charset=utf-8",
+      "Cache-Control": "no-store",
+    },
+  });
+}
+
 export async function POST() {
+  const workerUrl = process.env.ROOMBERG_WORKER_URL;
+  if (workerUrl) {
+    return runOnWorker(workerUrl);
+  }
+
   const repoRoot = resolveRepoRoot();
   const scriptPath = path.join(repoRoot, "kuoni_room_availability.py");
 
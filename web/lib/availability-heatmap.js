@@ -7,6 +7,13 @@ const LEAD_JUMP_DAYS = 7;
 const STAY_LENGTH_NIGHTS = 3;
 const LEAD_END_DAYS = 365;
 const ROOMS_REQUIRED = 10;
+// Precomputed payload written by kuoni_room_availability.py --heatmap-payload
+const PAYLOAD_DIRNAME = "heatmap";
+const PAYLOAD_FORMAT = "roomberg-heatmap";
+const PAYLOAD_VERSION = 1;
+const DAY_MS = 86400000;
+
+const payloadCache = new Map();
 
 const MONTH_LOOKUP = {
   jan: 0,
@@ -131,6 +138,116 @@ function loadAvailabilitySummary(outputRoot) {
   return map;
 }
 
+// The manifest fingerprints the CSV written alongside the payload; a later run that
+// rewrites the CSV without --heatmap-payload leaves the payload stale.
+function payloadMatchesCsv(csv, dataPath) {
+  if (!csv) {
+    return false;
+  }
+  try {
+    const stat = fs.statSync(dataPath, { bigint: true });
+    return String(stat.size) === String(csv.bytes) && String(stat.mtimeNs) === csv.mtime_ns;
+  } catch (error) {
+    return false;
+  }
+}
+
+// Only <csv dir>/heatmap is read, the default --heatmap-payload location.
+function loadHeatmapPayload(dataPath) {
+  const directory = path.join(path.dirname(dataPath), PAYLOAD_DIRNAME);
+  const manifestPath = path.join(directory, "manifest.json");
+  let stat;
+  try {
+    stat = fs.statSync(manifestPath);
+  } catch (error) {
+    return null;
+  }
+  const cached = payloadCache.get(manifestPath);
+  if (cached && cached.mtimeMs === stat.mtimeMs) {
+    return payloadMatchesCsv(cached.payload.csv, dataPath) ? cached.payload : null;
+  }
+  try {
+    const manifest = JSON.parse(fs.readFileSync(manifestPath, "utf-8"));
+    if (
+      manifest.format !== PAYLOAD_FORMAT ||
+      manifest.version !== PAYLOAD_VERSION ||
+      !payloadMatchesCsv(manifest.csv, dataPath)
+    ) {
+      return null;
+    }
+    const [hotelCount, dayCount] = manifest.shape;
+    const bytes = fs.readFileSync(path.join(directory, manifest.grid.name));
+    if (bytes.byteLength !== hotelCount * dayCount * Int16Array.BYTES_PER_ELEMENT) {
+      return null;
+    }
+    const data = JSON.parse(
+      fs.readFileSync(path.join(directory, manifest.payload.name), "utf-8")
+    );
+    // Copy out of Node's shared buffer pool so the Int16Array view is aligned.
+    const grid = new Int16Array(
+      bytes.buffer.slice(bytes.byteOffset, bytes.byteOffset + bytes.byteLength)
+    );
+    const payload = {
+      ...data,
+      grid,
+      dayCount,
+      missing: manifest.grid.missing,
+      csv: manifest.csv,
+      startMs: manifest.start_date ? Date.parse(`${manifest.start_date}T00:00:00Z`) : 0,
+    };
+    payloadCache.set(manifestPath, { mtimeMs: stat.mtimeMs, payload });
+    return payload;
+  } catch (error) {
+    // A batch being republished may swap files underneath us; fall back to the CSV.
+    return null;
+  }
+}
+
+function payloadHotels(payload) {
+  const { grid, dayCount, missing, startMs } = payload;
+  return payload.hotels.ids.map((hotelId, row) => {
+    const cityIndex = payload.hotels.city[row];
+    const offset = row * dayCount;
+    return {
+      hotelId,
+      city: cityIndex >= 0 ? payload.cities.names[cityIndex] : "",
+      hmid: payload.hotels.hmid[row] || "",
+      countAt(dayMs) {
+        const day = (dayMs - startMs) / DAY_MS;
+        if (day < 0 || day >= dayCount) {
+          return null;
+        }
+        const count = grid[offset + day];
+        return count === missing ? null : count;
+      },
+    };
+  });
+}
+
+function csvHotels(records, dateColumns, summaryMap) {
+  return records.map((record) => {
+    const hotelId = String(record.hotel_id || "").trim();
+    if (!hotelId) {
+      return null;
+    }
+    const nightlyCounts = {};
+    dateColumns.forEach((date) => {
+      const raw = record[date];
+      const parsed = raw === "" ? null : Number(raw);
+      nightlyCounts[date] = Number.isFinite(parsed) ? parsed : null;
+    });
+    const summary = summaryMap.get(hotelId);
+    return {
+      hotelId,
+      city: summary?.city || "",
+      hmid: summary?.hmid || "",
+      countAt(dayMs) {
+        return nightlyCounts[formatIsoDate(new Date(dayMs))];
+      },
+    };
+  }).filter(Boolean);
+}
+
 function parseAvailabilityCsv(text) {
   const rows = parseCsv(text);
   if (!rows.length) {
@@ -243,15 +360,23 @@ export function loadAvailabilityHeatmapData(batchSlug, options = {}) {
     };
   }
 
-  const dataText = fs.readFileSync(dataPath, "utf-8");
-  const { headers, records } = parseAvailabilityCsv(dataText);
-
-  const dateColumns = headers.filter((header) => {
-    const normalized = header.trim().toLowerCase();
-    return normalized && normalized !== "hotel_id" && normalized !== "coverage";
-  });
+  const payload = loadHeatmapPayload(dataPath);
+  let hotels;
+  if (payload) {
+    hotels = payload.days ? payloadHotels(payload) : [];
+  } else {
+    const dataText = fs.readFileSync(dataPath, "utf-8");
+    const { headers, records } = parseAvailabilityCsv(dataText);
+    const dateColumns = headers.filter((header) => {
+      const normalized = header.trim().toLowerCase();
+      return normalized && normalized !== "hotel_id" && normalized !== "coverage";
+    });
+    hotels = dateColumns.length
+      ? csvHotels(records, dateColumns, loadAvailabilitySummary(outputRoot))
+      : [];
+  }
 
-  if (!dateColumns.length) {
+  if (!hotels.length) {
     return {
       sourceLabel: label,
       sourcePath: path.relative(outputRoot, dataPath) || dataPath,
@@ -269,8 +394,6 @@ export function loadAvailabilityHeatmapData(batchSlug, options = {}) {
     };
   }
 
-  const summaryMap = loadAvailabilitySummary(outputRoot);
-
   let maxRooms = 0;
   let totalRooms = 0;
   let valueCount = 0;
@@ -283,27 +406,15 @@ export function loadAvailabilityHeatmapData(batchSlug, options = {}) {
     weeklyStartDates.push(formatIsoDate(addUtcDays(startBase, offset)));
   }
 
-  const rows = records.map((record) => {
-    const hotelId = String(record.hotel_id || "").trim();
-    if (!hotelId) {
-      return null;
-    }
-    const nightlyCounts = {};
-    dateColumns.forEach((date) => {
-      const raw = record[date];
-      const parsed = raw === "" ? null : Number(raw);
-      nightlyCounts[date] = Number.isFinite(parsed) ? parsed : null;
-    });
-
+  const rows = hotels.map((hotel) => {
     const values = {};
     let availableWeeks = 0;
 
     weeklyStartDates.forEach((start) => {
       let minRooms = null;
-      const base = new Date(`${start}T00:00:00Z`);
+      const baseMs = Date.parse(`${start}T00:00:00Z`);
       for (let i = 0; i < criteria.stayLengthNights; i += 1) {
-        const dateKey = formatIsoDate(addUtcDays(base, i));
-        const count = nightlyCounts[dateKey];
+        const count = hotel.countAt(baseMs + i * DAY_MS);
         if (!Number.isFinite(count)) {
           minRooms = null;
           break;
@@ -331,15 +442,14 @@ export function loadAvailabilityHeatmapData(batchSlug, options = {}) {
       ? availableWeeks / weeklyStartDates.length
       : 0;
 
-    const summary = summaryMap.get(hotelId);
     return {
-      hotelId,
+      hotelId: hotel.hotelId,
       coverage,
-      city: summary?.city || "",
-      hmid: summary?.hmid || "",
+      city: hotel.city,
+      hmid: hotel.hmid,
       values,
     };
-  }).filter(Boolean);
+  });
 
   const totalCells = rows.length * weeklyStartDates.length;
   const avgRooms = valueCount ? totalRooms / valueCount : 0;